@@ -0,0 +1,147 @@
+import asyncio
+import json
+import sys
+import time
+from collections import defaultdict
+from typing import Iterable, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def percentile(values: list, pct: float) -> float:
+    """
+    Nearest rank percentile
+    :param values: sorted values
+    :param pct: percentile, 0-100
+    :return: float
+    """
+    if not values:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Peak resident set size of the process so far, None where the platform can't tell
+    :return: MB
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class LatencyRecorder:
+    """
+    Latencies and failures per route of one scenario
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.soft_failures = defaultdict(int)
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, route: str, seconds: float, status_code: int, body: bytes) -> None:
+        self.latencies[route].append(seconds)
+        if status_code >= 400 and status_code != 404:
+            self.errors[route] += 1
+        # Handlers answer business failures (e.g. out of stock) with status failed and HTTP 200
+        elif body[:40].replace(b' ', b'').startswith(b'{"status":"failed"'):
+            self.soft_failures[route] += 1
+
+    def finish(self) -> None:
+        self.finished = time.perf_counter()
+
+    def summary(self) -> dict:
+        """
+        Returns throughput and p50/p95/p99 latency in ms overall and per route
+        :return: dict
+        """
+        seconds = (self.finished or time.perf_counter()) - self.started
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            routes[route] = _latency_summary(sorted(latencies), seconds)
+            routes[route].update({'errors': self.errors[route], 'soft_failures': self.soft_failures[route]})
+        everything = sorted(latency for latencies in self.latencies.values() for latency in latencies)
+
+        return {
+            'seconds': round(seconds, 3),
+            **_latency_summary(everything, seconds),
+            'errors': sum(self.errors.values()),
+            'soft_failures': sum(self.soft_failures.values()),
+            'peak_rss_mb': peak_rss_mb(),
+            'routes': routes
+        }
+
+
+def _latency_summary(latencies: list, seconds: float) -> dict:
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / seconds, 1) if seconds else 0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+async def run_requests(client, requests: Iterable[tuple], concurrency: int) -> dict:
+    """
+    Sends requests with a fixed number of concurrent clients
+    :param client: httpx.AsyncClient
+    :param requests: (route label, method, url, request kwargs) tuples
+    :param concurrency: concurrent clients
+    :return: LatencyRecorder summary
+    """
+    recorder = LatencyRecorder()
+    pending = iter(requests)
+
+    async def worker():
+        for route, method, url, kwargs in pending:
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            recorder.record(route, time.perf_counter() - started, response.status_code, response.content)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    recorder.finish()
+
+    return recorder.summary()
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float, min_delta_ms: float = 2) -> list:
+    """
+    Lists regressions against a baseline run: p95 latency over or throughput under the baseline
+    by more than the tolerance, per scenario and route
+    :param results: current run
+    :param baseline: baseline run
+    :param tolerance: allowed relative change, e.g. 0.2
+    :param min_delta_ms: p95 increases smaller than this are noise of sub millisecond routes
+    :return: list of regression messages
+    """
+    regressions = []
+    for scenario, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(scenario)
+        if not previous or 'routes' not in current:
+            continue
+        pairs = [(scenario, current, previous)] + [
+            (f'{scenario} {route}', stats, previous['routes'][route])
+            for route, stats in current['routes'].items() if route in previous.get('routes', {})
+        ]
+        for name, now, then in pairs:
+            if then['p95_ms'] and now['p95_ms'] > max(then['p95_ms'] * (1 + tolerance), then['p95_ms'] + min_delta_ms):
+                regressions.append(f"{name}: p95 {now['p95_ms']}ms, baseline {then['p95_ms']}ms")
+            if then['throughput_rps'] and now['throughput_rps'] < then['throughput_rps'] * (1 - tolerance):
+                regressions.append(f"{name}: {now['throughput_rps']} req/s, baseline {then['throughput_rps']} req/s")
+
+    return regressions
+
+
+def load_results(path: str) -> dict:
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
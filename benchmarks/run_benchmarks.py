@@ -0,0 +1,143 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+import seed_data
+from benchmarks.bench_utils import compare_results, load_results, peak_rss_mb
+from benchmarks.scenarios import HTTP_SCENARIOS, load_catalog, serialization_scenario
+from db_utils import configure_database
+from main import create_app
+
+SCENARIOS = tuple(HTTP_SCENARIOS) + ('serialization',)
+DEFAULT_SCENARIOS = ('routes', 'pos', 'dashboard', 'analyst')
+
+
+async def run_http_scenarios(url: str, scenarios: list, requests: int, concurrency: int, days: int,
+                             seed: int) -> dict:
+    """
+    Runs the HTTP scenarios in process against the app, through its lifespan like a server would
+    :param url: database URL
+    :param scenarios: scenario names
+    :param requests: requests per scenario
+    :param concurrency: concurrent clients
+    :param days: days the seeded sales span
+    :param seed: random seed of the generated requests
+    :return: dict of scenario name to summary
+    """
+    app = create_app(url)
+    results = {}
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+            catalog = await load_catalog(client, days)
+            if not catalog.skus:
+                sys.exit('Database has no products, seed it first')
+            for name in scenarios:
+                print(f'Running {name}', file=sys.stderr)
+                results[name] = await HTTP_SCENARIOS[name](client, catalog, random.Random(seed), requests,
+                                                           concurrency)
+
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Seeds a database and benchmarks the API with realistic traffic')
+    parser.add_argument('--url', help='database URL, a temporary SQLite database if not given')
+    parser.add_argument('--no-seed', action='store_true', help='benchmark the data already in --url')
+    parser.add_argument('--reset', action='store_true', help='delete every row of --url before seeding')
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--sales', type=int, default=100000, help='seeded sales, e.g. 1000 to 10000000')
+    parser.add_argument('--days', type=int, default=365, help='days the sales are spread over, ending now')
+    parser.add_argument('--seed', type=int, default=42, help='random seed of the data and the requests')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help=f'repeatable, default {" ".join(DEFAULT_SCENARIOS)}')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent clients')
+    parser.add_argument('--serialization-rows', type=int, action='append',
+                        help='rows per serialization run, repeatable, default 10000 100000 1000000')
+    parser.add_argument('--output', default='benchmark_results.json', help='results JSON file')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95 latency increase and throughput decrease against the baseline')
+    parser.add_argument('--min-delta-ms', type=float, default=2,
+                        help='p95 latency increases under this many ms are not regressions')
+    args = parser.parse_args()
+    scenarios = args.scenario or list(DEFAULT_SCENARIOS)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        url = args.url or f'sqlite:///{os.path.join(tmp_dir, "bench.db")}'
+        configure_database(url)
+        seed_seconds = None
+        if not args.no_seed:
+            started = time.perf_counter()
+            seed_data.main(args.categories, args.products, args.sales, args.days, args.seed, args.reset)
+            seed_seconds = round(time.perf_counter() - started, 3)
+
+        results = {}
+        http_scenarios = [name for name in scenarios if name in HTTP_SCENARIOS]
+        if http_scenarios:
+            results.update(asyncio.run(run_http_scenarios(url, http_scenarios, args.requests, args.concurrency,
+                                                          args.days, args.seed)))
+        if 'serialization' in scenarios:
+            print('Running serialization', file=sys.stderr)
+            results['serialization'] = serialization_scenario(tuple(args.serialization_rows or
+                                                                    (10000, 100000, 1000000)))
+
+    output = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'database': url.split(':')[0] if args.url else 'sqlite (temporary)',
+            'categories': args.categories,
+            'products': args.products,
+            'sales': args.sales,
+            'seeded': not args.no_seed,
+            'seed_seconds': seed_seconds,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        },
+        'peak_rss_mb': peak_rss_mb(),
+        'scenarios': results
+    }
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(output, file, indent=2)
+
+    for name, summary in results.items():
+        if 'p95_ms' in summary:
+            print(f"{name}: {summary['throughput_rps']} req/s, p50 {summary['p50_ms']}ms, p95 {summary['p95_ms']}ms, "
+                  f"p99 {summary['p99_ms']}ms, {summary['errors']} errors")
+    print(f'Results saved to {args.output}')
+
+    failed = False
+    errors = sum(summary.get('errors', 0) for summary in results.values())
+    if errors:
+        print(f'{errors} requests failed', file=sys.stderr)
+        failed = True
+    for name, summary in results.items():
+        for violation in summary.get('violations', []):
+            print(f'{name}: {violation}', file=sys.stderr)
+            failed = True
+    if args.baseline:
+        regressions = compare_results(output, load_results(args.baseline), args.tolerance,
+                                      args.min_delta_ms)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        failed = failed or bool(regressions)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import httpx
+
+from benchmarks.bench_utils import LatencyRecorder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_START_TIMEOUT = 60  # seconds
+
+
+def _read_requests(rng: random.Random, categories: list, seconds: float):
+    """
+    Endpoint mix of the dashboards, generated until the time is up
+    """
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        choice = rng.random()
+        if choice < 0.3:
+            yield '/inventory/status', 'GET', '/inventory/status', {'params': {'low_stock': True, 'limit': 100}}
+        elif choice < 0.5:
+            yield '/inventory/status category', 'GET', '/inventory/status', {
+                'params': {'category': rng.choice(categories), 'limit': 100}}
+        elif choice < 0.7:
+            yield '/product/list', 'GET', '/product/list', {'params': {'cached': True}}
+        elif choice < 0.85:
+            yield '/category/list', 'GET', '/category/list', {'params': {'cached': True}}
+        else:
+            start = date.today() - timedelta(days=rng.randrange(30, 300))
+            yield '/sales/series', 'GET', '/sales/series', {
+                'params': {'start_date': start, 'end_date': start + timedelta(days=30), 'split_by': 'category'}}
+
+
+def _client_process(base_url: str, categories: list, seconds: float, concurrency: int, seed: int,
+                    results: multiprocessing.Queue) -> None:
+    async def run():
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=None) as client:
+            recorder = LatencyRecorder()
+
+            async def worker(requests):
+                for route, method, url, kwargs in requests:
+                    started = time.perf_counter()
+                    response = await client.request(method, url, **kwargs)
+                    recorder.record(route, time.perf_counter() - started, response.status_code, response.content)
+
+            requests = _read_requests(random.Random(seed), categories, seconds)
+            await asyncio.gather(*(worker(requests) for _ in range(concurrency)))
+            results.put((dict(recorder.latencies), dict(recorder.errors)))
+
+    asyncio.run(run())
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(base_url: str) -> None:
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f'{base_url}/category/list').status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Server at {base_url} did not start in {SERVER_START_TIMEOUT}s')
+
+
+def measure(url: str, workers: int, clients: int, concurrency: int, seconds: float, seed: int) -> dict:
+    """
+    Starts the server with a number of workers and drives its read endpoints from client processes
+    :param url: database URL
+    :param workers: server worker processes
+    :param clients: load generating processes
+    :param concurrency: connections per client process
+    :param seconds: measured duration
+    :param seed: random seed of the requests
+    :return: LatencyRecorder summary
+    """
+    port = _free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    server = subprocess.Popen([sys.executable, 'main.py', '--host', '127.0.0.1', '--port', str(port),
+                               '--workers', str(workers)],
+                              cwd=ROOT, env={**os.environ, 'DATABASE_URL': url, 'ASYNC_DATABASE_URL': ''},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(base_url)
+        categories = [category['name'] for category in httpx.get(f'{base_url}/category/list').json()['data']]
+
+        # Warm every worker's caches and connection pool before measuring
+        _warm_up(base_url, categories, concurrency * workers)
+
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_client_process, args=(
+            base_url, categories, seconds, concurrency, seed + index, results)) for index in range(clients)]
+        recorder = LatencyRecorder()
+        for process in processes:
+            process.start()
+        for _ in processes:
+            latencies, errors = results.get()
+            for route, values in latencies.items():
+                recorder.latencies[route].extend(values)
+            for route, count in errors.items():
+                recorder.errors[route] += count
+        for process in processes:
+            process.join()
+        # Throughput over the measured time, not the process start up
+        recorder.started, recorder.finished = 0, seconds
+    finally:
+        server.terminate()
+        server.wait()
+
+    summary = recorder.summary()
+    # Peak RSS of the benchmark process says nothing about the server
+    del summary['peak_rss_mb']
+    return summary
+
+
+def _warm_up(base_url: str, categories: list, requests: int) -> None:
+    with httpx.Client(base_url=base_url, headers={'Connection': 'close'}) as client:
+        for route, method, url, kwargs in _read_requests(random.Random(0), categories, 3600):
+            client.request(method, url, **kwargs)
+            requests -= 1
+            if requests <= 0:
+                return
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Throughput of the read endpoints by number of server workers')
+    parser.add_argument('--url', help='database URL, a temporary SQLite database seeded with seed_data if not given')
+    parser.add_argument('--sales', type=int, default=100000, help='seeded sales when --url is not given')
+    parser.add_argument('--workers', type=int, action='append',
+                        help=f'worker counts to measure, repeatable, default 1, 2, 4 ... up to {os.cpu_count()}')
+    parser.add_argument('--clients', type=int, help='load generating processes, default the number of cores')
+    parser.add_argument('--concurrency', type=int, default=16, help='connections per client process')
+    parser.add_argument('--seconds', type=float, default=15, help='measured seconds per worker count')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='scaling_results.json', help='results JSON file')
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, *(2 ** i for i in range(1, cores.bit_length()) if 2 ** i <= cores),
+                                            cores})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        url = args.url
+        if not url:
+            url = f'sqlite:///{os.path.join(tmp_dir, "bench.db")}'
+            subprocess.run([sys.executable, 'seed_data.py', '--url', url, '--sales', str(args.sales),
+                            '--seed', str(args.seed)], cwd=ROOT, check=True, stderr=subprocess.DEVNULL)
+
+        results = {}
+        for workers in worker_counts:
+            print(f'Measuring {workers} workers', file=sys.stderr)
+            results[workers] = measure(url, workers, args.clients or cores, args.concurrency, args.seconds,
+                                       args.seed)
+
+    baseline = results[worker_counts[0]]['throughput_rps'] / worker_counts[0]
+    for workers, summary in results.items():
+        # 1.0 is linear scaling from the smallest worker count
+        summary['scaling_efficiency'] = round(summary['throughput_rps'] / (baseline * workers), 3) if baseline else 0
+        print(f"{workers} workers: {summary['throughput_rps']} req/s, p95 {summary['p95_ms']}ms, "
+              f"efficiency {summary['scaling_efficiency']}")
+
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump({
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'config': {'cores': cores, 'database': url.split(':')[0], 'clients': args.clients or cores,
+                       'concurrency': args.concurrency, 'seconds': args.seconds},
+            'workers': results
+        }, file, indent=2)
+    print(f'Results saved to {args.output}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,401 @@
+import asyncio
+import json
+import random
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine, func, select, text
+
+import db_utils
+from benchmarks.bench_utils import LatencyRecorder, peak_rss_mb, run_requests
+from db_utils import Inventory, InventoryStatus, Product, Sale
+from schemas import SalesDataResponse
+from utils.ledger_utils import sales_ledger
+from utils.query_utils import sales_query
+from utils.range_utils import day_range
+from utils.rollup_utils import check_rollups
+from utils.response_utils import SALE_FIELDS, rows_response
+
+
+class Catalog:
+    """
+    SKUs, categories and sales date range of the benchmarked database
+    """
+
+    def __init__(self, skus: list, categories: list, days: int):
+        self.skus = skus
+        self.categories = categories
+        self.end = date.today()
+        self.start = self.end - timedelta(days=days)
+
+    def period(self, rng: random.Random, days: int) -> tuple:
+        start = self.start + timedelta(days=rng.randrange(max((self.end - self.start).days - days, 1)))
+        return start, start + timedelta(days=days)
+
+
+async def load_catalog(client, days: int) -> Catalog:
+    products = (await client.get('/product/list')).json()['data']
+    categories = (await client.get('/category/list')).json()['data']
+    return Catalog([product['sku'] for product in products], [category['name'] for category in categories], days)
+
+
+async def top_up_stock(client, catalog: Catalog, stock: int = 1000000) -> None:
+    """
+    Stocks every product so sale scenarios measure sales, not out of stock answers
+    """
+    lines = 'sku,stock\n' + ''.join(f'{sku},{stock}\n' for sku in catalog.skus)
+    await client.post('/inventory/bulk_add', files={'file': ('stock.csv', lines.encode())})
+
+
+def _sale_requests(rng: random.Random, catalog: Catalog, count: int):
+    for _ in range(count):
+        # Mostly single item POS sales, some multi line orders
+        if rng.random() < 0.9:
+            yield ('/sale/make_sale', 'POST', '/sale/make_sale',
+                   {'params': {'product_sku': rng.choice(catalog.skus), 'quantity': rng.randint(1, 3)}})
+        else:
+            items = [{'sku': sku, 'quantity': rng.randint(1, 3)}
+                     for sku in rng.sample(catalog.skus, min(rng.randint(2, 4), len(catalog.skus)))]
+            yield '/sale/make_order', 'POST', '/sale/make_order', {'json': {'items': items}}
+
+
+async def pos_scenario(client, catalog: Catalog, rng: random.Random, requests: int, concurrency: int) -> dict:
+    """
+    Point of sale bursts: make_sale with some make_order
+    """
+    await top_up_stock(client, catalog)
+    return await run_requests(client, _sale_requests(rng, catalog, requests), concurrency)
+
+
+async def dashboard_scenario(client, catalog: Catalog, rng: random.Random, requests: int, concurrency: int) -> dict:
+    """
+    Dashboards polling stock status and the catalog lists
+    """
+    def generate():
+        for _ in range(requests):
+            choice = rng.random()
+            if choice < 0.4:
+                yield ('/inventory/status low_stock', 'GET', '/inventory/status',
+                       {'params': {'low_stock': True, 'limit': 100}})
+            elif choice < 0.6:
+                yield ('/inventory/status category', 'GET', '/inventory/status',
+                       {'params': {'category': rng.choice(catalog.categories), 'limit': 100}})
+            elif choice < 0.7:
+                yield ('/inventory/status sku_prefix', 'GET', '/inventory/status',
+                       {'params': {'sku_prefix': rng.choice(catalog.skus)[:-1], 'limit': 100}})
+            elif choice < 0.75:
+                yield '/product/list cached', 'GET', '/product/list', {'params': {'cached': True}}
+            elif choice < 0.9:
+                # Lookup as you type, a SKU prefix
+                yield '/product/search', 'GET', '/product/search', {'params': {'q': rng.choice(catalog.skus)[:-2]}}
+            else:
+                yield '/category/list cached', 'GET', '/category/list', {'params': {'cached': True}}
+
+    return await run_requests(client, generate(), concurrency)
+
+
+async def analyst_scenario(client, catalog: Catalog, rng: random.Random, requests: int, concurrency: int) -> dict:
+    """
+    Analysts comparing periods and paging through sales
+    """
+    def generate():
+        for _ in range(requests):
+            choice = rng.random()
+            (start, end), (start2, end2) = catalog.period(rng, 30), catalog.period(rng, 30)
+            periods = {'start_date': start, 'end_date': end, 'start_date2': start2, 'end_date2': end2}
+            categories = rng.sample(catalog.categories, 2)
+            if choice < 0.15:
+                yield ('/sales/compare_data raw', 'GET', '/sales/compare_data',
+                       {'params': {**periods, 'category1': categories[0], 'category2': categories[1]}})
+            elif choice < 0.35:
+                yield ('/sales/compare_data aggregate', 'GET', '/sales/compare_data',
+                       {'params': {**periods, 'category1': categories[0], 'category2': categories[1],
+                                   'mode': 'aggregate'}})
+            elif choice < 0.5:
+                quarters = [catalog.period(rng, 90) for _ in range(4)]
+                yield ('/sales/compare_summary', 'GET', '/sales/compare_summary',
+                       {'params': {'period': [f'{start}:{end}' for start, end in quarters],
+                                   'group_by': ['category', 'bucket'], 'bucket': 'monthly'}})
+            elif choice < 0.7:
+                yield ('/sales/get_data page', 'GET', '/sales/get_data',
+                       {'params': {'start_date': start, 'end_date': end, 'limit': 1000}})
+            elif choice < 0.8:
+                yield ('/sales/get_data aggregate', 'GET', '/sales/get_data',
+                       {'params': {'start_date': start, 'end_date': end, 'mode': 'aggregate'}})
+            elif choice < 0.9:
+                yield ('/sales/get_timed_data aggregate', 'GET', '/sales/get_timed_data',
+                       {'params': {'interval': rng.choice(['daily', 'weekly', 'monthly']), 'mode': 'aggregate'}})
+            else:
+                yield ('/inventory/track page', 'GET', '/inventory/track',
+                       {'params': {'start_date': start, 'end_date': end, 'limit': 1000}})
+
+    return await run_requests(client, generate(), concurrency)
+
+
+async def routes_scenario(client, catalog: Catalog, rng: random.Random, requests: int, concurrency: int) -> dict:
+    """
+    Every route of the app, round robin, one client so writes don't collide
+    """
+    def generate():
+        for i in range(max(requests // 20, 1)):
+            sku = rng.choice(catalog.skus)
+            category = rng.choice(catalog.categories)
+            start, end = catalog.period(rng, 7)
+            new_sku = f'BENCH{i}-{rng.randrange(10 ** 9)}'
+            yield '/category/add', 'POST', '/category/add', {'params': {'name': f'Bench {new_sku}'}}
+            yield '/product/add', 'POST', '/product/add', {
+                'params': {'name': new_sku, 'price': 10, 'category': category, 'sku': new_sku}}
+            yield '/inventory/add', 'POST', '/inventory/add', {'params': {'product_sku': new_sku, 'stock': 50}}
+            yield '/inventory/threshold', 'POST', '/inventory/threshold', {
+                'params': {'product_sku': sku, 'threshold': rng.randint(10, 50)}}
+            yield '/inventory/bulk_add', 'POST', '/inventory/bulk_add', {
+                'files': {'file': ('stock.csv', f'sku,stock\n{sku},5\n'.encode())}}
+            yield '/product/bulk_add', 'POST', '/product/bulk_add', {
+                'files': {'file': ('products.csv', f'name,sku,price,category\n{new_sku},{new_sku},12,{category}\n'
+                                   .encode())}}
+            yield '/sale/make_sale', 'POST', '/sale/make_sale', {'params': {'product_sku': new_sku, 'quantity': 1}}
+            yield '/sale/make_order', 'POST', '/sale/make_order', {
+                'json': {'items': [{'sku': new_sku, 'quantity': 1}, {'sku': sku, 'quantity': 1}]}}
+            yield '/inventory/status', 'GET', '/inventory/status', {'params': {'limit': 100}}
+            yield '/inventory/track', 'GET', '/inventory/track', {
+                'params': {'start_date': start, 'end_date': end, 'limit': 100}}
+            yield '/category/list', 'GET', '/category/list', {}
+            yield '/product/list', 'GET', '/product/list', {}
+            yield '/product/search', 'GET', '/product/search', {'params': {'q': sku[:-2]}}
+            yield '/sales/get_data', 'GET', '/sales/get_data', {
+                'params': {'start_date': start, 'end_date': end, 'limit': 100}}
+            yield '/sales/get_timed_data', 'GET', '/sales/get_timed_data', {
+                'params': {'interval': 'daily', 'limit': 100}}
+            yield '/sales/compare_data', 'GET', '/sales/compare_data', {
+                'params': {'start_date': start, 'end_date': end, 'start_date2': start, 'end_date2': end,
+                           'mode': 'aggregate'}}
+            yield '/sales/compare_summary', 'GET', '/sales/compare_summary', {
+                'params': {'period': f'{start}:{end}', 'group_by': 'product'}}
+            yield '/system/db_pool', 'GET', '/system/db_pool', {}
+            yield '/system/cache', 'GET', '/system/cache', {}
+            yield '/system/ledger', 'GET', '/system/ledger', {}
+            yield '/metrics', 'GET', '/metrics', {}
+
+    return await run_requests(client, generate(), 1)
+
+
+async def ledger_scenario(client, catalog: Catalog, rng: random.Random, requests: int, concurrency: int,
+                          batch_sizes: tuple = (1, 10, 100, 500)) -> dict:
+    """
+    make_sale throughput in sync mode and with the write-behind ledger at several batch sizes.
+    sales_per_sec counts until the ledger has committed every queued sale
+    """
+    await top_up_stock(client, catalog)
+    ledger_batch_size = sales_ledger.batch_size
+    results = {}
+    for batch_size in (None,) + tuple(batch_sizes):
+        requests_iter = (('/sale/make_sale', 'POST', '/sale/make_sale',
+                          {'params': {'product_sku': rng.choice(catalog.skus), 'quantity': 1}})
+                         for _ in range(requests))
+        started = time.perf_counter()
+        if batch_size:
+            sales_ledger.batch_size = batch_size
+            await sales_ledger.start()
+            summary = await run_requests(client, requests_iter, concurrency)
+            await sales_ledger.stop()
+        else:
+            summary = await run_requests(client, requests_iter, concurrency)
+        summary['sales_per_sec'] = round(requests / (time.perf_counter() - started), 1)
+        results['sync' if batch_size is None else f'write_behind_batch_{batch_size}'] = summary
+    sales_ledger.batch_size = ledger_batch_size
+
+    return {'modes': results, 'peak_rss_mb': peak_rss_mb()}
+
+
+async def mixed_scenario(client, catalog: Catalog, rng: random.Random, requests: int, concurrency: int) -> dict:
+    """
+    make_sale traffic while a few clients pull 30 day sales reports, with the reports served by the async
+    handlers and with the same report queries run on the blocking sync engine inside the event loop, the way
+    handlers ran before the async engine. sales_per_sec and sale latency show how much the reports stall sales
+    """
+    await top_up_stock(client, catalog)
+    report_clients = max(concurrency // 5, 1)
+    reports = max(requests // 20, report_clients)
+    periods = [catalog.period(rng, 30) for _ in range(reports)]
+    results = {}
+    for mode in ('async', 'sync_blocking'):
+        sales_iter = (('/sale/make_sale', 'POST', '/sale/make_sale',
+                       {'params': {'product_sku': rng.choice(catalog.skus), 'quantity': 1}})
+                      for _ in range(requests))
+        # A distinct cursor per report keeps the report cache out of the comparison
+        report_iter = iter(enumerate(periods, 1))
+        report_recorder = LatencyRecorder()
+
+        async def report_client():
+            for cursor, (start, end) in report_iter:
+                started = time.perf_counter()
+                if mode == 'async':
+                    response = await client.get('/sales/get_data', params={'start_date': start, 'end_date': end,
+                                                                           'cursor': cursor})
+                    status_code, body = response.status_code, response.content
+                else:
+                    with db_utils.SessionLocal() as db:
+                        rows = db.execute(sales_query(*day_range(start, end)).where(Sale.id > cursor)).all()
+                    status_code, body = 200, rows_response({'status': 'success', 'data': rows}, SALE_FIELDS).body
+                    await asyncio.sleep(0)
+                report_recorder.record('/sales/get_data', time.perf_counter() - started, status_code, body)
+
+        started = time.perf_counter()
+        summary, *_ = await asyncio.gather(run_requests(client, sales_iter, concurrency),
+                                           *(report_client() for _ in range(report_clients)))
+        summary['sales_per_sec'] = round(requests / (time.perf_counter() - started), 1)
+        report_recorder.finish()
+        summary['reports'] = report_recorder.summary()
+        del summary['reports']['routes'], summary['reports']['peak_rss_mb']
+        results[mode] = summary
+
+    return {'modes': results, 'peak_rss_mb': peak_rss_mb()}
+
+
+async def _hot_sku_counts(sku: str) -> dict:
+    async with db_utils.AsyncSessionLocal() as db:
+        product_id = await db.scalar(select(Product.id).where(Product.sku == sku))
+        return {
+            'stock': await db.scalar(select(Inventory.stock).where(Inventory.product_id == product_id)),
+            'sales': await db.scalar(select(func.count()).select_from(Sale).where(Sale.product_id == product_id)),
+            'removes': await db.scalar(select(func.count()).select_from(InventoryStatus)
+                                       .where(InventoryStatus.product_id == product_id,
+                                              InventoryStatus.operation == 'remove'))
+        }
+
+
+async def hot_sku_scenario(client, catalog: Catalog, rng: random.Random, requests: int, concurrency: int) -> dict:
+    """
+    Overselling check: one SKU stocked with half as many units as there are concurrent single unit sales of it,
+    in sync mode and with the write-behind ledger. Exactly stock sales may succeed, leaving stock 0 with one
+    sale and one inventory_status remove row each; anything else is listed in violations
+    """
+    stock = max(requests // 2, 1)
+    results = {}
+    violations = []
+    for mode in ('sync', 'write_behind'):
+        sku = f'HOT-{mode}-{rng.randrange(10 ** 9)}'
+        await client.post('/product/add', params={'name': sku, 'price': 10, 'category': catalog.categories[0],
+                                                  'sku': sku})
+        await client.post('/inventory/add', params={'product_sku': sku, 'stock': stock})
+
+        requests_iter = (('/sale/make_sale', 'POST', '/sale/make_sale', {'params': {'product_sku': sku, 'quantity': 1}})
+                         for _ in range(requests))
+        if mode == 'write_behind':
+            await sales_ledger.start()
+            summary = await run_requests(client, requests_iter, concurrency)
+            await sales_ledger.stop()
+        else:
+            summary = await run_requests(client, requests_iter, concurrency)
+
+        summary['stocked'] = stock
+        summary['sold'] = summary['requests'] - summary['errors'] - summary['soft_failures']
+        summary.update(await _hot_sku_counts(sku))
+        expected = {'sold': stock, 'stock': 0, 'sales': stock, 'removes': stock}
+        violations += [f'{mode}: {key} {summary[key]}, expected {value}' for key, value in expected.items()
+                       if summary[key] != value]
+        results[mode] = summary
+
+    return {'modes': results, 'violations': violations, 'peak_rss_mb': peak_rss_mb()}
+
+
+async def recategorize_scenario(client, catalog: Catalog, rng: random.Random, requests: int,
+                                concurrency: int) -> dict:
+    """
+    Product bulk imports moving a few products to another category while they sell, in sync mode and with
+    the write-behind ledger, then the rollup totals per category are compared with the raw sales. Category
+    reports read the category copied into the rollups, mismatches are listed in violations
+    """
+    await top_up_stock(client, catalog)
+    products = (await client.get('/product/list')).json()['data']
+    imports = 4
+    results = {}
+    violations = []
+    for mode in ('sync', 'write_behind'):
+        moved = rng.sample(products, min(max(requests // 50, 1), len(products)))
+
+        def generate():
+            for i in range(requests):
+                if i % max(requests // imports, 1) == 0:
+                    category = catalog.categories[i * imports // max(requests, 1) % len(catalog.categories)]
+                    lines = 'name,sku,price,category\n' + ''.join(
+                        f"{product['name']},{product['sku']},{product['price']},{category}\n" for product in moved)
+                    yield '/product/bulk_add', 'POST', '/product/bulk_add', {
+                        'files': {'file': ('products.csv', lines.encode())}}
+                else:
+                    yield '/sale/make_sale', 'POST', '/sale/make_sale', {
+                        'params': {'product_sku': rng.choice(moved)['sku'], 'quantity': 1}}
+
+        if mode == 'write_behind':
+            await sales_ledger.start()
+            summary = await run_requests(client, generate(), concurrency)
+            await sales_ledger.stop()
+        else:
+            summary = await run_requests(client, generate(), concurrency)
+
+        async with db_utils.AsyncSessionLocal() as db:
+            mismatches = await check_rollups(db)
+        summary['moved_products'] = len(moved)
+        summary['rollup_mismatches'] = len(mismatches)
+        violations += [f'{mode}: {mismatch}' for mismatch in mismatches]
+        results[mode] = summary
+
+    return {'modes': results, 'violations': violations, 'peak_rss_mb': peak_rss_mb()}
+
+
+def serialization_scenario(sizes: tuple = (10000, 100000, 1000000)) -> dict:
+    """
+    Serialization time and peak traced memory of a /sales/get_data page: the former jsonable_encoder path,
+    the response model path and rows_response straight from the rows
+    """
+    engine = create_engine('sqlite://')
+    results = {}
+    for size in sizes:
+        with engine.connect() as conn:
+            rows = conn.execute(text(
+                'WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < :size) '
+                "SELECT x, 'Product ' || x, 2, 10.5, 21.0, datetime('2024-01-01', '+' || x || ' seconds') FROM seq"
+            ), {'size': size}).all()
+
+        def encoder():
+            data = [dict(zip(SALE_FIELDS, row)) for row in rows]
+            return json.dumps(jsonable_encoder({'status': 'success', 'data': data, 'next_cursor': None})).encode()
+
+        def response_model():
+            data = [dict(zip(SALE_FIELDS, row)) for row in rows]
+            model = SalesDataResponse.model_validate({'status': 'success', 'data': data, 'next_cursor': None})
+            return model.model_dump_json(by_alias=True, exclude_unset=True).encode()
+
+        def from_rows():
+            return rows_response({'status': 'success', 'data': rows, 'next_cursor': None}, SALE_FIELDS).body
+
+        results[size] = {}
+        for name, serialize in (('jsonable_encoder', encoder), ('response_model', response_model),
+                                ('rows_response', from_rows)):
+            started = time.perf_counter()
+            body = serialize()
+            seconds = time.perf_counter() - started
+            # Traced separately, tracing slows allocation heavy code down several times
+            tracemalloc.start()
+            serialize()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[size][name] = {'ms': round(seconds * 1000, 1), 'peak_mb': round(peak / 2 ** 20, 1),
+                                   'bytes': len(body)}
+        rows = None
+
+    return {'sizes': results, 'peak_rss_mb': peak_rss_mb()}
+
+
+HTTP_SCENARIOS = {
+    'pos': pos_scenario,
+    'dashboard': dashboard_scenario,
+    'analyst': analyst_scenario,
+    'routes': routes_scenario,
+    'ledger': ledger_scenario,
+    'mixed': mixed_scenario,
+    'hot_sku': hot_sku_scenario,
+    'recategorize': recategorize_scenario,
+}
@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import contextvars
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import httpx
+from sqlalchemy import event
+
+import db_utils
+import seed_data
+from main import create_app
+from utils.report_cache_utils import invalidate_reports
+
+# Statements of the request being counted, background tasks of the app run in their own context and are not counted
+_statements = contextvars.ContextVar('statements', default=None)
+
+
+def get_checked_requests(days: int) -> list:
+    """
+    List endpoints whose statement count must not grow with the rows they return
+    :param days: days the seeded sales span, ending today
+    :return: list of (name, path, params)
+    """
+    end = date.today()
+    start = end - timedelta(days=days)
+    dates = {'start_date': start, 'end_date': end}
+
+    return [
+        ('/category/list', '/category/list', {}),
+        ('/product/list', '/product/list', {}),
+        ('/inventory/status', '/inventory/status', {}),
+        ('/inventory/status low_stock', '/inventory/status', {'low_stock': True}),
+        ('/inventory/track', '/inventory/track', dates),
+        ('/sales/get_data', '/sales/get_data', dates),
+        ('/sales/get_data aggregate', '/sales/get_data', {**dates, 'mode': 'aggregate'}),
+        ('/sales/get_timed_data', '/sales/get_timed_data', {'interval': 'monthly'}),
+        ('/sales/compare_data', '/sales/compare_data', {**dates, 'start_date2': start, 'end_date2': end,
+                                                        'category1': 'Category 001', 'category2': 'Category 002'}),
+        ('/sales/compare_summary', '/sales/compare_summary', {'period': f'{start}:{end}', 'group_by': 'product'}),
+    ]
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany) -> None:
+    statements = _statements.get()
+    if statements is not None:
+        statements.append(statement)
+
+
+async def count_statements(url: str, days: int) -> dict:
+    """
+    Sends every checked request once to the app serving url and counts the SQL statements each one runs
+    :param url: database URL
+    :param days: days the seeded sales span
+    :return: dict of request name to (status code or failure message, rows, statements)
+    """
+    app = create_app(url)
+    counts = {}
+    async with app.router.lifespan_context(app):
+        engines = (db_utils.get_engine(), db_utils.get_async_engine().sync_engine)
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', _count_statement)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://check', timeout=None) as client:
+            for name, path, params in get_checked_requests(days):
+                statements = []
+                token = _statements.set(statements)
+                try:
+                    response = await client.get(path, params=params)
+                finally:
+                    _statements.reset(token)
+                body = response.json()
+                rows = sum(len(value) for value in body.values() if isinstance(value, list))
+                # Handlers answer business failures with status failed and HTTP 200
+                counts[name] = (response.status_code if body.get('status') != 'failed' else body.get('message'),
+                                rows, statements)
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', _count_statement)
+
+    return counts
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Checks that list endpoints run the same number of SQL statements '
+                                                 'on a database with one row per table and on a larger one')
+    parser.add_argument('--products', type=int, default=200, help='products of the larger database')
+    parser.add_argument('--sales', type=int, default=2000, help='sales of the larger database')
+    parser.add_argument('--days', type=int, default=7, help='days the sales are spread over, ending now')
+    parser.add_argument('--verbose', action='store_true', help='print the statements of every request')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Two categories, compare_data compares two of them
+        for label, categories, products, sales in (('one row', 2, 1, 1),
+                                                   ('many rows', 5, args.products, args.sales)):
+            url = f'sqlite:///{os.path.join(tmp_dir, label.replace(" ", "_"))}.db'
+            db_utils.configure_database(url)
+            seed_data.main(categories, products, sales, args.days, 42, False)
+            # Report responses are cached process wide, the second database must not be answered from the first
+            invalidate_reports()
+            results[label] = asyncio.run(count_statements(url, args.days))
+
+    failed = False
+    for name, (status_code, rows, statements) in results['many rows'].items():
+        one_status_code, one_rows, one_statements = results['one row'][name]
+        ok = status_code == one_status_code == 200 and len(statements) == len(one_statements)
+        failed = failed or not ok
+        print(f"{'ok' if ok else 'FAILED':7} {name}: {len(one_statements)} statements for {one_rows} rows, "
+              f"{len(statements)} statements for {rows} rows (HTTP {one_status_code}, {status_code})")
+        if args.verbose or not ok:
+            for statement in statements:
+                print(f"    {' '.join(statement.split())[:200]}")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,4 +7,26 @@ TIME_INTERVAL_MAPPING = {
     'weekly': timedelta(weeks=1),
     'monthly': timedelta(days=30),  # Adjust as needed
     'yearly': timedelta(days=365),  # Adjust as needed
-}
\ No newline at end of file
+}
+
+# Keyset pagination / streaming
+MAX_PAGE_SIZE = 5000
+STREAM_BATCH_SIZE = 1000
+RESPONSE_FORMATS = ('json', 'ndjson', 'csv')
+
+# Bulk product / inventory import
+BULK_IMPORT_BATCH_SIZE = 1000
+
+# Catalog (SKU -> product, category name -> category) cache
+CATALOG_CACHE_SIZE = 10000
+CATALOG_CACHE_TTL = 300  # seconds
+
+# Server side sales comparison
+MAX_COMPARE_PERIODS = 12
+
+# Gap-filled sales series
+MAX_SERIES_POINTS = 10000  # buckets per series, e.g. ~14 months of hourly points
+
+# Raw (per invoice/inventory operation) date ranges
+MAX_RANGE_DAYS = 366  # longer raw reports are rejected, aggregate modes and exports cover them
+DEFAULT_RANGE_DAYS = 7  # range of /inventory/track when not given, today included
@@ -1,22 +1,202 @@
 import os
+import time
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, Float, ForeignKey, DateTime, func, Boolean
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event, make_url, Column, Integer, String, Text, Float, ForeignKey, DateTime, \
+    func, Boolean, Index, UniqueConstraint, BigInteger, LargeBinary
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, Session
+from sqlalchemy.pool import StaticPool
 from typing import Optional
 from pydantic import BaseModel
 
-# DATABASE_USER = os.environ.get('DATABASE_USER')
-# DATABASE_PASSWORD = os.environ.get('DATABASE_PASSWORD')
-# DATABASE_HOST = os.environ.get('DATABASE_HOST')
-# DATABASE = os.environ.get('DATABASE')
-DATABASE_HOST = 'localhost'
-DATABASE_USER = 'forsit'
-DATABASE_PASSWORD = 'forsit1'
-DATABASE = 'forsit'
+from utils.metrics_utils import query_metrics
+from utils.pool_utils import PoolMetrics
+
+# Settings are read from the environment, .env is loaded for local setups
+load_dotenv()
+
+DATABASE_USER = os.environ.get('DATABASE_USER', 'forsit')
+DATABASE_PASSWORD = os.environ.get('DATABASE_PASSWORD', 'forsit1')
+DATABASE_HOST = os.environ.get('DATABASE_HOST', 'localhost')
+DATABASE = os.environ.get('DATABASE', 'forsit')
+
+# Connection pool, recycle below MySQL wait_timeout so idle connections are never stale
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+
+
+# Async driver of each backend, the async URL is derived from DATABASE_URL when not set
+ASYNC_DRIVERS = {
+    'mysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def get_async_url(url: str) -> str:
+    """
+    Returns the async driver URL of a database URL
+    :param url: database URL e.g. sqlite:///sales.db
+    :return: str e.g. sqlite+aiosqlite:///sales.db
+    """
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No async driver known for {backend}, set ASYNC_DATABASE_URL')
+
+    return parsed.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+
+def is_memory_database(url: str) -> bool:
+    parsed = make_url(url)
+    return parsed.get_backend_name() == 'sqlite' and (
+        parsed.database in (None, '', ':memory:') or parsed.query.get('mode') == 'memory'
+    )
+
+
+def get_pool_options(url: str) -> dict:
+    """
+    Returns engine pool arguments for a database URL
+    :param url: database URL
+    :return: dict
+    """
+    # In-memory SQLite lives in its connection, every session has to share that one connection.
+    # Fine for tests and single client benchmarks, use a file database for concurrent load
+    if is_memory_database(url):
+        return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+
+    # SQLite doesn't use a sized queue pool
+    if url.startswith('sqlite'):
+        return {'pool_pre_ping': DB_POOL_PRE_PING}
+
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+
+DATABASE_URL = os.environ.get(
+    'DATABASE_URL', f"mysql+mysqlconnector://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}/{DATABASE}"
+)
+# Async engine used by the request handlers so DB round trips don't block the event loop
+ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL') or get_async_url(DATABASE_URL)
+
+# Pool metrics of the engine serving requests
+pool_metrics = PoolMetrics()
+
+# Engines are built on first use, importing this module never connects or loads a driver
+_engines = {}
+
+
+def configure_database(url: str, async_url: str = None) -> None:
+    """
+    Points the app at another database, e.g. sqlite:///bench.db or sqlite:// (in-memory). Engines
+    are rebuilt on next use, await dispose_engines() first to close connections of the old ones
+    :param url: database URL
+    :param async_url: async driver URL, derived from url if not given
+    :return:
+    """
+    global DATABASE_URL, ASYNC_DATABASE_URL
+    DATABASE_URL = url
+    ASYNC_DATABASE_URL = async_url or get_async_url(url)
+    _engines.clear()
+
+
+def _on_sqlite_connect(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    # Enforce foreign keys like MySQL, wait on locks instead of failing right away
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    # WAL lets readers run next to the writer, NORMAL sync is safe in WAL mode
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def _prepare_engine(engine: Engine) -> None:
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _on_sqlite_connect)
+    # Statement counts, DB time and the slow query log
+    query_metrics.attach(engine)
+
+
+def get_engine() -> Engine:
+    """
+    Sync engine used by the CLIs and migrations, built on first use
+    :return: Engine
+    """
+    if 'sync' not in _engines:
+        engine = create_engine(DATABASE_URL, **get_pool_options(DATABASE_URL))
+        _prepare_engine(engine)
+        _engines['sync'] = engine
+
+    return _engines['sync']
+
+
+def get_async_engine() -> AsyncEngine:
+    """
+    Async engine serving requests, built on first use
+    :return: AsyncEngine
+    """
+    if 'async' not in _engines:
+        async_engine = create_async_engine(ASYNC_DATABASE_URL, **get_pool_options(ASYNC_DATABASE_URL))
+        _prepare_engine(async_engine.sync_engine)
+        pool_metrics.attach(async_engine.sync_engine)
+        _engines['async'] = async_engine
+
+    return _engines['async']
+
+
+def get_range_engine(pool_size: int) -> AsyncEngine:
+    """
+    Async engine of the month chunk queries of long reports, built on first use. It has a pool of its own:
+    a report holds a connection of the request pool while its chunks wait for theirs, drawing both from the
+    same pool would let enough concurrent reports take every connection and wait on each other
+    :param pool_size: connections of the pool, no overflow
+    :return: AsyncEngine
+    """
+    if 'range' not in _engines:
+        options = get_pool_options(ASYNC_DATABASE_URL)
+        if 'pool_size' in options:
+            options.update(pool_size=pool_size, max_overflow=0)
+        range_engine = create_async_engine(ASYNC_DATABASE_URL, **options)
+        _prepare_engine(range_engine.sync_engine)
+        _engines['range'] = range_engine
+
+    return _engines['range']
+
+
+async def dispose_engines() -> None:
+    """
+    Closes the connections of the built engines, they are rebuilt on next use
+    :return:
+    """
+    engines = list(_engines.values())
+    _engines.clear()
+    for engine in engines:
+        if isinstance(engine, AsyncEngine):
+            await engine.dispose()
+        else:
+            engine.dispose()
+
+
+def __getattr__(name: str):
+    # db_utils.engine and db_utils.async_engine build the engines lazily
+    if name == 'engine':
+        return get_engine()
+    if name == 'async_engine':
+        return get_async_engine()
+    raise AttributeError(f'module {__name__} has no attribute {name}')
 
-DATABASE_URL = f"mysql+mysqlconnector://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}/{DATABASE}"
-engine = create_engine(DATABASE_URL)
 
 Base = declarative_base()
 
@@ -30,6 +210,10 @@ class Category(Base):
 
     products = relationship("Product", back_populates="category")
 
+    __table_args__ = (
+        Index('ix_category_cat_name', 'cat_name'),
+    )
+
 
 class Product(Base):
     __tablename__ = "product"
@@ -52,9 +236,16 @@ class Inventory(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     product_id = Column(Integer, ForeignKey("product.id"), nullable=False)
     stock = Column(Integer, nullable=False, default=0)
+    # Overrides LOW_STOCK_LIMIT for this product when set
+    low_stock_threshold = Column(Integer, nullable=True)
 
     product = relationship("Product", back_populates="inventory")
 
+    # One inventory row per product
+    __table_args__ = (
+        UniqueConstraint('product_id', name='uq_inventory_product'),
+    )
+
 
 class InventoryStatus(Base):
     __tablename__ = "inventory_status"
@@ -67,6 +258,11 @@ class InventoryStatus(Base):
 
     product = relationship("Product", back_populates="inventory_status")
 
+    __table_args__ = (
+        Index('ix_inventory_status_operation_date', 'operation_date'),
+        Index('ix_inventory_status_product_date', 'product_id', 'operation_date'),
+    )
+
 
 class Sale(Base):
     __tablename__ = "sales"
@@ -79,12 +275,143 @@ class Sale(Base):
 
     product = relationship("Product", back_populates="sales")
 
+    __table_args__ = (
+        Index('ix_sales_sale_time', 'sale_time'),
+        Index('ix_sales_product_sale_time', 'product_id', 'sale_time'),
+    )
+
 
-# Create tables in the database
-Base.metadata.create_all(bind=engine)
+class SalesRollup(Base):
+    """
+    Pre-aggregated sales per product and time bucket (daily, weekly, monthly, yearly).
+    category_id is denormalized so category summaries don't need to join product.
+    """
+    __tablename__ = "sales_rollup"
 
-# Create a Session class
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    bucket = Column(String(20), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    product_id = Column(Integer, ForeignKey("product.id"), nullable=False)
+    category_id = Column(Integer, ForeignKey("category.id"), nullable=False)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0)
+    sale_count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('bucket', 'bucket_start', 'product_id', name='uq_sales_rollup_bucket_product'),
+        Index('ix_sales_rollup_bucket_category', 'bucket', 'bucket_start', 'category_id'),
+    )
+
+    product = relationship("Product")
+
+
+class StockSnapshot(Base):
+    """
+    Current stock per product, kept in step with inventory by every stock write so the status
+    poll reads one indexed table. headroom is stock minus the effective low stock threshold,
+    a product is low on stock when it is negative.
+    """
+    __tablename__ = "stock_snapshot"
+
+    product_id = Column(Integer, ForeignKey("product.id"), primary_key=True, autoincrement=False)
+    sku = Column(String(200), nullable=False)
+    product_name = Column(String(200), nullable=False)
+    category_id = Column(Integer, ForeignKey("category.id"), nullable=False)
+    stock = Column(Integer, nullable=False)
+    low_stock_threshold = Column(Integer, nullable=False)
+    headroom = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint('sku', name='uq_stock_snapshot_sku'),
+        Index('ix_stock_snapshot_headroom', 'headroom'),
+        Index('ix_stock_snapshot_category_headroom', 'category_id', 'headroom'),
+    )
+
+
+class LedgerCheckpoint(Base):
+    """
+    Named progress markers, the inventory reconciliation keeps the last inventory_status id it folded
+    in and the last id a run saw here.
+    """
+    __tablename__ = "ledger_checkpoint"
+
+    name = Column(String(200), primary_key=True)
+    last_seq = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class LedgerEntry(Base):
+    """
+    Sold lines of a write-behind sale, inserted in the transaction of its stock decrement so a committed
+    decrement always has its sale. The ledger flusher turns entries into sales, inventory_status and rollup
+    rows and deletes them in one transaction. sale_lines is a JSON list of
+    [product_id, category_id, pieces, price_per_piece].
+    """
+    __tablename__ = "ledger_entry"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    sale_time = Column(DateTime, nullable=False)
+    sale_lines = Column(Text, nullable=False)
+
+
+class InventoryBalance(Base):
+    """
+    Net stock per product from the inventory_status ledger (adds minus removes), folded in
+    incrementally by the reconciliation up to its checkpoint.
+    """
+    __tablename__ = "inventory_balance"
+
+    product_id = Column(Integer, ForeignKey("product.id"), primary_key=True, autoincrement=False)
+    balance = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class IdempotencyRecord(Base):
+    """
+    Response of a POST request sent with an Idempotency-Key header, replayed when the request is retried.
+    Shared by every server process when IDEMPOTENCY_STORE=database, rows older than IDEMPOTENCY_TTL are purged.
+    A key is claimed with status_code 0 while its first attempt runs.
+    """
+    __tablename__ = "idempotency_key"
+
+    key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    status_code = Column(Integer, nullable=False)
+    headers = Column(Text, nullable=False)
+    body = Column(LargeBinary(length=2 ** 24), nullable=False)
+    created_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
+
+
+# Tables are created and upgraded by the alembic migrations in migrations/, run: alembic upgrade head
+
+
+async def create_tables() -> None:
+    """
+    Creates missing tables from the models, for in-memory and throwaway benchmark databases.
+    Databases that are kept are managed with the alembic migrations
+    :return:
+    """
+    async with get_async_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+_session_factory = sessionmaker(autocommit=False, autoflush=False)
+
+# Objects stay readable after commit, async sessions can't lazy load expired attributes
+_async_session_factory = async_sessionmaker(autoflush=False, expire_on_commit=False)
+
+
+def SessionLocal() -> Session:
+    return _session_factory(bind=get_engine())
+
+
+def AsyncSessionLocal() -> AsyncSession:
+    return _async_session_factory(bind=get_async_engine())
+
+
+def RangeSessionLocal(pool_size: int) -> AsyncSession:
+    return _async_session_factory(bind=get_range_engine(pool_size))
 
 
 def get_db():
@@ -93,3 +420,18 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        # Check the connection out up front to measure pool wait time
+        waited = pool_metrics.is_exhausted()
+        started = time.perf_counter()
+        try:
+            await db.connection()
+        except PoolTimeoutError:
+            pool_metrics.record_timeout()
+            raise
+        pool_metrics.record_checkout(time.perf_counter() - started, waited)
+
+        yield db
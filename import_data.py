@@ -0,0 +1,47 @@
+import argparse
+import asyncio
+import sys
+
+from constants import BULK_IMPORT_BATCH_SIZE
+from db_utils import AsyncSessionLocal
+from utils.import_utils import IMPORT_FORMATS, guess_format, import_product_batch, import_stock_batch, read_records, \
+    run_import
+
+IMPORTERS = {
+    'products': import_product_batch,
+    'inventory': import_stock_batch,
+}
+
+
+def print_progress(summary: dict) -> None:
+    print(f"{summary['rows']} rows, {summary['inserted']} inserted, {summary['updated']} updated, "
+          f"{summary['skipped']} skipped, {summary['rows_per_sec']} rows/sec", file=sys.stderr)
+
+
+async def main(kind: str, path: str, file_format: str, batch_size: int) -> dict:
+    """
+    Imports a products or inventory file
+    :param kind: products or inventory
+    :param path: CSV/NDJSON file path
+    :param file_format: csv or ndjson
+    :param batch_size: rows per transaction
+    :return: import summary
+    """
+    with open(path, 'rb') as file:
+        async with AsyncSessionLocal() as db:
+            return await run_import(db, read_records(file, file_format), IMPORTERS[kind], batch_size, print_progress)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import products or inventory stock from CSV/NDJSON')
+    parser.add_argument('kind', choices=IMPORTERS.keys())
+    parser.add_argument('path', help='file with name,sku,price,category (products) or sku,stock (inventory) lines')
+    parser.add_argument('--format', choices=IMPORT_FORMATS, help='guessed from the file name if not given')
+    parser.add_argument('--batch-size', type=int, default=BULK_IMPORT_BATCH_SIZE, help='rows per transaction')
+    args = parser.parse_args()
+
+    summary = asyncio.run(main(args.kind, args.path, args.format or guess_format(args.path), args.batch_size))
+    for error in summary['errors']:
+        print(error, file=sys.stderr)
+    print(f"Done: {summary['rows']} rows in {summary['seconds']}s ({summary['rows_per_sec']} rows/sec), "
+          f"{summary['inserted']} inserted, {summary['updated']} updated, {summary['skipped']} skipped")
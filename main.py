@@ -1,46 +1,144 @@
-import uvicorn
-from datetime import datetime, date
+import argparse
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, date, timedelta
+from typing import List
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import APIRouter, FastAPI, HTTPException, Query, UploadFile, Request, Response
 from fastapi.params import Depends
-from sqlalchemy.orm import Session, joinedload
-
-from constants import LOW_STOCK_LIMIT, TIME_INTERVAL_MAPPING
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import case, insert, select, update
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from constants import TIME_INTERVAL_MAPPING, MAX_PAGE_SIZE, RESPONSE_FORMATS, MAX_COMPARE_PERIODS, MAX_SERIES_POINTS, \
+    MAX_RANGE_DAYS, DEFAULT_RANGE_DAYS
+from schemas import OrderRequest, StatusResponse, InventoryStatusResponse, InventoryTrackResponse, ImportResponse, \
+    CategoryListResponse, ProductListResponse, ProductSearchResponse, SaleResponse, OrderResponse, SalesDataResponse, \
+    CompareResponse, SeriesResponse, ExportResponse, ReconcileResponse, SystemResponse
+from utils.catalog_utils import get_category, get_category_list, get_product, get_product_list, \
+    get_products_by_sku, invalidate_categories, invalidate_products, get_catalog_cache_stats
 from utils.common_utils import generate_rand
-from db_utils import get_db, Inventory, InventoryStatus, Category, Product, Sale
-
-app = FastAPI()
+from utils.export_utils import EXPORT_DIR, EXPORT_FORMATS, EXPORT_MEDIA_TYPES, ExportRunning, export_sales, \
+    list_export_days, read_export_day, read_watermark
+from utils.idempotency_utils import IdempotencyMiddleware, idempotency_store
+from utils.invalidation_utils import invalidation_channel
+from utils.import_utils import IMPORT_FORMATS, guess_format, import_product_batch, import_stock_batch, read_records, \
+    run_import
+from utils.ledger_utils import SALES_LEDGER_MODE, sales_ledger
+from utils.pagination_utils import paginate, stream_query
+from utils.report_cache_utils import ReportCacheMiddleware, invalidate_reports, report_cache
+from utils.range_utils import RangeError, day_range, fetch_range
+from utils.reconcile_utils import RECONCILE_REPAIRS, CheckpointConflict, inventory_reconciler
+from utils.query_utils import DATE_BUCKETS, inventory_status_query, inventory_track_query, sales_query, \
+    category_list_query, product_list_query
+from utils.metrics_utils import MetricsMiddleware, request_metrics
+from utils.response_utils import INVENTORY_TRACK_FIELDS, SALE_FIELDS, JSONResponse, rows_response
+from utils.rollup_utils import get_bucket_start, get_rollup_summary, update_sale_rollups
+from utils.stock_utils import refresh_stock_snapshot
+from utils.server_utils import serve
+from utils.search_utils import MAX_SEARCH_RESULTS, product_search
+from utils.series_utils import SERIES_BUCKETS, SERIES_SPLITS, sales_series, series_buckets
+from utils.summary_utils import COMPARE_GROUPS, compare_sales, parse_period
+from db_utils import configure_database, create_tables, dispose_engines, get_async_db, pool_metrics, Inventory, \
+    InventoryStatus, Category, Product, Sale, StockSnapshot
+
+router = APIRouter()
+
+
+def create_app(database_url: str = None, create_schema: bool = False) -> FastAPI:
+    """
+    Builds the application, the database engines are only created on the first request
+    :param database_url: database to serve, DATABASE_URL if not given e.g. sqlite:///bench.db or sqlite:// (in-memory)
+    :param create_schema: create missing tables on startup, for in-memory and throwaway databases
+    :return: FastAPI app
+    """
+    if database_url:
+        configure_database(database_url)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        if create_schema:
+            await create_tables()
+        # Flush ledger entries left by the last run before serving, flush what is queued on shutdown
+        if SALES_LEDGER_MODE == 'write_behind':
+            await sales_ledger.start()
+            # Replayed entries add past sales
+            if sales_ledger.replayed:
+                invalidate_reports()
+        await invalidation_channel.start()
+        await inventory_reconciler.start()
+        await product_search.warm_up()
+        yield
+        await inventory_reconciler.stop()
+        await invalidation_channel.stop()
+        await sales_ledger.stop()
+        await dispose_engines()
+
+    app = FastAPI(default_response_class=JSONResponse, lifespan=lifespan)
+    app.add_middleware(ReportCacheMiddleware, cache=report_cache)
+    app.add_middleware(IdempotencyMiddleware, store=idempotency_store)
+    app.add_middleware(MetricsMiddleware, metrics=request_metrics)
+    app.include_router(router)
+
+    return app
 
 
 ##############################
 ### Inventory related views ###
 ##############################
 
-@app.get('/inventory/status')
-async def get_inventory_status(db: Session = Depends(get_db)) -> dict:
+@router.get('/inventory/status', response_model=InventoryStatusResponse, response_model_exclude_unset=True)
+async def get_inventory_status(low_stock: bool = Query(False, description="Only products under their threshold"),
+                               category: str = '', sku_prefix: str = '',
+                               limit: int = Query(None, ge=1, le=MAX_PAGE_SIZE,
+                                                  description="Page size, all rows if not given"),
+                               cursor: int = Query(0, ge=0, description="next_cursor of the previous page"),
+                               db: AsyncSession = Depends(get_async_db)) -> dict:
     """
-    Fetches inventory current status
+    Fetches inventory current status from the stock snapshot
+    :param low_stock: only products under their low stock threshold
+    :param category: Category name filter
+    :param sku_prefix: SKU prefix filter
+    :param limit: page size
+    :param cursor: last product id of the previous page
     :return: dict
     """
     try:
+        # Resolve category filter from catalog cache
+        category_id = None
+        if category:
+            category_info = await get_category(db, category)
+            if not category_info:
+                return {
+                    'status': 'failed',
+                    'message': 'No category Found'
+                }
+            category_id = category_info.id
+
         # Fetch inventory data
-        inventory_data = db.query(Inventory).all()
+        inventory_data, next_cursor = await paginate(db, inventory_status_query(low_stock, category_id, sku_prefix),
+                                                     StockSnapshot.product_id, limit, cursor)
 
         # Format inventory data
-        inventory_data = [{'product_name': i.product.product_name,
-                           'stock': i.stock, 'low_stock': True if i.stock < LOW_STOCK_LIMIT else False}
+        inventory_data = [{'product_name': i.product_name,
+                           'sku': i.sku,
+                           'stock': i.stock,
+                           'low_stock_threshold': i.low_stock_threshold,
+                           'low_stock': i.headroom < 0}
                           for i in inventory_data]
         return {
             'status': 'success',
-            'inventory_data': inventory_data
+            'inventory_data': inventory_data,
+            'next_cursor': next_cursor
         }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post('/inventory/add')
-async def add_inventory(product_sku: str, stock: int = 0, db: Session = Depends(get_db)):
+@router.post('/inventory/add', response_model=StatusResponse, response_model_exclude_unset=True)
+async def add_inventory(product_sku: str, stock: int = 0, db: AsyncSession = Depends(get_async_db)):
     """
     Adds Item to inventory
     :param product_id: product_id
@@ -58,76 +156,221 @@ async def add_inventory(product_sku: str, stock: int = 0, db: Session = Depends(
         # product = db.query(Inventory).join(Inventory.product).filter(Product.sku == product_sku).first()
 
         # Check if product is deleted
-        product = db.query(Product).filter(Product.sku == product_sku).first()
+        product = await get_product(db, product_sku)
         if not product:
             return {
                 'status': 'failed',
                 'message': 'Product not found'
             }
 
-        # db.query(Inventory).filter(Inventory.product_id == product.id).update({'stock': Inventory.stock + stock})
+        # Add items in stock with one atomic update so decrements of concurrent sales are never overwritten
+        result = await db.execute(
+            update(Inventory)
+            .where(Inventory.product_id == product.id)
+            .values(stock=Inventory.stock + stock)
+            .execution_options(synchronize_session=False)
+        )
 
-        # Fetch product entry in inventory
-        inventory_product = db.query(Inventory).filter(Inventory.product_id == product.id).first()
+        # Add product in inventory if it is not listed yet
+        if not result.rowcount:
+            await db.execute(insert(Inventory).values(product_id=product.id, stock=stock))
 
-        # Add if product is not listed in inventory else add items in stock
-        if not inventory_product:
-            db.add(Inventory(**{'product_id': product.id, 'stock': stock}))
-        else:
-            inventory_product.stock += stock
-            inventory_update = InventoryStatus(**{'product_id': product.id, 'operation': 'add', 'pieces': stock})
-            db.add(inventory_update)
+        # Every stock change goes to the ledger, the first one included
+        inventory_update = InventoryStatus(**{'product_id': product.id, 'operation': 'add', 'pieces': stock})
+        db.add(inventory_update)
+
+        # Keep stock snapshot current in the same transaction
+        await refresh_stock_snapshot(db, [product.id])
 
         # Save in db
-        db.commit()
+        await db.commit()
 
         return {
             "status": "success",
             "message": "Inventory item stock added successfully"
         }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post('/inventory/threshold', response_model=StatusResponse, response_model_exclude_unset=True)
+async def set_low_stock_threshold(product_sku: str,
+                                  threshold: int = Query(None, ge=0, description="LOW_STOCK_LIMIT if not given"),
+                                  db: AsyncSession = Depends(get_async_db)):
+    """
+    Sets the low stock threshold of a product, overriding LOW_STOCK_LIMIT
+    :param product_sku: product sku
+    :param threshold: threshold, clears the override when not given
+    :param db: DB session object
+    :return:
+    """
+    try:
+        product = await get_product(db, product_sku)
+        if not product:
+            return {
+                'status': 'failed',
+                'message': 'Product not found'
+            }
+
+        result = await db.execute(
+            update(Inventory)
+            .where(Inventory.product_id == product.id)
+            .values(low_stock_threshold=threshold)
+            .execution_options(synchronize_session=False)
+        )
+        if not result.rowcount:
+            await db.rollback()
+            return {
+                'status': 'failed',
+                'message': 'Product not found in inventory'
+            }
+
+        await refresh_stock_snapshot(db, [product.id])
+        await db.commit()
+
+        return {
+            'status': 'success',
+            'message': 'Low stock threshold updated'
+        }
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post('/inventory/bulk_add', response_model=ImportResponse, response_model_exclude_unset=True)
+async def bulk_add_inventory(file: UploadFile,
+                             file_format: str = Query('', alias='format',
+                                                      description="csv or ndjson, guessed from file name if not given"),
+                             db: AsyncSession = Depends(get_async_db)):
+    """
+    Adds stock from an uploaded CSV/NDJSON file of sku, stock lines in batched transactions
+    :param file: uploaded file
+    :param file_format: csv or ndjson
+    :param db: DB session object
+    :return: import summary
+    """
+    try:
+        file_format = file_format or guess_format(file.filename)
+        if file_format not in IMPORT_FORMATS:
+            return {
+                'status': 'failed',
+                'message': f'Format not supported. possible choices are: {",".join(IMPORT_FORMATS)}'
+            }
+
+        return {
+            'status': 'success',
+            'summary': await run_import(db, read_records(file.file, file_format), import_stock_batch)
+        }
+    except Exception as e:
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/inventory/track")
-def get_inventory_track_within_date_range(
-        start_date: date = Query(..., title="Start Date", description="Start date of the range"),
-        end_date: date = Query(..., title="End Date", description="End date of the range"),
-        db: Session = Depends(get_db)):
+@router.post('/inventory/reconcile/run', response_model=ReconcileResponse, response_model_exclude_unset=True)
+async def run_inventory_reconciliation(
+        repair: str = Query('', description="stock takes the ledger stock, ledger records the drift as entries. "
+                                            "Only drift the previous run found too is repaired"),
+        rebuild: bool = Query(False, description="Recompute the ledger balances from the whole ledger")):
+    """
+    Checks inventory stock against the InventoryStatus ledger, reading the ledger rows added since the last run
+    :param repair: stock, ledger or empty to only report drift
+    :param rebuild: recompute the balances instead of continuing from the checkpoint
+    :return: run summary
+    """
+    try:
+        if repair and repair not in RECONCILE_REPAIRS:
+            return {
+                'status': 'failed',
+                'message': f'Repair not supported. possible choices are: {",".join(RECONCILE_REPAIRS)}'
+            }
+
+        return {
+            'status': 'success',
+            'data': await inventory_reconciler.run(repair, rebuild)
+        }
+    except CheckpointConflict as e:
+        return {
+            'status': 'failed',
+            'message': str(e)
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get('/inventory/reconcile', response_model=ReconcileResponse, response_model_exclude_unset=True)
+async def get_inventory_reconciliation():
+    """
+    Returns duration, ledger rows processed and drift of the last reconciliation run
+    :return:
+    """
+    return {
+        'status': 'success',
+        'data': inventory_reconciler.stats()
+    }
+
+
+@router.get("/inventory/track", response_model=InventoryTrackResponse, response_model_exclude_unset=True)
+async def get_inventory_track_within_date_range(
+        start_date: date = Query(None, title="Start Date",
+                                 description=f"Start date of the range, last {DEFAULT_RANGE_DAYS} days if not given"),
+        end_date: date = Query(None, title="End Date", description="Last day of the range, today if not given"),
+        limit: int = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Page size, all rows if not given"),
+        cursor: int = Query(0, ge=0, description="next_cursor of the previous page"),
+        response_format: str = Query('json', alias='format', description="json, ndjson or csv"),
+        db: AsyncSession = Depends(get_async_db)):
     """
     Returns Inventory changes by date
     :param start_date: Start Date filter
-    :param end_date: End Date filter
+    :param end_date: End Date filter, included
+    :param limit: page size
+    :param cursor: last id of the previous page
+    :param response_format: json page, or ndjson/csv stream of every row after cursor
     :param db: DB session
     :return:
     """
     try:
-        # Get data of past 7 days if range is not defined
-        if not start_date and end_date:
-            start_date = datetime.today() - datetime.timedelta(days=7)
-            end_date = datetime.today()
+        if response_format not in RESPONSE_FORMATS:
+            return {
+                'status': 'failed',
+                'message': f'Format not supported. possible choices are: {",".join(RESPONSE_FORMATS)}'
+            }
+
+        # Get data of past 7 days, today included, if range is not defined
+        end_date = end_date or date.today()
+        start_date = start_date or end_date - timedelta(days=DEFAULT_RANGE_DAYS - 1)
+        try:
+            start_time, end_time = day_range(start_date, end_date)
+        except RangeError as e:
+            return {
+                'status': 'failed',
+                'message': str(e)
+            }
 
         # Fetch inventory data within the given time range
-        inventory_track_data = (
-            db.query(InventoryStatus)
-            .filter(InventoryStatus.operation_date >= start_date, InventoryStatus.operation_date <= end_date)
-            .all()
-        )
+        inventory_track_data = inventory_track_query(start_time, end_time)
 
-        # Format and return data
-        inventory_track_data = [{
-            'product_name': i.product.product_name,
-            'product_sku': i.product.sku,
-            'units': i.pieces,
-            'operation': i.operation,
-            'operation_date': i.operation_date
-        } for i in inventory_track_data]
+        # Stream every row instead of building the whole list
+        if response_format != 'json':
+            return await stream_query(db, inventory_track_data, InventoryStatus.id, INVENTORY_TRACK_FIELDS,
+                                      response_format, cursor)
 
-        return {
+        if limit:
+            inventory_track_data, next_cursor = await paginate(db, inventory_track_data, InventoryStatus.id, limit,
+                                                               cursor)
+        # Whole range, read one month at a time in parallel
+        else:
+            next_cursor = None
+            inventory_track_data = await fetch_range(
+                db, lambda start, end: inventory_track_query(start, end).where(InventoryStatus.id > cursor),
+                start_time, end_time)
+
+        # Serialize straight from the rows
+        return rows_response({
             "status": "success",
-            "data": inventory_track_data
-        }
+            "data": inventory_track_data,
+            "next_cursor": next_cursor
+        }, INVENTORY_TRACK_FIELDS)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -136,15 +379,29 @@ def get_inventory_track_within_date_range(
 # Product/Category related views #
 #################################
 
-@app.get('/category/list')
-async def get_categories(db: Session = Depends(get_db)):
+@router.get('/category/list', response_model=CategoryListResponse, response_model_exclude_unset=True)
+async def get_categories(request: Request, response: Response, cached: bool = False,
+                         db: AsyncSession = Depends(get_async_db)):
     """
     return available categories
+    :param cached: serve the cached list with an ETag, If-None-Match gets a 304 when unchanged
     :return:
     """
     try:
+        # Cached list, clients holding the current ETag skip the payload
+        if cached:
+            etag, categories = await get_category_list(db)
+            if request.headers.get('if-none-match') == etag:
+                return Response(status_code=304, headers={'ETag': etag})
+            response.headers['ETag'] = etag
+
+            return {
+                'status': 'success',
+                'data': categories
+            }
+
         # list categories, Format and return
-        categories = db.query(Category).all()
+        categories = (await db.execute(category_list_query())).all()
         categories = [{
             'name': i.cat_name,
             'description': i.cat_description
@@ -158,8 +415,8 @@ async def get_categories(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post('/category/add')
-async def add_categories(name: str, description: str = '', db: Session = Depends(get_db)):
+@router.post('/category/add', response_model=StatusResponse, response_model_exclude_unset=True)
+async def add_categories(name: str, description: str = '', db: AsyncSession = Depends(get_async_db)):
     """
     return available categories
     :return:
@@ -172,7 +429,7 @@ async def add_categories(name: str, description: str = '', db: Session = Depends
                 'message': 'no name was provided'
             }
         # Check if category is already in db
-        if db.query(Category).filter(Category.cat_name == name).first():
+        if await get_category(db, name):
             return {
                 'status': 'failed',
                 'message': 'Category already present'
@@ -182,7 +439,8 @@ async def add_categories(name: str, description: str = '', db: Session = Depends
         category = Category(**{'cat_name': name, 'cat_description': description})
         db.add(category)
 
-        db.commit()
+        await db.commit()
+        invalidate_categories([name])
 
         return {
             'status': 'success',
@@ -192,15 +450,29 @@ async def add_categories(name: str, description: str = '', db: Session = Depends
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get('/product/list')
-async def get_products(db: Session = Depends(get_db)):
+@router.get('/product/list', response_model=ProductListResponse, response_model_exclude_unset=True)
+async def get_products(request: Request, response: Response, cached: bool = False,
+                       db: AsyncSession = Depends(get_async_db)):
     """
     return available categories
+    :param cached: serve the cached list with an ETag, If-None-Match gets a 304 when unchanged
     :return:
     """
     try:
+        # Cached list, clients holding the current ETag skip the payload
+        if cached:
+            etag, products = await get_product_list(db)
+            if request.headers.get('if-none-match') == etag:
+                return Response(status_code=304, headers={'ETag': etag})
+            response.headers['ETag'] = etag
+
+            return {
+                'status': 'success',
+                'data': products
+            }
+
         # List products and return formatted data
-        products = db.query(Product).all()
+        products = (await db.execute(product_list_query())).all()
         products = [{
             'name': i.product_name,
             'sku': i.sku,
@@ -215,8 +487,35 @@ async def get_products(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post('/product/add')
-async def add_product(name: str, price: float, category: str, sku: str = '', db: Session = Depends(get_db)):
+@router.get('/product/search', response_model=ProductSearchResponse, response_model_exclude_unset=True)
+async def search_products(q: str = Query(..., description="Words of the product name, SKU or category, the last one "
+                                                          "may be partly typed"),
+                          limit: int = Query(20, ge=1, le=MAX_SEARCH_RESULTS)):
+    """
+    Searches products by name, SKU and category name from the in-memory index, tolerating typos
+    :param q: search text
+    :param limit: number of results
+    :return: best matches first
+    """
+    try:
+        await product_search.ensure_current()
+
+        return {
+            'status': 'success',
+            'data': [{
+                'name': result.product_name,
+                'sku': result.sku,
+                'price': result.price,
+                'category': result.category,
+                'score': result.score
+            } for result in product_search.search(q, limit)]
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post('/product/add', response_model=StatusResponse, response_model_exclude_unset=True)
+async def add_product(name: str, price: float, category: str, sku: str = '', db: AsyncSession = Depends(get_async_db)):
     """
     return available products
     :return:
@@ -234,7 +533,7 @@ async def add_product(name: str, price: float, category: str, sku: str = '', db:
             sku = generate_rand()
 
         # Check if given category is not in system
-        category = db.query(Category).filter(Category.cat_name == category).first()
+        category = await get_category(db, category)
         if not category:
             return {
                 'status': 'failed',
@@ -242,7 +541,7 @@ async def add_product(name: str, price: float, category: str, sku: str = '', db:
             }
 
         # Check if product is alread present in system
-        if db.query(Product).filter(Product.sku == sku).first():
+        if await get_product(db, sku):
             return {
                 'status': 'failed',
                 'message': 'Product already present'
@@ -252,7 +551,8 @@ async def add_product(name: str, price: float, category: str, sku: str = '', db:
         product = Product(**{'product_name': name, 'sku': sku, 'price': price, 'category_id': category.id})
         db.add(product)
 
-        db.commit()
+        await db.commit()
+        invalidate_products([sku])
 
         return {
             'status': 'success',
@@ -262,8 +562,37 @@ async def add_product(name: str, price: float, category: str, sku: str = '', db:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post('/product/bulk_add', response_model=ImportResponse, response_model_exclude_unset=True)
+async def bulk_add_products(file: UploadFile,
+                            file_format: str = Query('', alias='format',
+                                                     description="csv or ndjson, guessed from file name if not given"),
+                            db: AsyncSession = Depends(get_async_db)):
+    """
+    Adds or updates products from an uploaded CSV/NDJSON file of name, sku, price, category lines
+    :param file: uploaded file
+    :param file_format: csv or ndjson
+    :param db: DB session object
+    :return: import summary
+    """
+    try:
+        file_format = file_format or guess_format(file.filename)
+        if file_format not in IMPORT_FORMATS:
+            return {
+                'status': 'failed',
+                'message': f'Format not supported. possible choices are: {",".join(IMPORT_FORMATS)}'
+            }
+
+        return {
+            'status': 'success',
+            'summary': await run_import(db, read_records(file.file, file_format), import_product_batch)
+        }
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # @app.delete('/product/delete/')
-# async def delete_product(sku: str, db: Session = Depends(get_db)):
+# async def delete_product(sku: str, db: AsyncSession = Depends(get_async_db)):
 #     """
 #     Delete a product
 #     :param sku: Product sku
@@ -294,8 +623,8 @@ async def add_product(name: str, price: float, category: str, sku: str = '', db:
 ##############################
 
 
-@app.post('/sale/make_sale')
-async def sale_product(product_sku: str, quantity: int = 1, db: Session = Depends(get_db)):
+@router.post('/sale/make_sale', response_model=SaleResponse, response_model_exclude_unset=True)
+async def sale_product(product_sku: str, quantity: int = 1, db: AsyncSession = Depends(get_async_db)):
     """
     Sale a product
     :param product_sku: sold product sku
@@ -310,45 +639,76 @@ async def sale_product(product_sku: str, quantity: int = 1, db: Session = Depend
                 'status': 'failed',
                 'message': 'No product sku given'
             }
+        if quantity < 1:
+            return {
+                'status': 'failed',
+                'message': 'Quantity must be at least 1'
+            }
 
-        # Fetch product from db
-        product = db.query(Product).filter(Product.sku == product_sku).first()
+        # Fetch product from catalog cache
+        product = await get_product(db, product_sku)
         if not product:
             return {
                 'status': 'failed',
                 'message': 'No product was found'
             }
 
-        # Fetch inventory entry for product
-        inventory = db.query(Inventory).filter(Inventory.product_id == product.id).first()
+        # A full write-behind queue holds the sale back before it locks the stock row
+        await sales_ledger.wait_for_room()
 
-        # Check if stock is lesser than purchased quantity
-        if inventory.stock < quantity:
+        # Check and decrement stock in one conditional update so concurrent sales can't oversell
+        result = await db.execute(
+            update(Inventory)
+            .where(Inventory.product_id == product.id, Inventory.stock >= quantity)
+            .values(stock=Inventory.stock - quantity)
+            .execution_options(synchronize_session=False)
+        )
+        if not result.rowcount:
+            # Tell a product missing from inventory apart from a short stock
+            inventory_id = await db.scalar(select(Inventory.id).where(Inventory.product_id == product.id))
+            await db.rollback()
+            if not inventory_id:
+                return {
+                    'status': 'failed',
+                    'message': 'Product not found in inventory'
+                }
             return {
                 'status': 'failed',
                 'message': 'Not enough items in stock'
             }
 
-        # reset stock after sale
-        inventory.stock -= quantity
+        sale_time = datetime.now()
+        await refresh_stock_snapshot(db, [product.id])
 
-        # Update transaction details to inventory status
-        inventory_status = InventoryStatus(**{
-            'product_id': product.id,
-            'operation': 'remove',
-            'pieces': quantity
-        })
-        db.add(inventory_status)
-
-        # Add record to sales table
-        sales = Sale(**{
-            'product_id': product.id,
-            'price_per_piece': product.price,
-            'pieces': quantity
-        })
-        db.add(sales)
-
-        db.commit()
+        # Write-behind mode commits the stock change with a ledger entry, the ledger batches sale rows and rollups
+        if sales_ledger.running:
+            entry = await sales_ledger.record(db, [(product.id, product.category_id, quantity, product.price)],
+                                              sale_time)
+            await db.commit()
+            sales_ledger.queue_entry(entry)
+        else:
+            # Update transaction details to inventory status
+            inventory_status = InventoryStatus(**{
+                'product_id': product.id,
+                'operation': 'remove',
+                'pieces': quantity
+            })
+            db.add(inventory_status)
+
+            # Add record to sales table
+            sales = Sale(**{
+                'product_id': product.id,
+                'price_per_piece': product.price,
+                'pieces': quantity,
+                'sale_time': sale_time
+            })
+            db.add(sales)
+
+            # Keep sales rollups current in the same transaction
+            await update_sale_rollups(db, [(product.id, product.category_id, quantity, product.price * quantity)],
+                                      sale_time)
+
+            await db.commit()
 
         return {
             'status': 'success',
@@ -362,87 +722,206 @@ async def sale_product(product_sku: str, quantity: int = 1, db: Session = Depend
         }
 
     except Exception as e:
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get('/sales/get_data')
-async def get_sales_data(db: Session = Depends(get_db),
+@router.post('/sale/make_order', response_model=OrderResponse, response_model_exclude_unset=True)
+async def order_products(order: OrderRequest, db: AsyncSession = Depends(get_async_db)):
+    """
+    Sale several products in one all-or-nothing transaction
+    :param order: order lines of sku and quantity
+    :param db: DB Session Instance
+    :return:
+    """
+    try:
+        # Merge repeated SKUs into one line
+        quantities = {}
+        for line in order.items:
+            quantities[line.sku] = quantities.get(line.sku, 0) + line.quantity
+
+        # Resolve every SKU from the catalog cache, misses in one query
+        products = await get_products_by_sku(db, quantities.keys())
+        missing = [sku for sku in quantities if sku not in products]
+        if missing:
+            return {
+                'status': 'failed',
+                'message': f'No product was found: {",".join(missing)}'
+            }
+
+        # A full write-behind queue holds the order back before it locks any stock row
+        await sales_ledger.wait_for_room()
+
+        # Check and decrement the stock of every line in one conditional update
+        product_quantities = {products[sku].id: quantity for sku, quantity in quantities.items()}
+        quantity_case = case(product_quantities, value=Inventory.product_id)
+        result = await db.execute(
+            update(Inventory)
+            .where(Inventory.product_id.in_(product_quantities.keys()), Inventory.stock >= quantity_case)
+            .values(stock=Inventory.stock - quantity_case)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != len(product_quantities):
+            # Find the lines that can't be served and undo the whole order
+            stock = dict((await db.execute(
+                select(Inventory.product_id, Inventory.stock).where(Inventory.product_id.in_(product_quantities.keys()))
+            )).all())
+            short = [sku for sku, product in products.items()
+                     if stock.get(product.id) is None or stock[product.id] < quantities[sku]]
+            await db.rollback()
+            return {
+                'status': 'failed',
+                'message': f'Not enough items in stock: {",".join(short)}'
+            }
+
+        sale_time = datetime.now()
+        await refresh_stock_snapshot(db, product_quantities.keys())
+
+        # Write-behind mode commits the stock change with a ledger entry, the ledger batches sale rows and rollups
+        if sales_ledger.running:
+            entry = await sales_ledger.record(db, [(products[sku].id, products[sku].category_id, quantity,
+                                                    products[sku].price) for sku, quantity in quantities.items()],
+                                              sale_time)
+            await db.commit()
+            sales_ledger.queue_entry(entry)
+        else:
+            # Record inventory operations and sales with bulk inserts
+            await db.execute(insert(InventoryStatus), [{
+                'product_id': products[sku].id,
+                'operation': 'remove',
+                'pieces': quantity
+            } for sku, quantity in quantities.items()])
+            await db.execute(insert(Sale), [{
+                'product_id': products[sku].id,
+                'price_per_piece': products[sku].price,
+                'pieces': quantity,
+                'sale_time': sale_time
+            } for sku, quantity in quantities.items()])
+
+            # Keep sales rollups current in the same transaction
+            await update_sale_rollups(db, [(products[sku].id, products[sku].category_id, quantity,
+                                            products[sku].price * quantity) for sku, quantity in quantities.items()],
+                                      sale_time)
+
+            await db.commit()
+
+        items = [{
+            'item': products[sku].product_name,
+            'unit': quantity,
+            'price': products[sku].price,
+            'total': products[sku].price * quantity
+        } for sku, quantity in quantities.items()]
+
+        return {
+            'status': 'success',
+            'message': 'Order sold',
+            'reciept_data': {
+                'items': items,
+                'total': sum(item['total'] for item in items)
+            }
+        }
+
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get('/sales/get_data', response_model=SalesDataResponse, response_model_exclude_unset=True)
+async def get_sales_data(db: AsyncSession = Depends(get_async_db),
                          start_date: date = Query(..., title="Start Date", description="Start date of the range"),
-                         end_date: date = Query(..., title="End Date", description="End date of the range"),
-                         product_sku: str = '', category: str = ''):
+                         end_date: date = Query(..., title="End Date", description="End date of the range, included"),
+                         product_sku: str = '', category: str = '', mode: str = 'raw',
+                         limit: int = Query(None, ge=1, le=MAX_PAGE_SIZE,
+                                            description="Page size, all rows if not given"),
+                         cursor: int = Query(0, ge=0, description="next_cursor of the previous page"),
+                         response_format: str = Query('json', alias='format', description="json, ndjson or csv")):
     """
     Returns Sales Data from given time frame
     :param db: DB connection Session
     :param start_date: Starting date
-    :param end_date: Ending Date
+    :param end_date: Ending Date, included
     :param product_id: Product name/SKU
     :param category: Product Category
+    :param mode: raw for invoices, aggregate for per product totals read from daily rollups
+    :param limit: page size
+    :param cursor: last invoice no of the previous page
+    :param response_format: json page, or ndjson/csv stream of every invoice after cursor
     :return: Dict
     """
     try:
-        # Sales data if product and category are not defined
-        if not product_sku and not category:
-            sales_data = db.query(Sale).filter(Sale.sale_time >= start_date, Sale.sale_time <= end_date)
-
-        # Sales data if product is not defined but category is given
-        elif not product_sku and category:
-            sales_data = (
-                db.query(Sale)
-                .join(Product)
-                .join(Category)
-                .filter(Category.cat_name.in_([category]), Sale.sale_time >= start_date, Sale.sale_time <= end_date)
-                .options(joinedload(Sale.product).joinedload(Product.category))
-                .all()
-            )
-
-        # Sales data if category is not defined but product is given
-        elif not category and product_sku:
-            sales_data = (
-                db.query(Sale)
-                .join(Product)
-                .filter(Product.sku.in_([product_sku]), Sale.sale_time >= start_date, Sale.sale_time <= end_date)
-                .all()
-            )
-
-        # Sales data if product and category are given
+        if response_format not in RESPONSE_FORMATS:
+            return {
+                'status': 'failed',
+                'message': f'Format not supported. possible choices are: {",".join(RESPONSE_FORMATS)}'
+            }
+
+        # Per product totals from the daily rollups, end day included
+        if mode == 'aggregate':
+            return {
+                'status': 'success',
+                'data': await get_rollup_summary(db, 'daily', start_date, end_date, product_sku, category)
+            }
+
+        # End day included, long raw ranges are rejected
+        try:
+            start_time, end_time = day_range(start_date, end_date)
+        except RangeError as e:
+            return {
+                'status': 'failed',
+                'message': str(e)
+            }
+
+        # Sales data filtered on product and/or category when given
+        sales_data = sales_query(start_time, end_time, product_sku, category)
+
+        # Stream every invoice instead of building the whole list
+        if response_format != 'json':
+            return await stream_query(db, sales_data, Sale.id, SALE_FIELDS, response_format, cursor)
+
+        if limit:
+            sales_data, next_cursor = await paginate(db, sales_data, Sale.id, limit, cursor)
+        # Whole range, read one month at a time in parallel
         else:
-            sales_data = (
-                db.query(Sale)
-                .join(Product)
-                .join(Category)
-                .filter(Category.cat_name.in_([category]), Product.sku.in_([product_sku]),
-                        Sale.sale_time >= start_date, Sale.sale_time <= end_date)
-                .options(joinedload(Sale.product).joinedload(Product.category))
-                .all()
-            )
-
-        # Data Formatting
-        sales_data = [{
-            'invoice_no': i.id,
-            'item': i.product.product_name,
-            'quantity': i.pieces,
-            'price per piece': i.price_per_piece,
-            'total': i.pieces * i.price_per_piece,
-            'invoice time': i.sale_time
-        } for i in sales_data]
+            next_cursor = None
+            sales_data = await fetch_range(
+                db, lambda start, end: sales_query(start, end, product_sku, category).where(Sale.id > cursor),
+                start_time, end_time)
 
-        return {
+        # Serialize straight from the rows
+        return rows_response({
             'status': 'success',
-            'data': sales_data
-        }
+            'data': sales_data,
+            'next_cursor': next_cursor
+        }, SALE_FIELDS)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get('/sales/get_timed_data')
-async def get_timed_sales_data(interval: str, db: Session = Depends(get_db)):
+@router.get('/sales/get_timed_data', response_model=SalesDataResponse, response_model_exclude_unset=True)
+async def get_timed_sales_data(interval: str, mode: str = 'raw',
+                               limit: int = Query(None, ge=1, le=MAX_PAGE_SIZE,
+                                                  description="Page size, all rows if not given"),
+                               cursor: int = Query(0, ge=0, description="next_cursor of the previous page"),
+                               response_format: str = Query('json', alias='format',
+                                                            description="json, ndjson or csv"),
+                               db: AsyncSession = Depends(get_async_db)):
     """
     Returns Fixed interval timed sales data points
     :param interval: time interval i.e. today, week, month, year
+    :param mode: raw for invoices, aggregate for per product totals of the current calendar bucket
+    :param limit: page size
+    :param cursor: last invoice no of the previous page
+    :param response_format: json page, or ndjson/csv stream of every invoice after cursor
     :param db: DB Sessions Instance
     :return:
     """
     try:
+        if response_format not in RESPONSE_FORMATS:
+            return {
+                'status': 'failed',
+                'message': f'Format not supported. possible choices are: {",".join(RESPONSE_FORMATS)}'
+            }
+
         # Check for time interval parameter
         interval_timedelta = TIME_INTERVAL_MAPPING.get(interval.lower())
         if not interval_timedelta:
@@ -451,40 +930,56 @@ async def get_timed_sales_data(interval: str, db: Session = Depends(get_db)):
                 'message': f'Interval value not defined. possible choices are: {",".join(TIME_INTERVAL_MAPPING.keys())}'
             }
 
-        start_time = datetime.today() - interval_timedelta
+        # Per product totals of the current calendar day/week/month/year from rollups
+        if mode == 'aggregate':
+            bucket_start = get_bucket_start(datetime.today(), interval.lower())
+            return {
+                'status': 'success',
+                'interval': interval,
+                'bucket_start': bucket_start,
+                'data': await get_rollup_summary(db, interval.lower(), bucket_start, bucket_start)
+            }
+
         end_time = datetime.today()
+        start_time = end_time - interval_timedelta
 
         # Fetch data between time intervals
-        sales_data = (db.query(Sale).filter(Sale.sale_time >= start_time, Sale.sale_time <= end_time).all())
-
-        # Format data
-        sales_data = [{
-            'invoice_no': i.id,
-            'item': i.product.product_name,
-            'quantity': i.pieces,
-            'price per piece': i.price_per_piece,
-            'total': i.pieces * i.price_per_piece,
-            'invoice time': i.sale_time
-        } for i in sales_data]
+        sales_data = sales_query(start_time, end_time)
 
-        return {
+        # Stream every invoice instead of building the whole list
+        if response_format != 'json':
+            return await stream_query(db, sales_data, Sale.id, SALE_FIELDS, response_format, cursor)
+
+        if limit:
+            sales_data, next_cursor = await paginate(db, sales_data, Sale.id, limit, cursor)
+        # Whole interval, read one month at a time in parallel
+        else:
+            next_cursor = None
+            sales_data = await fetch_range(db, lambda start, end: sales_query(start, end).where(Sale.id > cursor),
+                                           start_time, end_time)
+
+        # Serialize straight from the rows
+        return rows_response({
             'status': 'success',
             'interval': interval,
-            'data': sales_data
-        }
+            'data': sales_data,
+            'next_cursor': next_cursor
+        }, SALE_FIELDS)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get('/sales/compare_data')
-async def compare_sales_data(db: Session = Depends(get_db),
+@router.get('/sales/compare_data', response_model=CompareResponse, response_model_exclude_unset=True)
+async def compare_sales_data(db: AsyncSession = Depends(get_async_db),
                              start_date: date = Query(..., title="Start Date", description="Start date of the range"),
                              start_date2: date = Query(..., title="Start Date 2",
                                                        description="Start date of the range 2"),
-                             end_date: date = Query(..., title="End Date", description="End date of the range"),
-                             end_date2: date = Query(..., title="End Date 2", description="End date of the range 2"),
-                             category1: str = '', category2: str = ''):
+                             end_date: date = Query(..., title="End Date",
+                                                    description="End date of the range, included"),
+                             end_date2: date = Query(..., title="End Date 2",
+                                                     description="End date of the range 2, included"),
+                             category1: str = '', category2: str = '', mode: str = 'raw'):
     """
     Returns Comparison of data points by period
     :param start_date: Start date for period 1
@@ -493,80 +988,315 @@ async def compare_sales_data(db: Session = Depends(get_db),
     :param end_date2: End date for period 2
     :param category1: Category for period 1
     :param category2: Category for period 2
+    :param mode: raw for invoices, aggregate for per category totals and deltas computed in SQL
     :param db: DB Sessions Instance
     :return:
     """
     try:
+        # End days included, every invoice is only read for ranges up to MAX_RANGE_DAYS
+        try:
+            max_days = None if mode == 'aggregate' else MAX_RANGE_DAYS
+            period1, period2 = day_range(start_date, end_date, max_days), day_range(start_date2, end_date2, max_days)
+        except RangeError as e:
+            return {
+                'status': 'failed',
+                'message': str(e)
+            }
+
         # If categories for comparison are given
         if category1 and category2:
             # Check if both categories exists in system
-            category = db.query(Category).filter(Category.cat_name.in_([category1, category2])).all()
-            if len(category) != 2:
+            category = (
+                await db.scalars(select(Category).where(Category.cat_name.in_([category1, category2])))
+            ).all()
+            if len(category) != len({category1, category2}):
                 return {
                     'status': 'failed',
                     'message': 'Category not found in system'
                 }
 
-            # sales data for category1 in time period1
-            sales_data_1 = (
-                db.query(Sale)
-                .join(Product)
-                .join(Category)
-                .filter(Category.cat_name.in_([category1]), Sale.sale_time >= start_date, Sale.sale_time <= end_date)
-                .options(joinedload(Sale.product).joinedload(Product.category))
-                .all()
-            )
-            # sales data for category2 in time period2
-            sales_data_2 = (
-                db.query(Sale)
-                .join(Product)
-                .join(Category)
-                .filter(Category.cat_name.in_([category2]), Sale.sale_time >= start_date2, Sale.sale_time <= end_date2)
-                .options(joinedload(Sale.product).joinedload(Product.category))
-                .all()
-            )
-
-        # Check if both categories are not given
-        elif not category1 and not category2:
-            sales_data_1 = (
-                db.query(Sale).filter(Sale.sale_time >= start_date, Sale.sale_time <= end_date).all()
-            )
-
-            sales_data_2 = (
-                db.query(Sale).filter(Sale.sale_time >= start_date2, Sale.sale_time <= end_date2).all()
-            )
         # Any other case
-        else:
+        elif category1 or category2:
             return {
                 'status': 'failed',
                 'message': 'Cant compare without category set'
             }
 
-        return {
+        # Totals of both periods in one query instead of every invoice, category1 in period1 and category2 in period2
+        if mode == 'aggregate':
+            return {
+                'status': 'success',
+                'category1': category1,
+                'category2': category2,
+                'periods': await compare_sales(db, [(start_date, end_date), (start_date2, end_date2)],
+                                               period_categories=[category1, category2] if category1 else None)
+            }
+
+        # sales data for category1 in time period1 and category2 in time period2, all categories when not given
+        sales_data_1 = await fetch_range(db, lambda start, end: sales_query(start, end, category=category1), *period1)
+        sales_data_2 = await fetch_range(db, lambda start, end: sales_query(start, end, category=category2), *period2)
+
+        return rows_response({
             'status': 'success',
             'category1': category1,
-            'period1': [{
-                    'invoice_no': i.id,
-                    'item': i.product.product_name,
-                    'quantity': i.pieces,
-                    'price per piece': i.price_per_piece,
-                    'total': i.pieces * i.price_per_piece,
-                    'invoice time': i.sale_time
-                } for i in sales_data_1],
+            'period1': sales_data_1,
             'category2': category2,
-            'period2': [{
-                    'invoice_no': i.id,
-                    'item': i.product.product_name,
-                    'quantity': i.pieces,
-                    'price per piece': i.price_per_piece,
-                    'total': i.pieces * i.price_per_piece,
-                    'invoice time': i.sale_time
-                } for i in sales_data_2]
+            'period2': sales_data_2
+        }, SALE_FIELDS)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get('/sales/compare_summary', response_model=CompareResponse, response_model_exclude_unset=True)
+async def compare_sales_summary(period: List[str] = Query(..., description="start:end dates, end day included, "
+                                                                           "e.g. 2024-01-01:2024-03-31. Repeatable"),
+                                category: List[str] = Query([], description="Categories to keep. Repeatable"),
+                                group_by: List[str] = Query([], description="category, product and/or bucket"),
+                                bucket: str = Query('daily', description="hourly, daily, weekly, monthly or yearly"),
+                                db: AsyncSession = Depends(get_async_db)):
+    """
+    Returns sales totals, units, averages and period over period deltas of any number of periods and
+    categories, computed in SQL with one query
+    :param period: periods to compare
+    :param category: category filter
+    :param group_by: grouping dimensions
+    :param bucket: bucket size when grouping by bucket
+    :param db: DB Sessions Instance
+    :return:
+    """
+    try:
+        try:
+            periods = [parse_period(value) for value in period]
+        except ValueError as e:
+            return {
+                'status': 'failed',
+                'message': f'Invalid period, expected start:end dates ({e})'
+            }
+        if len(periods) > MAX_COMPARE_PERIODS:
+            return {
+                'status': 'failed',
+                'message': f'At most {MAX_COMPARE_PERIODS} periods can be compared'
+            }
+        if set(group_by) - set(COMPARE_GROUPS) or bucket not in DATE_BUCKETS:
+            return {
+                'status': 'failed',
+                'message': f'group_by choices are: {",".join(COMPARE_GROUPS)}, bucket choices are: '
+                           f'{",".join(DATE_BUCKETS)}'
+            }
+
+        return {
+            'status': 'success',
+            'periods': await compare_sales(db, periods, category, group_by, bucket)
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get('/sales/series', response_model=SeriesResponse, response_model_exclude_unset=True)
+async def get_sales_series(start_date: date = Query(..., title="Start Date", description="Start date of the range"),
+                           end_date: date = Query(..., title="End Date", description="End date of the range"),
+                           bucket: str = Query('daily', description="hourly, daily, weekly or monthly"),
+                           split_by: str = Query(None, description="category or sku, one total series if not given"),
+                           category: List[str] = Query([], description="Categories to keep. Repeatable"),
+                           sku: List[str] = Query([], description="SKUs to keep. Repeatable"),
+                           top: int = Query(None, ge=1, description="Only the series with the highest revenue"),
+                           db: AsyncSession = Depends(get_async_db)):
+    """
+    Returns revenue and units per time bucket, one point per bucket of the range with empty buckets
+    filled with zeros, bucketed in SQL
+    :param start_date: first day
+    :param end_date: last day, included
+    :param bucket: bucket size
+    :param split_by: one series per category or SKU
+    :param category: category filter
+    :param sku: SKU filter
+    :param top: number of series kept
+    :param db: DB Sessions Instance
+    :return:
+    """
+    try:
+        if bucket not in SERIES_BUCKETS or (split_by and split_by not in SERIES_SPLITS):
+            return {
+                'status': 'failed',
+                'message': f'bucket choices are: {",".join(SERIES_BUCKETS)}, split_by choices are: '
+                           f'{",".join(SERIES_SPLITS)}'
+            }
+        if start_date > end_date:
+            return {
+                'status': 'failed',
+                'message': 'end_date is before start_date'
+            }
+        if len(series_buckets(start_date, end_date, bucket)) > MAX_SERIES_POINTS:
+            return {
+                'status': 'failed',
+                'message': f'At most {MAX_SERIES_POINTS} buckets per series, use a bigger bucket or a shorter range'
+            }
+
+        return {
+            'status': 'success',
+            **await sales_series(db, start_date, end_date, bucket, split_by, category, sku, top)
         }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+#############################
+#### Export related views ####
+#############################
+
+
+@router.post('/export/sales/run', response_model=ExportResponse, response_model_exclude_unset=True)
+async def run_sales_export(export_format: str = Query('parquet', alias='format', description="parquet or arrow")):
+    """
+    Exports sales added since the last run to the day partitioned files, one run at a time
+    :param export_format: file format of the new parts
+    :return: run summary
+    """
+    try:
+        if export_format not in EXPORT_FORMATS:
+            return {
+                'status': 'failed',
+                'message': f'format choices are: {",".join(EXPORT_FORMATS)}'
+            }
+        # Blocking file and streaming DB work, kept off the event loop. One export per dataset across workers
+        try:
+            summary = await run_in_threadpool(export_sales, EXPORT_DIR, export_format)
+        except ExportRunning as e:
+            return {
+                'status': 'failed',
+                'message': str(e)
+            }
+
+        return {
+            'status': 'success',
+            'summary': summary
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get('/export/sales', response_model=ExportResponse, response_model_exclude_unset=True)
+async def get_sales_exports(export_format: str = Query('parquet', alias='format', description="parquet or arrow")):
+    """
+    Returns the export watermark and the exported days of a format
+    :param export_format: parquet or arrow dataset
+    :return:
+    """
+    try:
+        if export_format not in EXPORT_FORMATS:
+            return {
+                'status': 'failed',
+                'message': f'format choices are: {",".join(EXPORT_FORMATS)}'
+            }
+
+        return {
+            'status': 'success',
+            'watermark': read_watermark(EXPORT_DIR, export_format),
+            'days': list_export_days(EXPORT_DIR, export_format)
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get('/export/sales/download', response_model=StatusResponse, response_model_exclude_unset=True)
+async def download_sales_export(day: date = Query(..., description="Sale day"),
+                                export_format: str = Query('parquet', alias='format',
+                                                           description="parquet or arrow")):
+    """
+    Downloads the exported sales of one day as a single file
+    :param day: sale day
+    :param export_format: parquet or arrow
+    :return: file
+    """
+    try:
+        if export_format not in EXPORT_FORMATS:
+            return {
+                'status': 'failed',
+                'message': f'format choices are: {",".join(EXPORT_FORMATS)}'
+            }
+
+        content = await run_in_threadpool(read_export_day, day, export_format, EXPORT_DIR)
+        if not content:
+            return {
+                'status': 'failed',
+                'message': f'No exported sales for {day}'
+            }
+
+        filename = f'sales_{day.isoformat()}{EXPORT_FORMATS[export_format]}'
+        return Response(content, media_type=EXPORT_MEDIA_TYPES[export_format],
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+##############################
+#### System related views ####
+##############################
+
+@router.get('/system/db_pool', response_model=SystemResponse, response_model_exclude_unset=True)
+async def get_db_pool_status():
+    """
+    Returns connection pool checkout latency, wait counts and in use connections
+    :return:
+    """
+    return {
+        'status': 'success',
+        'data': pool_metrics.snapshot()
+    }
+
+
+@router.get('/system/cache', response_model=SystemResponse, response_model_exclude_unset=True)
+async def get_cache_status():
+    """
+    Returns catalog, report and idempotency key cache sizes and hit/miss counters, and cross-worker invalidations
+    :return:
+    """
+    return {
+        'status': 'success',
+        'data': {**get_catalog_cache_stats(), 'reports': report_cache.stats(), 'search': product_search.stats(),
+                 'idempotency': idempotency_store.stats(), 'invalidation': invalidation_channel.stats()}
+    }
+
+
+@router.get('/system/ledger', response_model=SystemResponse, response_model_exclude_unset=True)
+async def get_ledger_status():
+    """
+    Returns write-behind sales ledger queue depth and flush counters
+    :return:
+    """
+    return {
+        'status': 'success',
+        'data': sales_ledger.stats()
+    }
+
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Returns per route latency histograms, SQL statement counts, DB time, rows and serialization
+    time in the Prometheus text format
+    :return:
+    """
+    return PlainTextResponse(request_metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+app = create_app()
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    parser = argparse.ArgumentParser(description='Runs the API server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', 1)),
+                        help='worker processes, e.g. the number of cores. SIGHUP reloads them one at a time')
+    parser.add_argument('--graceful-timeout', type=int, help='seconds a stopping worker waits for open requests')
+    parser.add_argument('--reload', action='store_true', help='restart on code changes, development only')
+    args = parser.parse_args()
+
+    serve('main:app', args.host, args.port, args.workers, args.reload, args.graceful_timeout)
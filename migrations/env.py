@@ -0,0 +1,42 @@
+from logging.config import fileConfig
+
+from alembic import context
+
+from db_utils import Base, DATABASE_URL, get_engine
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+target_metadata = Base.metadata
+
+# SQLite can't alter constraints in place, batch mode recreates the table instead
+render_as_batch = DATABASE_URL.startswith('sqlite')
+
+
+def run_migrations_offline() -> None:
+    """
+    Emits the migration SQL without a database connection (alembic upgrade head --sql)
+    """
+    context.configure(url=DATABASE_URL, target_metadata=target_metadata, literal_binds=True,
+                      render_as_batch=render_as_batch, dialect_opts={'paramstyle': 'named'})
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online() -> None:
+    """
+    Runs the migrations on the configured database
+    """
+    with get_engine().connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata, render_as_batch=render_as_batch)
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
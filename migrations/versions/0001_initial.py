@@ -0,0 +1,77 @@
+"""initial schema
+
+Tables as created by Datascript and the sales rollups. Databases set up before migrations
+were introduced should be marked with: alembic stamp 0001
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'category',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('cat_name', sa.String(200), nullable=False),
+        sa.Column('cat_description', sa.Text(), nullable=True),
+    )
+    op.create_table(
+        'product',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('product_name', sa.String(200), nullable=False),
+        sa.Column('sku', sa.String(200), nullable=False, unique=True),
+        sa.Column('price', sa.Float(), nullable=False),
+        sa.Column('category_id', sa.Integer(), sa.ForeignKey('category.id'), nullable=False),
+    )
+    op.create_table(
+        'inventory',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('product_id', sa.Integer(), sa.ForeignKey('product.id'), nullable=False),
+        sa.Column('stock', sa.Integer(), nullable=False, server_default='0'),
+    )
+    op.create_table(
+        'inventory_status',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('product_id', sa.Integer(), sa.ForeignKey('product.id'), nullable=False),
+        sa.Column('operation', sa.String(200), nullable=False),
+        sa.Column('pieces', sa.Integer(), nullable=False),
+        sa.Column('operation_date', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+    )
+    op.create_table(
+        'sales',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('product_id', sa.Integer(), sa.ForeignKey('product.id'), nullable=False),
+        sa.Column('price_per_piece', sa.Float(), nullable=False),
+        sa.Column('pieces', sa.Integer(), nullable=False),
+        sa.Column('sale_time', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+    )
+    op.create_table(
+        'sales_rollup',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('bucket', sa.String(20), nullable=False),
+        sa.Column('bucket_start', sa.DateTime(), nullable=False),
+        sa.Column('product_id', sa.Integer(), sa.ForeignKey('product.id'), nullable=False),
+        sa.Column('category_id', sa.Integer(), sa.ForeignKey('category.id'), nullable=False),
+        sa.Column('units', sa.Integer(), nullable=False),
+        sa.Column('revenue', sa.Float(), nullable=False),
+        sa.Column('sale_count', sa.Integer(), nullable=False),
+        sa.UniqueConstraint('bucket', 'bucket_start', 'product_id', name='uq_sales_rollup_bucket_product'),
+    )
+    op.create_index('ix_sales_rollup_bucket_category', 'sales_rollup', ['bucket', 'bucket_start', 'category_id'])
+
+
+def downgrade() -> None:
+    op.drop_table('sales_rollup')
+    op.drop_table('sales')
+    op.drop_table('inventory_status')
+    op.drop_table('inventory')
+    op.drop_table('product')
+    op.drop_table('category')
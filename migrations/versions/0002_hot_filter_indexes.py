@@ -0,0 +1,53 @@
+"""indexes on the hot filter columns, one inventory row per product
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def _merge_duplicate_inventory() -> None:
+    """
+    Folds duplicate inventory rows of a product into its first row so the unique constraint can be added
+    """
+    bind = op.get_bind()
+    inventory = sa.table('inventory', sa.column('id', sa.Integer), sa.column('product_id', sa.Integer),
+                         sa.column('stock', sa.Integer))
+    duplicates = bind.execute(
+        sa.select(inventory.c.product_id, sa.func.min(inventory.c.id), sa.func.sum(inventory.c.stock))
+        .group_by(inventory.c.product_id)
+        .having(sa.func.count() > 1)
+    ).all()
+    for product_id, keep_id, stock in duplicates:
+        bind.execute(sa.update(inventory).where(inventory.c.id == keep_id).values(stock=stock))
+        bind.execute(sa.delete(inventory).where(inventory.c.product_id == product_id, inventory.c.id != keep_id))
+
+
+def upgrade() -> None:
+    op.create_index('ix_sales_sale_time', 'sales', ['sale_time'])
+    op.create_index('ix_sales_product_sale_time', 'sales', ['product_id', 'sale_time'])
+    op.create_index('ix_inventory_status_operation_date', 'inventory_status', ['operation_date'])
+    op.create_index('ix_inventory_status_product_date', 'inventory_status', ['product_id', 'operation_date'])
+    op.create_index('ix_category_cat_name', 'category', ['cat_name'])
+
+    _merge_duplicate_inventory()
+    with op.batch_alter_table('inventory') as batch_op:
+        batch_op.create_unique_constraint('uq_inventory_product', ['product_id'])
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('inventory') as batch_op:
+        batch_op.drop_constraint('uq_inventory_product', type_='unique')
+
+    op.drop_index('ix_category_cat_name', 'category')
+    op.drop_index('ix_inventory_status_product_date', 'inventory_status')
+    op.drop_index('ix_inventory_status_operation_date', 'inventory_status')
+    op.drop_index('ix_sales_product_sale_time', 'sales')
+    op.drop_index('ix_sales_sale_time', 'sales')
@@ -0,0 +1,52 @@
+"""stock snapshot with low stock headroom, per product low stock thresholds
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from constants import LOW_STOCK_LIMIT
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('inventory') as batch_op:
+        batch_op.add_column(sa.Column('low_stock_threshold', sa.Integer(), nullable=True))
+
+    op.create_table(
+        'stock_snapshot',
+        sa.Column('product_id', sa.Integer(), sa.ForeignKey('product.id'), primary_key=True, autoincrement=False),
+        sa.Column('sku', sa.String(200), nullable=False),
+        sa.Column('product_name', sa.String(200), nullable=False),
+        sa.Column('category_id', sa.Integer(), sa.ForeignKey('category.id'), nullable=False),
+        sa.Column('stock', sa.Integer(), nullable=False),
+        sa.Column('low_stock_threshold', sa.Integer(), nullable=False),
+        sa.Column('headroom', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.UniqueConstraint('sku', name='uq_stock_snapshot_sku'),
+    )
+    op.create_index('ix_stock_snapshot_headroom', 'stock_snapshot', ['headroom'])
+    op.create_index('ix_stock_snapshot_category_headroom', 'stock_snapshot', ['category_id', 'headroom'])
+
+    # Fill the snapshot from the current inventory
+    op.execute(f"""
+        insert into stock_snapshot (product_id, sku, product_name, category_id, stock, low_stock_threshold, headroom)
+        select inventory.product_id, product.sku, product.product_name, product.category_id, inventory.stock,
+               {LOW_STOCK_LIMIT}, inventory.stock - {LOW_STOCK_LIMIT}
+        from inventory join product on product.id = inventory.product_id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_stock_snapshot_category_headroom', 'stock_snapshot')
+    op.drop_index('ix_stock_snapshot_headroom', 'stock_snapshot')
+    op.drop_table('stock_snapshot')
+
+    with op.batch_alter_table('inventory') as batch_op:
+        batch_op.drop_column('low_stock_threshold')
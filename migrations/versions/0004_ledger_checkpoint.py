@@ -0,0 +1,26 @@
+"""named checkpoints, the inventory reconciliation keeps its folded and last seen inventory_status ids here
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'ledger_checkpoint',
+        sa.Column('name', sa.String(200), primary_key=True),
+        sa.Column('last_seq', sa.BigInteger(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('ledger_checkpoint')
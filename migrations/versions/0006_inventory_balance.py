@@ -0,0 +1,26 @@
+"""inventory ledger balance of the reconciliation
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'inventory_balance',
+        sa.Column('product_id', sa.Integer(), sa.ForeignKey('product.id'), primary_key=True, autoincrement=False),
+        sa.Column('balance', sa.BigInteger(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('inventory_balance')
@@ -0,0 +1,26 @@
+"""write-behind sales ledger entries
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'ledger_entry',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('sale_time', sa.DateTime(), nullable=False),
+        sa.Column('sale_lines', sa.Text(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('ledger_entry')
@@ -0,0 +1,215 @@
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Union
+
+from pydantic import BaseModel, Field
+
+
+class OrderLine(BaseModel):
+    sku: str
+    quantity: int = Field(1, ge=1)
+
+
+class OrderRequest(BaseModel):
+    items: List[OrderLine] = Field(..., min_length=1)
+
+
+# Response models, fields a response can leave out default to None and are dropped with
+# response_model_exclude_unset, so failed responses only carry status and message
+
+class StatusResponse(BaseModel):
+    status: str
+    message: Optional[str] = None
+
+
+class InventoryItem(BaseModel):
+    product_name: str
+    sku: str
+    stock: int
+    low_stock_threshold: int
+    low_stock: bool
+
+
+class InventoryStatusResponse(StatusResponse):
+    inventory_data: Optional[List[InventoryItem]] = None
+    next_cursor: Optional[int] = None
+
+
+class InventoryTrackRecord(BaseModel):
+    product_name: str
+    product_sku: str
+    units: int
+    operation: str
+    operation_date: datetime
+
+
+class InventoryTrackResponse(StatusResponse):
+    data: Optional[List[InventoryTrackRecord]] = None
+    next_cursor: Optional[int] = None
+
+
+class ImportSummary(BaseModel):
+    rows: int
+    inserted: int
+    updated: int
+    skipped: int
+    errors: List[str]
+    seconds: float
+    rows_per_sec: float
+
+
+class ImportResponse(StatusResponse):
+    summary: Optional[ImportSummary] = None
+
+
+class CategoryRecord(BaseModel):
+    name: str
+    description: Optional[str] = None
+
+
+class CategoryListResponse(StatusResponse):
+    data: Optional[List[CategoryRecord]] = None
+
+
+class ProductRecord(BaseModel):
+    name: str
+    sku: str
+    price: float
+
+
+class ProductListResponse(StatusResponse):
+    data: Optional[List[ProductRecord]] = None
+
+
+class ProductSearchRecord(ProductRecord):
+    category: str
+    score: float
+
+
+class ProductSearchResponse(StatusResponse):
+    data: Optional[List[ProductSearchRecord]] = None
+
+
+class ReceiptLine(BaseModel):
+    item: str
+    unit: int
+    price: float
+    total: float
+
+
+class SaleResponse(StatusResponse):
+    reciept_data: Optional[ReceiptLine] = None
+
+
+class OrderReceipt(BaseModel):
+    items: List[ReceiptLine]
+    total: float
+
+
+class OrderResponse(StatusResponse):
+    reciept_data: Optional[OrderReceipt] = None
+
+
+class SaleRecord(BaseModel):
+    invoice_no: int
+    item: str
+    quantity: int
+    price_per_piece: float = Field(alias='price per piece')
+    total: float
+    invoice_time: datetime = Field(alias='invoice time')
+
+
+class SaleSummary(BaseModel):
+    item: str
+    sku: str
+    category: str
+    quantity: int
+    invoices: int
+    total: float
+
+
+class SalesDataResponse(StatusResponse):
+    interval: Optional[str] = None
+    bucket_start: Optional[datetime] = None
+    data: Optional[List[Union[SaleRecord, SaleSummary]]] = None
+    next_cursor: Optional[int] = None
+
+
+class CompareGroup(BaseModel):
+    category: Optional[str] = None
+    sku: Optional[str] = None
+    item: Optional[str] = None
+    bucket_start: Optional[str] = None
+    units: int
+    revenue: float
+    invoices: int
+    avg_price_per_piece: float
+    avg_invoice: float
+
+
+class CompareDelta(BaseModel):
+    category: Optional[str] = None
+    sku: Optional[str] = None
+    item: Optional[str] = None
+    units: int
+    units_pct: Optional[float]
+    revenue: float
+    revenue_pct: Optional[float]
+    invoices: int
+    invoices_pct: Optional[float]
+
+
+class ComparePeriod(BaseModel):
+    period: int
+    start_date: date
+    end_date: date
+    groups: List[CompareGroup]
+    change_from_previous: Optional[List[CompareDelta]] = None
+
+
+class CompareResponse(StatusResponse):
+    category1: Optional[str] = None
+    category2: Optional[str] = None
+    period1: Optional[List[SaleRecord]] = None
+    period2: Optional[List[SaleRecord]] = None
+    periods: Optional[List[ComparePeriod]] = None
+
+
+class SeriesLine(BaseModel):
+    key: Optional[str] = None
+    units: List[int]
+    revenue: List[float]
+
+
+class SeriesResponse(StatusResponse):
+    bucket: Optional[str] = None
+    buckets: Optional[List[datetime]] = None
+    series: Optional[List[SeriesLine]] = None
+
+
+class ExportSummary(BaseModel):
+    rows: int
+    days: int
+    first_day: Optional[date] = None
+    last_day: Optional[date] = None
+    last_id: int
+    seconds: float
+
+
+class ExportDay(BaseModel):
+    day: date
+    parts: int
+    bytes: int
+
+
+class ExportResponse(StatusResponse):
+    summary: Optional[ExportSummary] = None
+    watermark: Optional[Dict[str, Any]] = None
+    days: Optional[List[ExportDay]] = None
+
+
+class ReconcileResponse(StatusResponse):
+    data: Optional[Dict[str, Any]] = None
+
+
+class SystemResponse(StatusResponse):
+    data: Dict[str, Any]
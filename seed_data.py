@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from sqlalchemy import delete, func, insert, select
+
+import db_utils
+from db_utils import Base, Category, Inventory, InventoryStatus, Product, Sale
+from utils.rollup_utils import backfill_rollups
+from utils.stock_utils import rebuild_stock_snapshot
+
+SEED_BATCH_SIZE = 10000
+
+
+def seed_catalog(conn, rng: random.Random, categories: int, products: int) -> list:
+    """
+    Inserts categories and products, products are spread evenly over categories
+    :param conn: DB connection
+    :param rng: random generator
+    :param categories: number of categories
+    :param products: number of products
+    :return: list of (product_id, price)
+    """
+    conn.execute(insert(Category), [{
+        'cat_name': f'Category {i:03d}',
+        'cat_description': f'Generated category {i}'
+    } for i in range(1, categories + 1)])
+    category_ids = conn.scalars(select(Category.id).order_by(Category.id)).all()
+
+    for start in range(0, products, SEED_BATCH_SIZE):
+        conn.execute(insert(Product), [{
+            'product_name': f'Product {i}',
+            'sku': f'SKU{i:07d}',
+            'price': round(rng.uniform(5, 500), 2),
+            'category_id': category_ids[i % len(category_ids)]
+        } for i in range(start + 1, min(start + SEED_BATCH_SIZE, products) + 1)])
+
+    return conn.execute(select(Product.id, Product.price).order_by(Product.id)).all()
+
+
+def seed_sales(engine, rng: random.Random, catalog: list, sales: int, days: int) -> dict:
+    """
+    Inserts sales spread evenly over the last days with increasing times, each with its inventory
+    remove entry. A few products get most of the sales, like real catalogs
+    :param engine: DB engine
+    :param rng: random generator
+    :param catalog: list of (product_id, price)
+    :param sales: number of sales
+    :param days: days the sales are spread over, ending now
+    :return: dict of product_id to units sold
+    """
+    # Zipf like popularity of randomly ranked products
+    ranked = list(catalog)
+    rng.shuffle(ranked)
+    cum_weights = list(accumulate(1 / (rank + 1) for rank in range(len(ranked))))
+
+    start = datetime.now().replace(microsecond=0) - timedelta(days=days)
+    step = days * 86400 / max(sales, 1)
+    sold = dict.fromkeys((product_id for product_id, _ in catalog), 0)
+    started = time.perf_counter()
+
+    for offset in range(0, sales, SEED_BATCH_SIZE):
+        count = min(SEED_BATCH_SIZE, sales - offset)
+        sale_rows, status_rows = [], []
+        for i, (product_id, price) in enumerate(rng.choices(ranked, cum_weights=cum_weights, k=count), offset):
+            pieces = rng.randint(1, 5)
+            sale_time = start + timedelta(seconds=(i + rng.random()) * step)
+            sold[product_id] += pieces
+            sale_rows.append({'product_id': product_id, 'price_per_piece': price, 'pieces': pieces,
+                              'sale_time': sale_time})
+            status_rows.append({'product_id': product_id, 'operation': 'remove', 'pieces': pieces,
+                                'operation_date': sale_time})
+
+        with engine.begin() as conn:
+            conn.execute(insert(Sale), sale_rows)
+            conn.execute(insert(InventoryStatus), status_rows)
+
+        done = offset + count
+        print(f'{done} sales, {done / (time.perf_counter() - started):.0f} sales/sec', file=sys.stderr)
+
+    return sold
+
+
+def seed_inventory(conn, rng: random.Random, sold: dict, days: int) -> None:
+    """
+    Stocks every product, the recorded add covers the units sold so the inventory ledger balances
+    :param conn: DB connection
+    :param rng: random generator
+    :param sold: dict of product_id to units sold
+    :param days: days the sales are spread over
+    :return:
+    """
+    added_at = datetime.now().replace(microsecond=0) - timedelta(days=days + 1)
+    stock = {product_id: rng.randint(0, 200) for product_id in sold}
+    product_ids = list(stock)
+    for start in range(0, len(product_ids), SEED_BATCH_SIZE):
+        batch = product_ids[start:start + SEED_BATCH_SIZE]
+        conn.execute(insert(Inventory), [{'product_id': product_id, 'stock': stock[product_id]}
+                                         for product_id in batch])
+        conn.execute(insert(InventoryStatus), [{
+            'product_id': product_id,
+            'operation': 'add',
+            'pieces': stock[product_id] + sold[product_id],
+            'operation_date': added_at
+        } for product_id in batch])
+
+
+async def build_derived_tables() -> tuple:
+    async with db_utils.AsyncSessionLocal() as session:
+        snapshot_rows = await rebuild_stock_snapshot(session)
+        rollup_rows = await backfill_rollups(session)
+    await db_utils.dispose_engines()
+
+    return snapshot_rows, rollup_rows
+
+
+def main(categories: int, products: int, sales: int, days: int, seed: int, reset: bool) -> None:
+    rng = random.Random(seed)
+    engine = db_utils.get_engine()
+
+    # Missing tables are created from the models, run "alembic stamp head" to manage the database with
+    # migrations afterwards
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        if conn.scalar(select(func.count()).select_from(Product)):
+            if not reset:
+                sys.exit('Database already has products, pass --reset to delete every row first')
+            for table in reversed(Base.metadata.sorted_tables):
+                conn.execute(delete(table))
+
+        catalog = seed_catalog(conn, rng, categories, products)
+
+    sold = seed_sales(engine, rng, catalog, sales, days)
+    with engine.begin() as conn:
+        seed_inventory(conn, rng, sold, days)
+
+    snapshot_rows, rollup_rows = asyncio.run(build_derived_tables())
+    print(f'Done: {categories} categories, {products} products, {sales} sales, {snapshot_rows} stock snapshot rows, '
+          f'{rollup_rows} rollup rows')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seed a database with generated catalog, inventory and sales data')
+    parser.add_argument('--url', help='database URL e.g. sqlite:///bench.db, DATABASE_URL if not given')
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--sales', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=365, help='days the sales are spread over, ending now')
+    parser.add_argument('--seed', type=int, default=42, help='random seed, the same seed generates the same data')
+    parser.add_argument('--reset', action='store_true', help='delete every row before seeding')
+    args = parser.parse_args()
+
+    if args.url:
+        db_utils.configure_database(args.url)
+    main(args.categories, args.products, args.sales, args.days, args.seed, args.reset)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+from collections import namedtuple
+from typing import Iterable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from constants import CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL
+from db_utils import Category, Product
+from utils.cache_utils import LRUCache
+from utils.invalidation_utils import invalidation_channel
+from utils.query_utils import category_list_query, product_list_query
+from utils.report_cache_utils import report_cache
+from utils.search_utils import product_search
+
+# Plain tuples are cached instead of ORM objects, they are safe to share between sessions
+ProductInfo = namedtuple('ProductInfo', ['id', 'product_name', 'sku', 'price', 'category_id'])
+CategoryInfo = namedtuple('CategoryInfo', ['id', 'cat_name', 'cat_description'])
+
+product_cache = LRUCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL)
+category_cache = LRUCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL)
+
+# Formatted /product/list and /category/list payloads with their ETag
+catalog_list_cache = LRUCache(2, CATALOG_CACHE_TTL)
+
+
+async def get_product(db: AsyncSession, sku: str) -> Optional[ProductInfo]:
+    """
+    Returns a product by SKU, read through the product cache
+    :param db: DB Session
+    :param sku: product SKU
+    :return: ProductInfo or None
+    """
+    product = product_cache.get(sku, None)
+    if product is None:
+        row = (await db.execute(
+            select(Product.id, Product.product_name, Product.sku, Product.price, Product.category_id)
+            .where(Product.sku == sku)
+        )).first()
+        if row is None:
+            return None
+        product = ProductInfo(*row)
+        product_cache.set(sku, product)
+
+    return product
+
+
+async def get_products_by_sku(db: AsyncSession, skus: Iterable[str]) -> dict:
+    """
+    Returns products of several SKUs, cache misses are loaded with one query
+    :param db: DB Session
+    :param skus: product SKUs
+    :return: dict of sku to ProductInfo, unknown SKUs are left out
+    """
+    products, missing = {}, []
+    for sku in skus:
+        product = product_cache.get(sku, None)
+        if product is None:
+            missing.append(sku)
+        else:
+            products[sku] = product
+
+    if missing:
+        rows = await db.execute(
+            select(Product.id, Product.product_name, Product.sku, Product.price, Product.category_id)
+            .where(Product.sku.in_(missing))
+        )
+        for row in rows:
+            product = ProductInfo(*row)
+            product_cache.set(product.sku, product)
+            products[product.sku] = product
+
+    return products
+
+
+async def get_category(db: AsyncSession, name: str) -> Optional[CategoryInfo]:
+    """
+    Returns a category by name, read through the category cache
+    :param db: DB Session
+    :param name: category name
+    :return: CategoryInfo or None
+    """
+    category = category_cache.get(name, None)
+    if category is None:
+        row = (await db.execute(
+            select(Category.id, Category.cat_name, Category.cat_description).where(Category.cat_name == name)
+        )).first()
+        if row is None:
+            return None
+        category = CategoryInfo(*row)
+        category_cache.set(name, category)
+
+    return category
+
+
+def _with_etag(data: list) -> tuple:
+    digest = hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+    return f'"{digest}"', data
+
+
+async def get_product_list(db: AsyncSession) -> tuple:
+    """
+    Returns the formatted product list and its ETag
+    :param db: DB Session
+    :return: (etag, data)
+    """
+    cached = catalog_list_cache.get('products', None)
+    if cached is None:
+        data = [{
+            'name': i.product_name,
+            'sku': i.sku,
+            'price': i.price
+        } for i in await db.execute(product_list_query())]
+        cached = _with_etag(data)
+        catalog_list_cache.set('products', cached)
+
+    return cached
+
+
+async def get_category_list(db: AsyncSession) -> tuple:
+    """
+    Returns the formatted category list and its ETag
+    :param db: DB Session
+    :return: (etag, data)
+    """
+    cached = catalog_list_cache.get('categories', None)
+    if cached is None:
+        data = [{
+            'name': i.cat_name,
+            'description': i.cat_description
+        } for i in await db.execute(category_list_query())]
+        cached = _with_etag(data)
+        catalog_list_cache.set('categories', cached)
+
+    return cached
+
+
+def _drop_products(skus: Optional[Iterable[str]]) -> None:
+    if skus is None:
+        product_cache.clear()
+    else:
+        for sku in skus:
+            product_cache.invalidate(sku)
+    catalog_list_cache.invalidate('products')
+    # Reports show product names
+    report_cache.clear()
+    product_search.mark_stale(skus)
+
+
+def _drop_categories(names: Optional[Iterable[str]]) -> None:
+    if names is None:
+        category_cache.clear()
+    else:
+        for name in names:
+            category_cache.invalidate(name)
+    catalog_list_cache.invalidate('categories')
+    report_cache.clear()
+
+
+def invalidate_products(skus: Iterable[str] = ()) -> None:
+    """
+    Drops cached products after a product write, in this and the other workers
+    :param skus: written SKUs
+    :return:
+    """
+    skus = list(skus)
+    _drop_products(skus)
+    invalidation_channel.publish('products', skus)
+
+
+def invalidate_categories(names: Iterable[str] = ()) -> None:
+    """
+    Drops cached categories after a category write, in this and the other workers
+    :param names: written category names
+    :return:
+    """
+    names = list(names)
+    _drop_categories(names)
+    invalidation_channel.publish('categories', names)
+
+
+# Writes of other workers
+invalidation_channel.subscribe('products', _drop_products)
+invalidation_channel.subscribe('categories', _drop_categories)
+
+
+def get_catalog_cache_stats() -> dict:
+    return {
+        'products': product_cache.stats(),
+        'categories': category_cache.stats(),
+        'lists': catalog_list_cache.stats()
+    }
@@ -0,0 +1,79 @@
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.engine import Connection
+
+from db_utils import Category, Inventory, Product, SalesRollup
+from utils.query_utils import inventory_status_query, inventory_track_query, sales_query
+
+
+def get_checked_queries() -> list:
+    """
+    Filtered queries the endpoints run, none of them should scan a whole table
+    :return: list of (name, statement)
+    """
+    end = datetime.today()
+    start = end - timedelta(days=7)
+
+    return [
+        ('sales by date', sales_query(start, end)),
+        ('sales by date and product', sales_query(start, end, product_sku='BAT01')),
+        ('sales by date and category', sales_query(start, end, category='Cricket')),
+        ('inventory track by date', inventory_track_query(start, end)),
+        ('inventory by product', select(Inventory.id, Inventory.stock).where(Inventory.product_id == 1)),
+        ('product by sku', select(Product.id).where(Product.sku == 'BAT01')),
+        ('category by name', select(Category.id).where(Category.cat_name == 'Cricket')),
+        ('rollups by bucket', select(SalesRollup.units).where(SalesRollup.bucket == 'daily',
+                                                              SalesRollup.bucket_start >= start,
+                                                              SalesRollup.bucket_start <= end)),
+        ('low stock products', inventory_status_query(low_stock_only=True)),
+        ('low stock products by category', inventory_status_query(low_stock_only=True, category_id=1)),
+    ]
+
+
+def explain(connection: Connection, statement) -> list:
+    """
+    Returns full table scans in the query plan of a statement
+    :param connection: DB connection
+    :param statement: select statement
+    :return: list of scanned table names/plan lines
+    """
+    dialect = connection.dialect
+    compiled = statement.compile(dialect=dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup) if compiled.positional \
+        else compiled.params
+
+    if dialect.name == 'mysql':
+        plan = connection.exec_driver_sql(f'EXPLAIN {compiled}', params).mappings().all()
+        # access type ALL is a full table scan
+        return [row['table'] for row in plan if row['type'] == 'ALL']
+
+    if dialect.name == 'sqlite':
+        plan = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params).all()
+        # "SCAN table" without an index is a full table scan, index lookups show as SEARCH
+        return [row[-1] for row in plan if row[-1].startswith('SCAN') and 'INDEX' not in row[-1]]
+
+    raise ValueError(f'EXPLAIN check is not supported on {dialect.name}')
+
+
+def check_query_plans(connection: Connection) -> dict:
+    """
+    Explains every checked query
+    :param connection: DB connection
+    :return: dict of query name to full scans, empty when the query uses indexes
+    """
+    return {name: explain(connection, statement) for name, statement in get_checked_queries()}
+
+
+if __name__ == '__main__':
+    from db_utils import get_engine
+
+    # Run against a database with realistic data, optimizers prefer scans on near empty tables
+    with get_engine().connect() as conn:
+        results = check_query_plans(conn)
+
+    for query_name, scans in results.items():
+        print(f"{'FULL SCAN' if scans else 'ok':9} {query_name} {', '.join(scans)}")
+
+    sys.exit(1 if any(results.values()) else 0)
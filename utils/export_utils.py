@@ -0,0 +1,299 @@
+import argparse
+import glob
+import io
+import json
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+
+from sqlalchemy import func, select
+
+import db_utils
+from db_utils import Category, Product, Sale
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:  # Exports are optional, pip install pyarrow
+    pa = None
+
+try:
+    import fcntl
+except ImportError:  # Windows, exports are only serialized within the process
+    fcntl = None
+
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'exports')
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 50000))
+EXPORT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+EXPORT_MEDIA_TYPES = {'parquet': 'application/vnd.apache.parquet', 'arrow': 'application/vnd.apache.arrow.file'}
+PARQUET_COMPRESSION = 'zstd'
+
+WATERMARK_FILE = '_watermark.json'
+LOCK_FILE = '_export.lock'
+PART_PATTERN = re.compile(r'part-(\d+)\.(parquet|arrow)$')
+
+
+class ExportRunning(RuntimeError):
+    """
+    Another export of the same dataset is running, in this or another process
+    """
+
+
+def sales_schema():
+    return pa.schema([
+        ('id', pa.int64()),
+        ('sale_time', pa.timestamp('us')),
+        ('product_id', pa.int32()),
+        ('sku', pa.string()),
+        ('product_name', pa.string()),
+        ('category_id', pa.int32()),
+        ('category', pa.string()),
+        ('pieces', pa.int32()),
+        ('price_per_piece', pa.float64()),
+        ('total', pa.float64()),
+    ])
+
+
+def export_query(after_id: int, upto_id: int):
+    """
+    Sales with their product and category after the watermark, in id order
+    :param after_id: last exported sale id
+    :param upto_id: last sale id to export
+    :return: Select
+    """
+    return (
+        select(Sale.id, Sale.sale_time, Sale.product_id, Product.sku, Product.product_name, Product.category_id,
+               Category.cat_name, Sale.pieces, Sale.price_per_piece, (Sale.pieces * Sale.price_per_piece))
+        .join(Product, Product.id == Sale.product_id)
+        .join(Category, Category.id == Product.category_id)
+        .where(Sale.id > after_id, Sale.id <= upto_id)
+        .order_by(Sale.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise RuntimeError('Sales exports need pyarrow, run: pip install pyarrow')
+
+
+def _sales_dir(export_dir: str, export_format: str) -> str:
+    # Every format is its own dataset with its own watermark, readers expect one format per directory
+    return os.path.join(export_dir, f'sales_{export_format}')
+
+
+def _day_dir(export_dir: str, export_format: str, day: date) -> str:
+    # Hive style partitions, pyarrow.dataset and pandas read sale_date back as a column
+    return os.path.join(_sales_dir(export_dir, export_format), f'sale_date={day.isoformat()}')
+
+
+def read_watermark(export_dir: str = EXPORT_DIR, export_format: str = 'parquet') -> dict:
+    """
+    Returns the last exported sale id, the last sale id the previous run saw and export counters of a dataset
+    :param export_dir: export root
+    :param export_format: parquet or arrow dataset
+    :return: dict
+    """
+    path = os.path.join(_sales_dir(export_dir, export_format), WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {'last_id': 0, 'seen_id': None, 'rows': 0, 'updated_at': None}
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def _write_watermark(export_dir: str, export_format: str, watermark: dict) -> None:
+    path = os.path.join(_sales_dir(export_dir, export_format), WATERMARK_FILE)
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as file:
+        json.dump(watermark, file)
+    os.replace(f'{path}.tmp', path)
+
+
+@contextmanager
+def _export_lock(export_dir: str, export_format: str):
+    """
+    Exclusive lock of a dataset held while an export runs, server workers and the CLI share it through
+    a lock file in the dataset directory. Fails right away when it is taken
+    """
+    with open(os.path.join(_sales_dir(export_dir, export_format), LOCK_FILE), 'a') as file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise ExportRunning(f'An export of the {export_format} sales is already running') from None
+        # Closing the file releases the lock
+        yield
+
+
+def _remove_uncommitted_parts(export_dir: str, export_format: str, last_id: int) -> None:
+    """
+    Deletes parts an interrupted run wrote past the watermark, the next run exports those rows again
+    """
+    for path in glob.glob(os.path.join(_sales_dir(export_dir, export_format), 'sale_date=*', 'part-*')):
+        match = PART_PATTERN.search(path)
+        if match and int(match.group(1)) > last_id:
+            os.remove(path)
+
+
+class _DayWriters:
+    """
+    One open part file per sale day touched by the run, named after the first sale id of the run
+    """
+
+    def __init__(self, export_dir: str, export_format: str, first_id: int):
+        self.export_dir = export_dir
+        self.export_format = export_format
+        self.name = f'part-{first_id:012d}{EXPORT_FORMATS[export_format]}'
+        self.writers = {}
+
+    def write(self, day: date, table) -> None:
+        writer = self.writers.get(day)
+        if writer is None:
+            directory = _day_dir(self.export_dir, self.export_format, day)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, self.name)
+            if self.export_format == 'parquet':
+                writer = pq.ParquetWriter(path, table.schema, compression=PARQUET_COMPRESSION)
+            else:
+                writer = ipc.new_file(path, table.schema, options=ipc.IpcWriteOptions(compression='zstd'))
+            self.writers[day] = writer
+        writer.write_table(table)
+
+    def close(self) -> None:
+        for writer in self.writers.values():
+            writer.close()
+
+
+def export_sales(export_dir: str = EXPORT_DIR, export_format: str = 'parquet') -> dict:
+    """
+    Exports sales after the watermark to compressed files partitioned by sale day, reading them in
+    yield_per batches, then moves the watermark. Meant for a replica or off-peak runs, it holds one
+    streaming read open on the database.
+
+    A run only exports sales up to the last id the previous run saw: a sale still in flight at that time
+    may commit with a lower id than sales already visible, moving the watermark past it would skip it for good.
+    :param export_dir: export root
+    :param export_format: parquet or arrow (Arrow IPC)
+    :return: run summary
+    :raises ExportRunning: when another export of the dataset runs
+    """
+    _require_pyarrow()
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format: {export_format}')
+
+    started = time.perf_counter()
+    os.makedirs(_sales_dir(export_dir, export_format), exist_ok=True)
+    with _export_lock(export_dir, export_format):
+        watermark = read_watermark(export_dir, export_format)
+        _remove_uncommitted_parts(export_dir, export_format, watermark['last_id'])
+
+        schema = sales_schema()
+        rows, days, writers = 0, set(), None
+        with db_utils.get_engine().connect() as conn:
+            seen_id = conn.scalar(select(func.max(Sale.id))) or 0
+            # First runs, and watermarks written before seen_id was kept, export what is visible
+            upto_id = max(seen_id if watermark.get('seen_id') is None else watermark['seen_id'],
+                          watermark['last_id'])
+            for batch in conn.execute(export_query(watermark['last_id'], upto_id)).partitions():
+                columns = list(zip(*batch))
+                table = pa.Table.from_arrays([pa.array(values, type=field.type)
+                                              for values, field in zip(columns, schema)], schema=schema)
+                if writers is None:
+                    writers = _DayWriters(export_dir, export_format, batch[0][0])
+
+                sale_days = pc.cast(table['sale_time'], pa.date32())
+                for day in pc.unique(sale_days).to_pylist():
+                    writers.write(day, table.filter(pc.equal(sale_days, pa.scalar(day, pa.date32()))))
+                    days.add(day)
+
+                rows += len(batch)
+
+        if writers is not None:
+            writers.close()
+        # Sales up to upto_id that are still missing were rolled back
+        if writers is not None or seen_id != watermark.get('seen_id'):
+            _write_watermark(export_dir, export_format, {
+                'last_id': upto_id,
+                'seen_id': seen_id,
+                'rows': watermark['rows'] + rows,
+                'updated_at': datetime.now().isoformat(timespec='seconds')
+            })
+
+    return {
+        'rows': rows,
+        'days': len(days),
+        'first_day': min(days).isoformat() if days else None,
+        'last_day': max(days).isoformat() if days else None,
+        'last_id': upto_id,
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+
+def list_export_days(export_dir: str = EXPORT_DIR, export_format: str = 'parquet') -> list:
+    """
+    Returns the exported days of a dataset with their part count and size
+    :param export_dir: export root
+    :param export_format: parquet or arrow dataset
+    :return: list of dicts
+    """
+    days = []
+    for directory in sorted(glob.glob(os.path.join(_sales_dir(export_dir, export_format), 'sale_date=*'))):
+        parts = [path for path in glob.glob(os.path.join(directory, 'part-*')) if PART_PATTERN.search(path)]
+        days.append({
+            'day': os.path.basename(directory).split('=', 1)[1],
+            'parts': len(parts),
+            'bytes': sum(os.path.getsize(path) for path in parts)
+        })
+
+    return days
+
+
+def read_export_day(day: date, export_format: str = 'parquet', export_dir: str = EXPORT_DIR) -> bytes:
+    """
+    Returns the exported sales of one day as a single Parquet or Arrow IPC file, incremental runs
+    leave several parts per day which are merged
+    :param day: sale day
+    :param export_format: parquet or arrow dataset
+    :param export_dir: export root
+    :return: file content, empty when the day was not exported
+    """
+    _require_pyarrow()
+    parts = sorted(path for path in glob.glob(os.path.join(_day_dir(export_dir, export_format, day), 'part-*'))
+                   if PART_PATTERN.search(path))
+    if not parts:
+        return b''
+    if len(parts) == 1:
+        with open(parts[0], 'rb') as file:
+            return file.read()
+
+    sink = io.BytesIO()
+    if export_format == 'parquet':
+        pq.write_table(pa.concat_tables([pq.read_table(path) for path in parts]), sink,
+                       compression=PARQUET_COMPRESSION)
+    else:
+        table = pa.concat_tables([ipc.open_file(path).read_all() for path in parts])
+        with ipc.new_file(sink, table.schema, options=ipc.IpcWriteOptions(compression='zstd')) as writer:
+            writer.write_table(table)
+
+    return sink.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports new sales to Parquet/Arrow files partitioned by day')
+    parser.add_argument('--dir', default=EXPORT_DIR, help='export root, EXPORT_DIR if not given')
+    parser.add_argument('--format', default='parquet', choices=list(EXPORT_FORMATS))
+    parser.add_argument('--url', help='database URL, DATABASE_URL if not given. Point it at a replica if there is one')
+    args = parser.parse_args()
+
+    if args.url:
+        db_utils.configure_database(args.url)
+    try:
+        summary = export_sales(args.dir, args.format)
+    except ExportRunning as e:
+        sys.exit(str(e))
+    print(f"Exported {summary['rows']} sales over {summary['days']} days up to id {summary['last_id']} "
+          f"in {summary['seconds']}s", file=sys.stderr)
@@ -0,0 +1,290 @@
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from db_utils import AsyncSessionLocal, IdempotencyRecord
+from utils.cache_utils import LRUCache
+
+# memory keeps responses per process, database shares them between server processes
+IDEMPOTENCY_STORE = os.environ.get('IDEMPOTENCY_STORE', 'memory')
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))  # seconds a response is replayed
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 100000))  # responses kept in memory
+# Seconds a retry waits for the first attempt running in another process before getting 409
+IDEMPOTENCY_WAIT = int(os.environ.get('IDEMPOTENCY_WAIT', 10))
+# Seconds after which a claimed key without a response counts as abandoned (its process died) and is taken over
+IDEMPOTENCY_CLAIM_TIMEOUT = int(os.environ.get('IDEMPOTENCY_CLAIM_TIMEOUT', 300))
+
+IDEMPOTENCY_HEADER = b'idempotency-key'
+MAX_KEY_LENGTH = 255
+PURGE_EVERY = 1000  # stored responses between deletes of expired database rows
+PENDING = 0  # status_code of a claimed key whose first attempt is still running
+POLL_INTERVAL = 0.05  # seconds between looks at a key claimed by another process
+
+
+class StoredResponse:
+    __slots__ = ('fingerprint', 'status_code', 'headers', 'body')
+
+    def __init__(self, fingerprint: str, status_code: int, headers: list, body: bytes):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+
+class IdempotencyStore:
+    """
+    Responses of POST requests by Idempotency-Key. Recent keys are kept in a bounded in-process LRU
+    with TTL, fresh keys cost no round trip. With use_database a request first claims its key by inserting
+    a pending row in the idempotency_key table, whose primary key lets one process win, and fills the row
+    with its response; a retry on another process that loses the insert replays the response, or waits
+    while the first attempt is running. Fresh keys then cost an insert before and an update after the request.
+    """
+
+    def __init__(self, maxsize: int, ttl: int, use_database: bool = False):
+        self.ttl = ttl
+        self.use_database = use_database
+        self.responses = LRUCache(maxsize, ttl)
+        # Keys being processed, retries wait for the first request instead of running again
+        self.in_flight = {}
+
+        self.stored = 0
+        self.replayed = 0
+        self.mismatches = 0
+        self.waits = 0
+        self.database_lookups = 0
+
+    async def get_or_claim(self, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        """
+        Returns the stored response of a key, a PENDING one while another process runs its first attempt,
+        or None once the key is claimed for this request
+        :param key: Idempotency-Key
+        :param fingerprint: fingerprint of the request
+        :return: StoredResponse or None
+        """
+        response = self.responses.get(key, None)
+        if response is not None or not self.use_database:
+            return response
+
+        while True:
+            async with AsyncSessionLocal() as db:
+                now = datetime.now()
+                try:
+                    await db.execute(insert(IdempotencyRecord).values(
+                        key=key, fingerprint=fingerprint, status_code=PENDING, headers='[]', body=b'', created_at=now
+                    ))
+                    await db.commit()
+                    return None
+                except IntegrityError:
+                    await db.rollback()
+
+                # Expired responses and abandoned claims give way to this request
+                expired = await db.execute(delete(IdempotencyRecord).where(
+                    IdempotencyRecord.key == key,
+                    or_(IdempotencyRecord.created_at < now - timedelta(seconds=self.ttl),
+                        (IdempotencyRecord.status_code == PENDING)
+                        & (IdempotencyRecord.created_at < now - timedelta(seconds=IDEMPOTENCY_CLAIM_TIMEOUT)))
+                ))
+                await db.commit()
+                if expired.rowcount:
+                    continue
+
+                self.database_lookups += 1
+                row = (await db.execute(
+                    select(IdempotencyRecord.fingerprint, IdempotencyRecord.status_code, IdempotencyRecord.headers,
+                           IdempotencyRecord.body)
+                    .where(IdempotencyRecord.key == key)
+                )).first()
+            # Released by a failed first attempt in between, claim it again
+            if row is None:
+                continue
+
+            headers = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in json.loads(row[2])]
+            response = StoredResponse(row[0], row[1], headers, row[3])
+            if response.status_code != PENDING:
+                self.responses.set(key, response)
+            return response
+
+    async def set(self, key: str, response: StoredResponse) -> None:
+        """
+        Stores the response of a claimed key
+        """
+        self.responses.set(key, response)
+        self.stored += 1
+        if not self.use_database:
+            return
+
+        headers = json.dumps([(name.decode('latin-1'), value.decode('latin-1')) for name, value in response.headers])
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(IdempotencyRecord).where(IdempotencyRecord.key == key).values(
+                fingerprint=response.fingerprint, status_code=response.status_code, headers=headers,
+                body=response.body, created_at=datetime.now()
+            ))
+            if self.stored % PURGE_EVERY == 0:
+                await db.execute(delete(IdempotencyRecord).where(
+                    IdempotencyRecord.created_at < datetime.now() - timedelta(seconds=self.ttl)))
+            await db.commit()
+
+    async def release(self, key: str) -> None:
+        """
+        Drops the claim of a key whose request failed, so a retry runs it again
+        """
+        if not self.use_database:
+            return
+
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(IdempotencyRecord).where(IdempotencyRecord.key == key,
+                                                             IdempotencyRecord.status_code == PENDING))
+            await db.commit()
+
+    def stats(self) -> dict:
+        return {
+            'store': 'database' if self.use_database else 'memory',
+            'ttl': self.ttl,
+            **self.responses.stats(),
+            'in_flight': len(self.in_flight),
+            'stored': self.stored,
+            'replayed': self.replayed,
+            'mismatches': self.mismatches,
+            'waits': self.waits,
+            'database_lookups': self.database_lookups
+        }
+
+
+def _error(status_code: int, detail: str) -> StoredResponse:
+    return StoredResponse('', status_code, [(b'content-type', b'application/json')],
+                          json.dumps({'detail': detail}).encode())
+
+
+async def _send_response(send, response: StoredResponse, replayed: bool = False) -> None:
+    headers = list(response.headers)
+    if replayed:
+        headers.append((b'idempotent-replayed', b'true'))
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': response.body})
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI middleware answering retried POST requests that carry an Idempotency-Key header with the stored
+    response of the first attempt, so retries don't sell or add stock twice. Requests without the header
+    pass straight through. A key reused for a different request (method, path, query or body) gets 422,
+    server errors are not stored so the request can be retried. A retry arriving while the first attempt
+    runs waits for it, and gets 409 after IDEMPOTENCY_WAIT seconds when that attempt runs in another process.
+    """
+
+    def __init__(self, app, store: IdempotencyStore):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST':
+            await self.app(scope, receive, send)
+            return
+
+        key = next((value for name, value in scope['headers'] if name == IDEMPOTENCY_HEADER), None)
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+
+        key = key.decode('latin-1').strip()
+        if not key or len(key) > MAX_KEY_LENGTH:
+            await _send_response(send, _error(400, f'Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters'))
+            return
+
+        # The body is read up front so the fingerprint covers it whether or not the handler reads it
+        request_body = await _read_body(receive)
+        fingerprint = hashlib.sha256(f'{scope["method"]} {scope["path"]}?'.encode() + scope['query_string'] + b'\n'
+                                     + request_body).hexdigest()
+
+        waited = 0
+        while True:
+            in_flight = self.store.in_flight.get(key)
+            if in_flight is not None:
+                self.store.waits += 1
+                await in_flight.wait()
+                continue
+
+            # Retries reaching this process wait on the event instead of claiming the key again
+            done = self.store.in_flight[key] = asyncio.Event()
+            try:
+                stored = await self.store.get_or_claim(key, fingerprint)
+            except BaseException:
+                del self.store.in_flight[key]
+                done.set()
+                raise
+            if stored is None:
+                break
+            del self.store.in_flight[key]
+            done.set()
+
+            if stored.fingerprint != fingerprint:
+                self.store.mismatches += 1
+                await _send_response(send, _error(422, 'Idempotency-Key was used for a different request'))
+                return
+            if stored.status_code != PENDING:
+                self.store.replayed += 1
+                await _send_response(send, stored, replayed=True)
+                return
+
+            # The first attempt runs in another process
+            if waited >= IDEMPOTENCY_WAIT:
+                await _send_response(send, _error(409, 'A request with this Idempotency-Key is still running'))
+                return
+            self.store.waits += 1
+            await asyncio.sleep(POLL_INTERVAL)
+            waited += POLL_INTERVAL
+
+        status_code, headers, body = 500, [], []
+        body_sent = False
+
+        async def receive_buffered():
+            nonlocal body_sent
+            if body_sent:
+                return await receive()
+            body_sent = True
+            return {'type': 'http.request', 'body': request_body, 'more_body': False}
+
+        async def send_captured(message):
+            nonlocal status_code, headers
+            if message['type'] == 'http.response.start':
+                status_code, headers = message['status'], message.get('headers', [])
+            elif message['type'] == 'http.response.body':
+                body.append(message.get('body', b''))
+            await send(message)
+
+        stored = False
+        try:
+            await self.app(scope, receive_buffered, send_captured)
+            if status_code < 500:
+                await self.store.set(key, StoredResponse(fingerprint, status_code, list(headers),
+                                                         b''.join(body)))
+                stored = True
+        finally:
+            try:
+                if not stored:
+                    await self.store.release(key)
+            finally:
+                del self.store.in_flight[key]
+                done.set()
+
+
+async def _read_body(receive) -> bytes:
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        body.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+
+    return b''.join(body)
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_TTL, IDEMPOTENCY_STORE == 'database')
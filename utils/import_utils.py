@@ -0,0 +1,267 @@
+import csv
+import io
+import json
+import time
+from typing import Callable, IO, Iterable, Optional
+
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from constants import BULK_IMPORT_BATCH_SIZE
+from db_utils import Category, Inventory, InventoryStatus, Product
+from utils.catalog_utils import invalidate_products
+from utils.rollup_utils import recategorize_rollups
+from utils.stock_utils import refresh_stock_snapshot
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+# Only the first errors are kept in the summary, a bad feed can have thousands
+MAX_REPORTED_ERRORS = 100
+
+
+def guess_format(filename: str) -> str:
+    """
+    Guesses import format from a file name, csv unless it looks like NDJSON
+    :param filename: uploaded or local file name
+    :return: str
+    """
+    return 'ndjson' if (filename or '').lower().endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+
+
+def read_records(file: IO, file_format: str) -> Iterable[dict]:
+    """
+    Lazily reads records from a binary CSV (with header) or NDJSON file
+    :param file: binary file object
+    :param file_format: csv or ndjson
+    :return: iterator of dicts
+    """
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        yield from csv.DictReader(text)
+        return
+
+    for line in text:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            # Reported as a skipped line instead of aborting the import
+            yield {'_error': 'invalid JSON'}
+
+
+def read_batches(records: Iterable[dict], batch_size: int = BULK_IMPORT_BATCH_SIZE) -> Iterable[list]:
+    """
+    Groups records in batches of (line_no, record)
+    :param records: record iterator
+    :param batch_size: records per batch
+    :return: iterator of lists
+    """
+    batch = []
+    for line_no, record in enumerate(records, start=1):
+        batch.append((line_no, record))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ImportSummary:
+    """
+    Counters of a bulk import
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.errors = []
+
+    def add_error(self, line_no: int, message: str) -> None:
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f'row {line_no}: {message}')
+
+    def to_dict(self) -> dict:
+        seconds = time.perf_counter() - self.started
+        return {
+            'rows': self.rows,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'seconds': round(seconds, 3),
+            'rows_per_sec': round(self.rows / seconds, 1) if seconds else 0
+        }
+
+
+def _parse_product(record: dict) -> tuple:
+    if '_error' in record:
+        raise ValueError(record['_error'])
+    name = (record.get('name') or '').strip()
+    sku = (record.get('sku') or '').strip()
+    category = (record.get('category') or '').strip()
+    price = float(record.get('price') or 0)
+    if not name or not sku or not category or price <= 0:
+        raise ValueError('name, sku, category and a positive price are required')
+
+    return sku, name, price, category
+
+
+def _parse_stock(record: dict) -> tuple:
+    if '_error' in record:
+        raise ValueError(record['_error'])
+    sku = (record.get('sku') or '').strip()
+    stock = int(record.get('stock') or 0)
+    if not sku or stock <= 0:
+        raise ValueError('sku and a positive stock are required')
+
+    return sku, stock
+
+
+async def import_product_batch(db: AsyncSession, batch: list, summary: ImportSummary) -> None:
+    """
+    Upserts a batch of products by SKU in one transaction
+    :param db: DB Session
+    :param batch: list of (line_no, record) with name, sku, price, category
+    :param summary: import summary to update
+    :return:
+    """
+    products = {}
+    for line_no, record in batch:
+        summary.rows += 1
+        try:
+            sku, name, price, category = _parse_product(record)
+        except (TypeError, ValueError) as e:
+            summary.add_error(line_no, str(e))
+            continue
+        # Last line of a repeated SKU wins
+        products[sku] = (line_no, name, price, category)
+
+    # Resolve categories and existing SKUs with one query each
+    category_names = {category for _, _, _, category in products.values()}
+    categories = dict((await db.execute(
+        select(Category.cat_name, Category.id).where(Category.cat_name.in_(category_names))
+    )).all()) if category_names else {}
+    existing = {sku: (product_id, category_id) for sku, product_id, category_id in (await db.execute(
+        select(Product.sku, Product.id, Product.category_id).where(Product.sku.in_(products.keys()))
+    )).all()} if products else {}
+
+    new_rows, updated_rows, recategorized = [], [], {}
+    for sku, (line_no, name, price, category) in products.items():
+        if category not in categories:
+            summary.add_error(line_no, f'category {category} not found')
+            continue
+        row = {'product_name': name, 'price': price, 'category_id': categories[category]}
+        if sku in existing:
+            product_id, category_id = existing[sku]
+            updated_rows.append({'id': product_id, **row})
+            if category_id != categories[category]:
+                recategorized[product_id] = categories[category]
+        else:
+            new_rows.append({'sku': sku, **row})
+
+    if new_rows:
+        await db.execute(insert(Product), new_rows)
+    if updated_rows:
+        await db.execute(update(Product), updated_rows)
+        # Renamed or recategorized products
+        await refresh_stock_snapshot(db, [row['id'] for row in updated_rows])
+        await recategorize_rollups(db, recategorized)
+    await db.commit()
+    invalidate_products(products.keys())
+
+    summary.inserted += len(new_rows)
+    summary.updated += len(updated_rows)
+
+
+async def import_stock_batch(db: AsyncSession, batch: list, summary: ImportSummary) -> None:
+    """
+    Adds a batch of stock to inventory by SKU in one transaction, recording an InventoryStatus entry per product
+    :param db: DB Session
+    :param batch: list of (line_no, record) with sku, stock
+    :param summary: import summary to update
+    :return:
+    """
+    quantities, lines = {}, {}
+    for line_no, record in batch:
+        summary.rows += 1
+        try:
+            sku, stock = _parse_stock(record)
+        except (TypeError, ValueError) as e:
+            summary.add_error(line_no, str(e))
+            continue
+        # Repeated SKUs add up
+        quantities[sku] = quantities.get(sku, 0) + stock
+        lines[sku] = line_no
+
+    # Resolve SKUs and existing inventory rows with one query each
+    product_ids = dict((await db.execute(
+        select(Product.sku, Product.id).where(Product.sku.in_(quantities.keys()))
+    )).all()) if quantities else {}
+    for sku in quantities.keys() - product_ids.keys():
+        summary.add_error(lines[sku], f'product {sku} not found')
+    stock = {product_ids[sku]: quantity for sku, quantity in quantities.items() if sku in product_ids}
+    stocked = set((await db.scalars(
+        select(Inventory.product_id).where(Inventory.product_id.in_(stock.keys()))
+    )).all()) if stock else set()
+
+    inventory = Inventory.__table__
+    updated_rows = [{'b_product_id': product_id, 'b_stock': quantity}
+                    for product_id, quantity in stock.items() if product_id in stocked]
+    new_rows = [{'product_id': product_id, 'stock': quantity}
+                for product_id, quantity in stock.items() if product_id not in stocked]
+
+    if updated_rows:
+        await db.execute(
+            update(inventory)
+            .where(inventory.c.product_id == bindparam('b_product_id'))
+            .values(stock=inventory.c.stock + bindparam('b_stock')),
+            updated_rows
+        )
+    if new_rows:
+        await db.execute(insert(Inventory), new_rows)
+    if stock:
+        await db.execute(insert(InventoryStatus), [{
+            'product_id': product_id,
+            'operation': 'add',
+            'pieces': quantity
+        } for product_id, quantity in stock.items()])
+        await refresh_stock_snapshot(db, stock.keys())
+    await db.commit()
+
+    summary.inserted += len(new_rows)
+    summary.updated += len(updated_rows)
+
+
+async def run_import(db: AsyncSession, records: Iterable[dict], import_batch: Callable,
+                     batch_size: int = BULK_IMPORT_BATCH_SIZE, progress: Optional[Callable] = None) -> dict:
+    """
+    Imports records in batched transactions
+    :param db: DB Session
+    :param records: record iterator
+    :param import_batch: import_product_batch or import_stock_batch
+    :param batch_size: records per transaction
+    :param progress: optional callback receiving the summary dict after each batch
+    :return: summary dict
+    """
+    summary = ImportSummary()
+    for batch in read_batches(records, batch_size):
+        rows, skipped, errors = summary.rows, summary.skipped, len(summary.errors)
+        try:
+            await import_batch(db, batch, summary)
+        except Exception as e:
+            # A failed batch is rolled back and reported as a whole, the next batches still run
+            await db.rollback()
+            summary.rows, summary.skipped = rows + len(batch), skipped
+            del summary.errors[errors:]
+            for line_no, _ in batch:
+                summary.add_error(line_no, f'batch failed: {e}')
+        if progress:
+            progress(summary.to_dict())
+
+    return summary.to_dict()
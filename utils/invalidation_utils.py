@@ -0,0 +1,133 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import socket
+from typing import Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Directory of the worker sockets, set by the multi-worker server for its workers. Unset means one process
+INVALIDATION_SOCKET_DIR = os.environ.get('INVALIDATION_SOCKET_DIR', '')
+
+# Larger messages invalidate the whole channel instead, macOS drops datagrams over 2KB by default
+MAX_MESSAGE_SIZE = 2048
+RECEIVE_SIZE = 65536
+
+
+class InvalidationChannel:
+    """
+    Cross-worker cache invalidation over unix datagram sockets, no broker needed. Every worker binds
+    <directory>/<pid>.sock and publish() sends the invalidated keys to every other socket of the
+    directory, where the handler subscribed to the channel drops them from the local caches.
+    Delivery is best effort: a message lost to a full receive buffer leaves the entry until its TTL.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.handlers = {}
+        self.sock: Optional[socket.socket] = None
+        self.path = ''
+
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+
+    @property
+    def running(self) -> bool:
+        return self.sock is not None
+
+    def subscribe(self, channel: str, handler: Callable[[Optional[list]], None]) -> None:
+        """
+        Registers the local invalidation of a channel
+        :param channel: channel name e.g. products
+        :param handler: called with the invalidated keys, None for every key
+        :return:
+        """
+        self.handlers[channel] = handler
+
+    async def start(self) -> None:
+        """
+        Binds the socket of this worker and starts receiving, a no-op in single process mode
+        :return:
+        """
+        if not self.directory or not hasattr(socket, 'AF_UNIX'):
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f'{os.getpid()}.sock')
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._receive)
+
+    async def stop(self) -> None:
+        if not self.running:
+            return
+
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def publish(self, channel: str, keys: Optional[Iterable] = None) -> None:
+        """
+        Sends invalidated keys to the other workers
+        :param channel: channel name
+        :param keys: invalidated keys, None for every key
+        :return:
+        """
+        if not self.running:
+            return
+
+        message = json.dumps({'channel': channel, 'keys': None if keys is None else list(keys)}).encode()
+        if len(message) > MAX_MESSAGE_SIZE:
+            message = json.dumps({'channel': channel, 'keys': None}).encode()
+
+        for path in glob.glob(os.path.join(self.directory, '*.sock')):
+            if path == self.path:
+                continue
+            try:
+                self.sock.sendto(message, path)
+                self.published += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Socket of a worker that died without cleaning up
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                self.dropped += 1
+                logger.warning('Invalidation of %s dropped, receive buffer of %s is full', channel, path)
+
+    def _receive(self) -> None:
+        while True:
+            try:
+                message = self.sock.recv(RECEIVE_SIZE)
+            except BlockingIOError:
+                return
+
+            self.received += 1
+            try:
+                payload = json.loads(message)
+                handler = self.handlers.get(payload['channel'])
+                if handler is not None:
+                    handler(payload['keys'])
+            except Exception:
+                logger.exception('Failed to apply invalidation message %r', message)
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'workers': len(glob.glob(os.path.join(self.directory, '*.sock'))) if self.running else 1,
+            'published': self.published,
+            'received': self.received,
+            'dropped': self.dropped
+        }
+
+
+invalidation_channel = InvalidationChannel(INVALIDATION_SOCKET_DIR)
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_utils import AsyncSessionLocal, InventoryStatus, LedgerEntry, Product, Sale
+from utils.rollup_utils import add_sales_to_rollups
+
+logger = logging.getLogger(__name__)
+
+# sync writes sale rows in the request transaction, write_behind queues them for batched commits
+SALES_LEDGER_MODE = os.environ.get('SALES_LEDGER_MODE', 'sync')
+LEDGER_BATCH_SIZE = int(os.environ.get('LEDGER_BATCH_SIZE', 500))
+LEDGER_FLUSH_INTERVAL_MS = int(os.environ.get('LEDGER_FLUSH_INTERVAL_MS', 50))
+LEDGER_QUEUE_SIZE = int(os.environ.get('LEDGER_QUEUE_SIZE', 10000))
+# Seconds between checks for entries no worker has queued, e.g. of a request cancelled right after its commit
+LEDGER_SWEEP_INTERVAL = int(os.environ.get('LEDGER_SWEEP_INTERVAL', 60))
+# Seconds stop() waits for queued entries, entries left are flushed on the next startup
+LEDGER_STOP_TIMEOUT = int(os.environ.get('LEDGER_STOP_TIMEOUT', 10))
+
+LEDGER_RETRY_DELAY = 1  # seconds, doubled up to LEDGER_RETRY_DELAY_MAX while the database is failing
+LEDGER_RETRY_DELAY_MAX = 30
+
+
+class SalesLedger:
+    """
+    Write-behind ledger of Sale and InventoryStatus rows. A sale inserts one ledger_entry row with its
+    sold lines in the transaction of its stock decrement, so the decrement never commits without its
+    sale, and queues the entry once committed. A background task turns queued entries into sales,
+    inventory_status and rollup rows in multi-row batches every flush interval or batch size entries,
+    whichever comes first, deleting the entries in the same transaction. Entries left in the table
+    (a crash, a cancelled request) are flushed on startup and by the periodic sweep.
+    The queue is bounded, a full queue makes wait_for_room() wait for the flusher.
+
+    Flushing claims entries by deleting them, server workers sweeping the same entries never insert
+    a sale twice.
+
+    Each sale still commits its own transaction (stock decrement, snapshot and ledger_entry insert), only
+    the sales, inventory_status and rollup inserts are batched. The per-sale commit stays on the request
+    path, which is why the gain over sync mode is modest (about 84 to 110-120 sales/s in the benchmarks).
+    """
+
+    def __init__(self, batch_size: int, flush_interval_ms: int, queue_size: int, sweep_interval: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue_size = queue_size
+        self.sweep_interval = sweep_interval
+
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        # Ids of queued entries, and the last entry id of the previous sweep
+        self.queued = set()
+        self.swept_upto = 0
+        self.next_sweep = 0
+
+        self.recorded = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.replayed = 0
+        self.swept = 0
+        self.last_flush_ms = 0
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None
+
+    async def start(self) -> None:
+        """
+        Flushes the entries of sales committed before the last stop, then starts the flusher
+        :return:
+        """
+        self.queue = asyncio.Queue()
+        self.replayed = await self._flush_stored(None)
+        self.next_sweep = time.monotonic() + self.sweep_interval
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Flushes queued entries and stops the flusher, waiting at most LEDGER_STOP_TIMEOUT seconds. Entries
+        not flushed by then are kept in ledger_entry and flushed by the next startup or another worker's sweep
+        :return:
+        """
+        if not self.running:
+            return
+
+        try:
+            await asyncio.wait_for(self.queue.join(), LEDGER_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning('Sales ledger stopped with %s entries not flushed, they are flushed on the next startup',
+                           len(self.queued))
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def wait_for_room(self) -> None:
+        """
+        Holds a sale back while the queue is full, call it before the sale locks any stock row
+        :return:
+        """
+        while self.running and self.queue.qsize() >= self.queue_size:
+            await asyncio.sleep(self.flush_interval)
+
+    async def record(self, db: AsyncSession, sale_lines: list, sale_time: datetime) -> dict:
+        """
+        Inserts the ledger entry of a sale in the caller's transaction, queue_entry() it once that commits
+        :param db: DB Session of the stock decrement
+        :param sale_lines: list of (product_id, category_id, pieces, price_per_piece) tuples
+        :param sale_time: time of the sale
+        :return: ledger entry
+        """
+        lines = [list(line) for line in sale_lines]
+        result = await db.execute(insert(LedgerEntry).values(sale_time=sale_time, sale_lines=json.dumps(lines)))
+
+        return {'id': result.inserted_primary_key[0], 'sale_time': sale_time, 'lines': lines}
+
+    def queue_entry(self, entry: dict) -> None:
+        """
+        Queues the committed entry of a sale for the flusher
+        :param entry: entry returned by record()
+        :return:
+        """
+        self.queued.add(entry['id'])
+        self.queue.put_nowait(entry)
+        self.recorded += 1
+
+    async def _flush_stored(self, upto_id: Optional[int]) -> int:
+        """
+        Flushes stored entries this process has not queued
+        :param upto_id: last entry id to flush, every entry when None
+        :return: number of flushed entries
+        """
+        query = select(LedgerEntry.id, LedgerEntry.sale_time, LedgerEntry.sale_lines).order_by(LedgerEntry.id)
+        if upto_id is not None:
+            query = query.where(LedgerEntry.id <= upto_id)
+        async with AsyncSessionLocal() as db:
+            entries = [{'id': entry_id, 'sale_time': sale_time, 'lines': json.loads(lines)}
+                       for entry_id, sale_time, lines in (await db.execute(query)).all()
+                       if entry_id not in self.queued]
+
+        flushed = 0
+        for i in range(0, len(entries), self.batch_size):
+            flushed += await self._flush(entries[i:i + self.batch_size])
+
+        return flushed
+
+    async def _sweep(self) -> None:
+        """
+        Flushes entries already stored at the previous sweep and still not queued, those of a request
+        cancelled between its commit and queue_entry(). Entries queued by another worker get claimed
+        by whichever flush comes first
+        :return:
+        """
+        async with AsyncSessionLocal() as db:
+            last_id = await db.scalar(select(func.max(LedgerEntry.id))) or 0
+        if self.swept_upto:
+            self.swept += await self._flush_stored(self.swept_upto)
+        self.swept_upto = last_id
+
+    async def _flush(self, batch: list) -> int:
+        """
+        Claims a batch of entries by deleting them and inserts their rows in the same transaction.
+        Entries another worker flushed first are skipped
+        :param batch: ledger entries
+        :return: number of flushed entries
+        """
+        started = time.perf_counter()
+        ids = [entry['id'] for entry in batch]
+        stored = None
+        async with AsyncSessionLocal() as db:
+            try:
+                claimed = (await db.execute(delete(LedgerEntry).where(LedgerEntry.id.in_(ids)))).rowcount
+                if claimed != len(ids):
+                    await db.rollback()
+                    stored = set((await db.scalars(select(LedgerEntry.id).where(LedgerEntry.id.in_(ids)))).all())
+                    await db.rollback()
+                else:
+                    # Categories as of the flush, a bulk import may have moved products since the sale
+                    product_ids = {line[0] for entry in batch for line in entry['lines']}
+                    categories = dict((await db.execute(
+                        select(Product.id, Product.category_id).where(Product.id.in_(product_ids))
+                    )).all())
+                    sales, statuses, rollups = [], [], []
+                    for entry in batch:
+                        sale_time = entry['sale_time']
+                        for product_id, _, pieces, price_per_piece in entry['lines']:
+                            sales.append({'product_id': product_id, 'price_per_piece': price_per_piece,
+                                          'pieces': pieces, 'sale_time': sale_time})
+                            statuses.append({'product_id': product_id, 'operation': 'remove', 'pieces': pieces,
+                                             'operation_date': sale_time})
+                            rollups.append((product_id, categories[product_id], pieces, pieces * price_per_piece,
+                                            sale_time))
+
+                    await db.execute(insert(InventoryStatus), statuses)
+                    await db.execute(insert(Sale), sales)
+                    await add_sales_to_rollups(db, rollups)
+                    await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+
+        if stored is not None:
+            # Retry with the entries left
+            batch = [entry for entry in batch if entry['id'] in stored]
+            return await self._flush(batch) if batch else 0
+
+        self.flushed += len(batch)
+        self.batches += 1
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+        return len(batch)
+
+    async def _run(self) -> None:
+        """
+        Flusher loop, a failed batch is retried until it commits so entries are never dropped
+        :return:
+        """
+        while True:
+            if time.monotonic() >= self.next_sweep:
+                try:
+                    await self._sweep()
+                except Exception:
+                    logger.exception('Sales ledger sweep failed')
+                self.next_sweep = time.monotonic() + self.sweep_interval
+
+            try:
+                batch = [await asyncio.wait_for(self.queue.get(), max(self.next_sweep - time.monotonic(), 0))]
+            except asyncio.TimeoutError:
+                continue
+            # Give the batch time to fill unless it is already full
+            if self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            delay = LEDGER_RETRY_DELAY
+            while True:
+                try:
+                    await self._flush(batch)
+                    break
+                except Exception:
+                    self.failures += 1
+                    logger.exception('Sales ledger flush of %s entries failed, retrying in %ss', len(batch), delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, LEDGER_RETRY_DELAY_MAX)
+
+            for entry in batch:
+                self.queued.discard(entry['id'])
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        """
+        Returns queue depth and flush counters
+        :return: dict
+        """
+        return {
+            'mode': 'write_behind' if self.running else 'sync',
+            'queued': self.queue.qsize() if self.queue else 0,
+            'queue_size': self.queue_size,
+            'recorded': self.recorded,
+            'flushed': self.flushed,
+            'batches': self.batches,
+            'avg_batch': round(self.flushed / self.batches, 1) if self.batches else 0,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'failures': self.failures,
+            'replayed': self.replayed,
+            'swept': self.swept
+        }
+
+
+async def pending_ledger_pieces(db: AsyncSession) -> dict:
+    """
+    Pieces per product whose stock is already decremented but whose ledger entries are not flushed yet,
+    of every server worker
+    :param db: DB Session
+    :return: dict of product_id to pieces
+    """
+    pending = defaultdict(int)
+    for lines in (await db.scalars(select(LedgerEntry.sale_lines))).all():
+        for product_id, _, pieces, _ in json.loads(lines):
+            pending[product_id] += pieces
+
+    return dict(pending)
+
+
+sales_ledger = SalesLedger(LEDGER_BATCH_SIZE, LEDGER_FLUSH_INTERVAL_MS, LEDGER_QUEUE_SIZE, LEDGER_SWEEP_INTERVAL)
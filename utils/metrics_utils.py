@@ -0,0 +1,233 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+
+slow_query_logger = logging.getLogger('slow_query')
+
+# Statements slower than this are logged with their route, 0 disables the log
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_LOG_LENGTH = 1000  # characters of the statement logged
+
+# Request latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RequestStats:
+    """
+    DB and serialization work of the request being served, filled in by engine events and the
+    JSON response classes through current_request_stats
+    """
+    __slots__ = ('route', 'statements', 'db_time', 'rows', 'serialization_time')
+
+    def __init__(self, route: str = ''):
+        self.route = route
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.serialization_time = 0.0
+
+
+current_request_stats: ContextVar[Optional[RequestStats]] = ContextVar('current_request_stats', default=None)
+
+
+def record_serialization(seconds: float) -> None:
+    """
+    Adds response serialization time to the current request
+    :param seconds: time spent rendering the body
+    :return:
+    """
+    stats = current_request_stats.get()
+    if stats is not None:
+        stats.serialization_time += seconds
+
+
+class QueryMetrics:
+    """
+    Statement counters of the engines it is attached to. Work is added to the current request and
+    statements slower than SLOW_QUERY_MS are logged. Rows are the driver row count, which
+    buffered MySQL cursors report for selects and SQLite only for writes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.statements = 0
+        self.db_time = 0.0
+        self.slow_queries = 0
+
+    def attach(self, engine) -> None:
+        """
+        Starts timing the statements of an engine
+        :param engine: sync Engine (use async_engine.sync_engine for async engines)
+        :return:
+        """
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_started'].pop()
+        with self._lock:
+            self.statements += 1
+            self.db_time += seconds
+
+        stats = current_request_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_time += seconds
+            stats.rows += max(cursor.rowcount, 0)
+
+        if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+            with self._lock:
+                self.slow_queries += 1
+            slow_query_logger.warning('%.1fms %s %s', seconds * 1000, stats.route if stats else '-',
+                                      ' '.join(statement.split())[:SLOW_QUERY_LOG_LENGTH])
+
+
+class RouteMetrics:
+    """
+    Per route request counters and latency histogram
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.statuses = {}
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.serialization_time = 0.0
+
+
+class RequestMetrics:
+    """
+    Request metrics of every route, rendered in the Prometheus text format
+    """
+
+    def __init__(self, query_metrics: QueryMetrics):
+        self._lock = threading.Lock()
+        self.query_metrics = query_metrics
+        self.routes = {}
+
+    def observe(self, method: str, route: str, status: int, seconds: float, stats: RequestStats) -> None:
+        """
+        Records a served request
+        :param method: HTTP method
+        :param route: route path
+        :param status: response status code
+        :param seconds: request latency
+        :param stats: DB and serialization work of the request
+        :return:
+        """
+        with self._lock:
+            metrics = self.routes.get((method, route))
+            if metrics is None:
+                metrics = self.routes[(method, route)] = RouteMetrics()
+            metrics.count += 1
+            bucket = bisect_left(LATENCY_BUCKETS, seconds)
+            if bucket < len(LATENCY_BUCKETS):
+                metrics.latency_buckets[bucket] += 1
+            metrics.latency_sum += seconds
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.statements += stats.statements
+            metrics.db_time += stats.db_time
+            metrics.rows += stats.rows
+            metrics.serialization_time += stats.serialization_time
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text exposition format
+        :return: str
+        """
+        lines = [
+            '# HELP http_request_duration_seconds Request latency',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        counters = {
+            'http_requests_total': ('Requests served', []),
+            'db_statements_total': ('SQL statements executed by requests', []),
+            'db_query_seconds_total': ('Time requests spent in SQL statements', []),
+            'db_rows_total': ('Rows reported by the driver for request statements', []),
+            'response_serialization_seconds_total': ('Time spent rendering JSON bodies', []),
+        }
+        with self._lock:
+            for (method, route), metrics in sorted(self.routes.items()):
+                labels = f'method="{method}",route="{route}"'
+                cumulative = 0
+                for le, count in zip(LATENCY_BUCKETS, metrics.latency_buckets):
+                    cumulative += count
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines += [
+                    f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {metrics.count}',
+                    f'http_request_duration_seconds_sum{{{labels}}} {metrics.latency_sum}',
+                    f'http_request_duration_seconds_count{{{labels}}} {metrics.count}',
+                ]
+                for status, count in sorted(metrics.statuses.items()):
+                    counters['http_requests_total'][1].append(f'{{{labels},status="{status}"}} {count}')
+                counters['db_statements_total'][1].append(f'{{{labels}}} {metrics.statements}')
+                counters['db_query_seconds_total'][1].append(f'{{{labels}}} {metrics.db_time}')
+                counters['db_rows_total'][1].append(f'{{{labels}}} {metrics.rows}')
+                counters['response_serialization_seconds_total'][1].append(
+                    f'{{{labels}}} {metrics.serialization_time}')
+
+        for name, (description, samples) in counters.items():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+            lines += [f'{name}{sample}' for sample in samples]
+
+        lines += [
+            '# HELP db_slow_queries_total Statements slower than SLOW_QUERY_MS',
+            '# TYPE db_slow_queries_total counter',
+            f'db_slow_queries_total {self.query_metrics.slow_queries}',
+            '# HELP db_statements_all_total SQL statements executed, background work included',
+            '# TYPE db_statements_all_total counter',
+            f'db_statements_all_total {self.query_metrics.statements}',
+        ]
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request and collecting its DB and serialization work
+    """
+
+    def __init__(self, app, metrics: RequestMetrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope['path'])
+        token = current_request_stats.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_request_stats.reset(token)
+            # The router adds the endpoint to the scope, unmatched paths share one label. Report cache hits are
+            # answered before routing
+            route = scope['path'] if 'endpoint' in scope or scope.get('report_cache_hit') else 'unmatched'
+            self.metrics.observe(scope['method'], route, status, time.perf_counter() - started, stats)
+
+
+query_metrics = QueryMetrics()
+request_metrics = RequestMetrics(query_metrics)
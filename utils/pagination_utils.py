@@ -0,0 +1,92 @@
+import csv
+import io
+from typing import AsyncIterable, Optional, Sequence
+
+import orjson
+
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from constants import STREAM_BATCH_SIZE
+
+STREAM_MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+async def paginate(db: AsyncSession, query: Select, id_column, limit: Optional[int], cursor: int = 0) -> tuple:
+    """
+    Keyset paginates a query on an increasing id column
+    :param db: DB Session
+    :param query: query to paginate
+    :param id_column: id column the keyset is built on
+    :param limit: page size, None returns every row after the cursor
+    :param cursor: last id of the previous page
+    :return: (rows, next_cursor), next_cursor is None on the last page
+    """
+    query = query.where(id_column > cursor).order_by(id_column)
+    if not limit:
+        return (await db.execute(query)).all(), None
+
+    # Fetch one row extra to know if there is a next page
+    rows = (await db.execute(query.limit(limit + 1))).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, rows[-1].id
+
+
+async def _ndjson_lines(rows: AsyncIterable, fields: Sequence[str]) -> AsyncIterable[bytes]:
+    """
+    Yields NDJSON chunks of STREAM_BATCH_SIZE rows, encoded with orjson like the JSON responses
+    """
+    chunk = []
+    async for row in rows:
+        chunk.append(orjson.dumps(dict(zip(fields, row)), default=str))
+        if len(chunk) >= STREAM_BATCH_SIZE:
+            yield b'\n'.join(chunk) + b'\n'
+            chunk = []
+    if chunk:
+        yield b'\n'.join(chunk) + b'\n'
+
+
+async def _csv_lines(rows: AsyncIterable, fields: Sequence[str]) -> AsyncIterable[str]:
+    """
+    Yields CSV chunks of STREAM_BATCH_SIZE rows after the header, which is sent even when there are no rows
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    count = 0
+    async for row in rows:
+        # Columns past the last field (keyset ids) are left out
+        writer.writerow(row[:len(fields)])
+        count += 1
+        if count % STREAM_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+async def stream_query(db: AsyncSession, query: Select, id_column, fields: Sequence[str], response_format: str,
+                       cursor: int = 0) -> StreamingResponse:
+    """
+    Streams query rows as NDJSON or CSV, reading them in yield_per batches so memory stays flat
+    :param db: DB Session
+    :param query: query to stream
+    :param id_column: id column rows are ordered on
+    :param fields: output key of each row column
+    :param response_format: ndjson or csv
+    :param cursor: only rows after this id are streamed
+    :return: StreamingResponse
+    """
+    query = query.where(id_column > cursor).order_by(id_column).execution_options(yield_per=STREAM_BATCH_SIZE)
+    rows = await db.stream(query)
+    lines = _csv_lines(rows, fields) if response_format == 'csv' else _ndjson_lines(rows, fields)
+
+    return StreamingResponse(lines, media_type=STREAM_MEDIA_TYPES[response_format])
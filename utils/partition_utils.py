@@ -0,0 +1,153 @@
+import argparse
+from datetime import date, datetime
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+import db_utils
+
+# Tables partitioned by calendar month of their time column, the ranges every report filters on
+PARTITIONED_TABLES = {
+    'sales': 'sale_time',
+    'inventory_status': 'operation_date',
+}
+# Empty partitions kept ahead of the current month, run the maintenance before they run out
+PARTITION_MONTHS_AHEAD = 3
+# Catch-all partition, rows past the last month land there until it is split
+OVERFLOW_PARTITION = 'pmax'
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'p{month:%Y%m}'
+
+
+def _month_definitions(months: list) -> str:
+    definitions = [f"PARTITION {partition_name(month)} VALUES LESS THAN ('{add_months(month, 1)}')"
+                   for month in months]
+    definitions.append(f'PARTITION {OVERFLOW_PARTITION} VALUES LESS THAN (MAXVALUE)')
+    return ', '.join(definitions)
+
+
+def month_partitions(connection: Connection, table: str) -> list:
+    """
+    Month partitions of a table
+    :param connection: DB connection
+    :param table: table name
+    :return: list of first days of the partitioned months, empty when the table is not partitioned
+    """
+    names = connection.execute(text(
+        'SELECT partition_name FROM information_schema.partitions '
+        'WHERE table_schema = DATABASE() AND table_name = :table AND partition_name IS NOT NULL'
+    ), {'table': table}).scalars().all()
+
+    return sorted(datetime.strptime(name, 'p%Y%m').date() for name in names if name != OVERFLOW_PARTITION)
+
+
+def partition_table_statements(connection: Connection, table: str, column: str, last_month: date) -> list:
+    """
+    Statements partitioning a table by month, from the month of its oldest row to last_month.
+    MySQL partitioned tables can't have foreign keys and every unique key has to hold the partitioning
+    column, the foreign keys are dropped (the app checks products itself) and the primary key becomes
+    (id, time column). Each statement rebuilds the table, run it in a maintenance window
+    :param connection: DB connection
+    :param table: table name
+    :param column: time column
+    :param last_month: last month getting its own partition
+    :return: list of SQL statements
+    """
+    oldest = connection.execute(text(f'SELECT MIN({column}) FROM {table}')).scalar() or datetime.today()
+    months = [date(oldest.year, oldest.month, 1)]
+    while months[-1] < last_month:
+        months.append(add_months(months[-1], 1))
+
+    foreign_keys = connection.execute(text(
+        "SELECT constraint_name FROM information_schema.table_constraints "
+        "WHERE table_schema = DATABASE() AND table_name = :table AND constraint_type = 'FOREIGN KEY'"
+    ), {'table': table}).scalars().all()
+
+    statements = [f'ALTER TABLE {table} DROP FOREIGN KEY {name}' for name in foreign_keys]
+    statements += [
+        f'ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id, {column})',
+        f'ALTER TABLE {table} PARTITION BY RANGE COLUMNS({column}) ({_month_definitions(months)})',
+    ]
+    return statements
+
+
+def add_partition_statements(table: str, partitions: list, last_month: date) -> list:
+    """
+    Statement splitting the months up to last_month out of the overflow partition, it holds no rows while
+    the maintenance runs ahead of time so the split is instant
+    :param table: table name
+    :param partitions: existing month partitions
+    :param last_month: last month getting its own partition
+    :return: list of SQL statements, empty when the months exist
+    """
+    months = []
+    month = add_months(partitions[-1], 1)
+    while month <= last_month:
+        months.append(month)
+        month = add_months(month, 1)
+    if not months:
+        return []
+
+    return [f'ALTER TABLE {table} REORGANIZE PARTITION {OVERFLOW_PARTITION} INTO ({_month_definitions(months)})']
+
+
+def maintain_partitions(connection: Connection, months_ahead: int = PARTITION_MONTHS_AHEAD,
+                        dry_run: bool = False) -> dict:
+    """
+    Partitions the sales and inventory_status tables by month on first run, later runs add the partitions
+    of the coming months. Queries on a sale_time/operation_date range then only read the partitions of
+    that range (partition pruning), run it monthly
+    :param connection: DB connection
+    :param months_ahead: months after the current one that get a partition
+    :param dry_run: return the statements without running them
+    :return: dict of table to executed statements
+    """
+    if connection.dialect.name != 'mysql':
+        raise ValueError(f'Partitioning is only supported on MySQL, not {connection.dialect.name}')
+
+    today = date.today()
+    last_month = add_months(date(today.year, today.month, 1), months_ahead)
+    executed = {}
+    for table, column in PARTITIONED_TABLES.items():
+        partitions = month_partitions(connection, table)
+        if partitions:
+            statements = add_partition_statements(table, partitions, last_month)
+        else:
+            statements = partition_table_statements(connection, table, column, last_month)
+
+        if not dry_run:
+            for statement in statements:
+                connection.execute(text(statement))
+        executed[table] = statements
+    connection.commit()
+
+    return executed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Partitions sales and inventory_status by month (MySQL)')
+    parser.add_argument('--months-ahead', type=int, default=PARTITION_MONTHS_AHEAD,
+                        help='future months to create partitions for')
+    parser.add_argument('--dry-run', action='store_true', help='print the statements without running them')
+    parser.add_argument('--url', help='database URL, DATABASE_URL if not given')
+    args = parser.parse_args()
+
+    if args.url:
+        db_utils.configure_database(args.url)
+    try:
+        with db_utils.get_engine().connect() as conn:
+            results = maintain_partitions(conn, args.months_ahead, args.dry_run)
+    except ValueError as e:
+        parser.error(str(e))
+
+    for table_name, table_statements in results.items():
+        print(f"{table_name}: {'up to date' if not table_statements else ''}")
+        for table_statement in table_statements:
+            print(f'  {table_statement};')
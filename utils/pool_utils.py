@@ -0,0 +1,98 @@
+import threading
+
+from sqlalchemy import event
+
+
+class PoolMetrics:
+    """
+    Connection pool counters of one engine. Checkout latency is recorded by the session
+    dependency, connect/invalidate counts come from pool events.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pool = None
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.checkout_time_total = 0.0
+        self.checkout_time_max = 0.0
+        self.connects = 0
+        self.invalidations = 0
+
+    def attach(self, engine) -> None:
+        """
+        Starts collecting metrics of an engine's pool
+        :param engine: sync Engine (use async_engine.sync_engine for async engines)
+        :return:
+        """
+        self.pool = engine.pool
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+        event.listen(engine, 'soft_invalidate', self._on_invalidate)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def is_exhausted(self) -> bool:
+        """
+        True when every pooled and overflow connection is checked out, so a checkout has to wait
+        :return: bool
+        """
+        if self.pool is None or not hasattr(self.pool, 'size'):
+            return False
+        max_overflow = getattr(self.pool, '_max_overflow', 0)
+        return self.pool.checkedout() >= self.pool.size() + max(max_overflow, 0)
+
+    def record_checkout(self, seconds: float, waited: bool) -> None:
+        """
+        Records the time a session waited to get its connection
+        :param seconds: checkout latency
+        :param waited: pool was exhausted when the checkout started
+        :return:
+        """
+        with self._lock:
+            self.checkouts += 1
+            self.waits += 1 if waited else 0
+            self.checkout_time_total += seconds
+            self.checkout_time_max = max(self.checkout_time_max, seconds)
+
+    def record_timeout(self) -> None:
+        """
+        Records a checkout that gave up after pool_timeout
+        :return:
+        """
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        """
+        Returns counters and current pool gauges
+        :return: dict
+        """
+        with self._lock:
+            data = {
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'checkout_latency_avg_ms': (self.checkout_time_total / self.checkouts * 1000) if self.checkouts else 0,
+                'checkout_latency_max_ms': self.checkout_time_max * 1000,
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+            }
+
+        # Gauges are only available on queue based pools
+        if self.pool is not None and hasattr(self.pool, 'checkedout'):
+            data.update({
+                'pool_size': self.pool.size(),
+                'in_use': self.pool.checkedout(),
+                'idle': self.pool.checkedin(),
+                'overflow': self.pool.overflow(),
+            })
+
+        return data
@@ -0,0 +1,134 @@
+from datetime import datetime
+
+from sqlalchemy import Integer, Select, String, cast, func, literal, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+from db_utils import Category, InventoryStatus, Product, Sale, StockSnapshot
+
+
+# Every builder selects only the columns its endpoint serializes and joins the related
+# tables in the same statement, so a list endpoint costs one query whatever the row count.
+
+
+def inventory_status_query(low_stock_only: bool = False, category_id: int = None, sku_prefix: str = '') -> Select:
+    """
+    Current stock of products read from the stock snapshot, every filter is an index lookup
+    :param low_stock_only: only products under their low stock threshold
+    :param category_id: Category filter
+    :param sku_prefix: SKU prefix filter
+    :return: Select of (id, product_name, sku, stock, low_stock_threshold, headroom), id is the product id
+    """
+    query = select(StockSnapshot.product_id.label('id'), StockSnapshot.product_name, StockSnapshot.sku,
+                   StockSnapshot.stock, StockSnapshot.low_stock_threshold, StockSnapshot.headroom)
+    if low_stock_only:
+        query = query.where(StockSnapshot.headroom < 0)
+    if category_id is not None:
+        query = query.where(StockSnapshot.category_id == category_id)
+    if sku_prefix:
+        query = query.where(StockSnapshot.sku.startswith(sku_prefix, autoescape=True))
+
+    return query
+
+
+def inventory_track_query(start: datetime, end: datetime) -> Select:
+    """
+    Inventory operations in a half-open time range
+    :param start: range start
+    :param end: range end, excluded (see range_utils.day_range)
+    :return: Select of (product_name, product_sku, pieces, operation, operation_date, id)
+    """
+    # id goes last, it is only used as the pagination key and not sent to clients
+    return (
+        select(Product.product_name, Product.sku.label('product_sku'), InventoryStatus.pieces,
+               InventoryStatus.operation, InventoryStatus.operation_date, InventoryStatus.id)
+        .join(Product, Product.id == InventoryStatus.product_id)
+        .where(InventoryStatus.operation_date >= start, InventoryStatus.operation_date < end)
+    )
+
+
+def sales_query(start: datetime, end: datetime, product_sku: str = '', category: str = '') -> Select:
+    """
+    Sale invoices in a half-open time range, optionally filtered on product and category
+    :param start: range start
+    :param end: range end, excluded (see range_utils.day_range)
+    :param product_sku: Product SKU filter
+    :param category: Category name filter
+    :return: Select of (id, product_name, pieces, price_per_piece, total, sale_time)
+    """
+    query = (
+        select(Sale.id, Product.product_name, Sale.pieces, Sale.price_per_piece,
+               (Sale.pieces * Sale.price_per_piece).label('total'), Sale.sale_time)
+        .join(Product, Product.id == Sale.product_id)
+        .where(Sale.sale_time >= start, Sale.sale_time < end)
+    )
+    if product_sku:
+        query = query.where(Product.sku == product_sku)
+    if category:
+        query = query.join(Category, Category.id == Product.category_id).where(Category.cat_name == category)
+
+    return query
+
+
+def category_list_query() -> Select:
+    """
+    Every category
+    :return: Select of (id, cat_name, cat_description)
+    """
+    return select(Category.id, Category.cat_name, Category.cat_description).order_by(Category.id)
+
+
+def product_list_query() -> Select:
+    """
+    Every product
+    :return: Select of (id, product_name, sku, price)
+    """
+    return select(Product.id, Product.product_name, Product.sku, Product.price).order_by(Product.id)
+
+
+DATE_BUCKETS = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+
+# strftime formats, understood by MySQL DATE_FORMAT and SQLite strftime alike
+_BUCKET_FORMATS = {
+    'hourly': '%Y-%m-%d %H:00:00',
+    'daily': '%Y-%m-%d 00:00:00',
+    'weekly': '%Y-%m-%d 00:00:00',
+    'monthly': '%Y-%m-01 00:00:00',
+    'yearly': '%Y-01-01 00:00:00',
+}
+
+
+class date_bucket(FunctionElement):
+    """
+    Start of the time bucket of a datetime column as a 'YYYY-MM-DD HH:MM:SS' string, so bucketing
+    runs in SQL. Weeks start on monday. Usage: date_bucket(Sale.sale_time, 'weekly')
+    """
+    type = String()
+    # The bucket is not part of the cache key, statements using it are not cached
+    inherit_cache = False
+
+    def __init__(self, column, bucket: str):
+        if bucket not in DATE_BUCKETS:
+            raise ValueError(f'Unknown bucket: {bucket}')
+        self.bucket = bucket
+        super().__init__(column)
+
+
+@compiles(date_bucket, 'mysql')
+def _mysql_date_bucket(element, compiler, **kw):
+    column = list(element.clauses)[0]
+    if element.bucket == 'weekly':
+        # WEEKDAY() is 0 for monday
+        column = func.subdate(column, func.weekday(column))
+    return compiler.process(func.date_format(column, literal(_BUCKET_FORMATS[element.bucket])), **kw)
+
+
+@compiles(date_bucket, 'sqlite')
+def _sqlite_date_bucket(element, compiler, **kw):
+    column = list(element.clauses)[0]
+    modifiers = []
+    if element.bucket == 'weekly':
+        # strftime('%w') is 0 for sunday, shift back to monday
+        weekday = (cast(func.strftime(literal('%w'), column), Integer) + 6) % 7
+        modifiers.append(literal('-') + cast(weekday, String) + literal(' days'))
+    return compiler.process(func.strftime(literal(_BUCKET_FORMATS[element.bucket]), column, *modifiers), **kw)
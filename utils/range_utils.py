@@ -0,0 +1,111 @@
+import asyncio
+import heapq
+import os
+from datetime import date, datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import db_utils
+from constants import MAX_RANGE_DAYS
+
+# Month chunks read at the same time by all requests of the process together, on a pool of that many connections
+# next to the request pool
+RANGE_QUERY_CONCURRENCY = int(os.environ.get('RANGE_QUERY_CONCURRENCY', 4))
+
+# Event loop and semaphore of the chunk sessions, a semaphore can't be shared between loops
+_chunk_sessions = (None, None)
+
+
+class RangeError(ValueError):
+    """
+    Date range a report can't be run on, the message is meant for the client
+    """
+
+
+def day_start(value: date) -> datetime:
+    return datetime(value.year, value.month, value.day)
+
+
+def day_range(start_date: date, end_date: date, max_days: Optional[int] = MAX_RANGE_DAYS) -> tuple:
+    """
+    Half-open datetime range of a start and end day, the end day included: [start 00:00, day after end 00:00).
+    Comparing a timestamp column to the end date itself would drop everything after midnight of the end day
+    :param start_date: first day
+    :param end_date: last day, included
+    :param max_days: longest range accepted, None for no limit
+    :return: (start, end) datetimes
+    """
+    if start_date > end_date:
+        raise RangeError('end_date is before start_date')
+    days = (end_date - start_date).days + 1
+    if max_days is not None and days > max_days:
+        raise RangeError(f'Range of {days} days is longer than {max_days} days, use mode=aggregate or the sales '
+                         f'exports for longer ranges')
+
+    return day_start(start_date), day_start(end_date) + timedelta(days=1)
+
+
+def month_chunks(start: datetime, end: datetime) -> list:
+    """
+    Splits a half-open range on calendar month boundaries, one chunk per monthly partition
+    :param start: range start
+    :param end: range end, excluded
+    :return: list of (start, end) datetimes
+    """
+    chunks = []
+    while start < end:
+        next_month = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+        chunks.append((start, min(next_month, end)))
+        start = next_month
+
+    return chunks
+
+
+def _parallel_chunks(db: AsyncSession) -> bool:
+    # SQLite runs in process, decoding rows and not the database is the bottleneck there
+    return RANGE_QUERY_CONCURRENCY > 1 and db.bind.dialect.name != 'sqlite'
+
+
+def _chunk_semaphore() -> asyncio.Semaphore:
+    global _chunk_sessions
+    loop = asyncio.get_running_loop()
+    if _chunk_sessions[0] is not loop:
+        # Chunks queue here instead of timing out on the pool
+        _chunk_sessions = (loop, asyncio.Semaphore(RANGE_QUERY_CONCURRENCY))
+
+    return _chunk_sessions[1]
+
+
+async def fetch_range(db: AsyncSession, build_query: Callable[[datetime, datetime], Select], start: datetime,
+                      end: datetime) -> list:
+    """
+    Rows of a range query, read one calendar month at a time and merged by id. Ranges over several months
+    run their month queries at once on sessions of the range engine, whose pool of RANGE_QUERY_CONCURRENCY
+    connections is shared by all requests, so a long report takes about as long as its largest month;
+    on partitioned tables each of them reads a single partition
+    :param db: DB Session, runs ranges within one month and every chunk when they can't run in parallel
+    :param build_query: builds the query of a (start, end) half-open chunk, its rows have an id column
+    :param start: range start
+    :param end: range end, excluded
+    :return: list of rows ordered by id
+    """
+    def chunk_query(chunk: tuple) -> Select:
+        query = build_query(*chunk)
+        return query.order_by(query.selected_columns.id)
+
+    chunks = month_chunks(start, end)
+    if len(chunks) < 2 or not _parallel_chunks(db):
+        chunk_rows = [(await db.execute(chunk_query(chunk))).all() for chunk in chunks]
+    else:
+        semaphore = _chunk_semaphore()
+
+        async def fetch_chunk(chunk: tuple) -> list:
+            async with semaphore, db_utils.RangeSessionLocal(RANGE_QUERY_CONCURRENCY) as chunk_db:
+                return (await chunk_db.execute(chunk_query(chunk))).all()
+
+        chunk_rows = await asyncio.gather(*[fetch_chunk(chunk) for chunk in chunks])
+
+    # Ids mostly follow time, but write-behind sales can land in an earlier month after later ones
+    return list(heapq.merge(*chunk_rows, key=lambda row: row.id))
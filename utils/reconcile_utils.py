@@ -0,0 +1,360 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Select, case, delete, func, insert, select, update
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import db_utils
+from db_utils import Inventory, InventoryBalance, InventoryStatus, LedgerCheckpoint, Product
+from utils.ledger_utils import pending_ledger_pieces
+from utils.stock_utils import refresh_stock_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Seconds between background runs of a server process, 0 leaves runs to the endpoint or the CLI
+RECONCILE_INTERVAL = int(os.environ.get('RECONCILE_INTERVAL', 0))
+# Repair of the background runs: stock, ledger or empty to only report drift
+RECONCILE_REPAIR = os.environ.get('RECONCILE_REPAIR', '')
+
+# stock rebuilds inventory stock from the ledger, ledger records the drift as ledger entries
+RECONCILE_REPAIRS = ('stock', 'ledger')
+RECONCILE_BATCH_SIZE = 1000  # rows per balance upsert and repair statement
+MAX_REPORTED_DRIFT = 1000
+
+# Last inventory_status id folded into inventory_balance, and the last id a run saw
+BALANCE_CHECKPOINT = 'inventory_reconcile'
+SEEN_CHECKPOINT = 'inventory_reconcile_seen'
+
+
+class CheckpointConflict(Exception):
+    """
+    Another process moved the reconciliation checkpoint first, its run already folded in the same rows
+    """
+
+
+def ledger_delta_query(after_id: int, upto_id: Optional[int] = None) -> Select:
+    """
+    Net stock change per product of the ledger rows after an id, with one grouped scan
+    :param after_id: last ledger id already counted
+    :param upto_id: last ledger id to count, every row if not given
+    :return: Select of (product_id, delta, entries)
+    """
+    delta = case((InventoryStatus.operation == 'add', InventoryStatus.pieces),
+                 (InventoryStatus.operation == 'remove', -InventoryStatus.pieces), else_=0)
+    query = (
+        select(InventoryStatus.product_id, func.sum(delta).label('delta'), func.count().label('entries'))
+        .where(InventoryStatus.id > after_id)
+        .group_by(InventoryStatus.product_id)
+    )
+    if upto_id is not None:
+        query = query.where(InventoryStatus.id <= upto_id)
+
+    return query
+
+
+def drift_query(after_id: int) -> Select:
+    """
+    Products whose stock differs from their ledger balance plus the ledger rows after the checkpoint.
+    One statement, so stock and ledger are read from the same snapshot
+    :param after_id: balance checkpoint
+    :return: Select of (product_id, sku, stock, ledger stock)
+    """
+    tail = ledger_delta_query(after_id).subquery()
+    ledger_stock = func.coalesce(InventoryBalance.balance, 0) + func.coalesce(tail.c.delta, 0)
+    return (
+        select(Inventory.product_id, Product.sku, Inventory.stock, ledger_stock)
+        .join(Product, Product.id == Inventory.product_id)
+        .outerjoin(InventoryBalance, InventoryBalance.product_id == Inventory.product_id)
+        .outerjoin(tail, tail.c.product_id == Inventory.product_id)
+        .where(Inventory.stock != ledger_stock)
+        .order_by(Inventory.product_id)
+    )
+
+
+async def _add_to_balances(db: AsyncSession, rows: list) -> None:
+    """
+    Adds ledger deltas to the balances, inserting missing ones
+    :param db: DB Session
+    :param rows: list of dicts (product_id, balance)
+    :return:
+    """
+    dialect = db.bind.dialect.name
+
+    # Single statement upsert where the dialect supports it
+    if dialect == 'mysql':
+        stmt = mysql.insert(InventoryBalance).values(rows)
+        await db.execute(stmt.on_duplicate_key_update(
+            balance=InventoryBalance.balance + stmt.inserted.balance, updated_at=func.now()
+        ))
+        return
+
+    if dialect == 'sqlite':
+        stmt = sqlite.insert(InventoryBalance).values(rows)
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=['product_id'],
+            set_={'balance': InventoryBalance.balance + stmt.excluded.balance, 'updated_at': func.now()},
+        ))
+        return
+
+    # Generic fallback: update and insert when nothing was there yet
+    for row in rows:
+        result = await db.execute(
+            update(InventoryBalance)
+            .where(InventoryBalance.product_id == row['product_id'])
+            .values(balance=InventoryBalance.balance + row['balance'], updated_at=func.now())
+        )
+        if not result.rowcount:
+            await db.execute(insert(InventoryBalance).values(**row))
+
+
+async def _read_checkpoint(db: AsyncSession, name: str) -> Optional[int]:
+    return await db.scalar(select(LedgerCheckpoint.last_seq).where(LedgerCheckpoint.name == name))
+
+
+async def _move_checkpoint(db: AsyncSession, name: str, current: Optional[int], value: int) -> None:
+    """
+    Moves a checkpoint only if it still is where this run read it
+    :param db: DB Session
+    :param name: checkpoint name
+    :param current: value read at the start of the run, None if there was none
+    :param value: new value
+    :return:
+    """
+    if current is None:
+        # A concurrent first run fails on the primary key
+        await db.execute(insert(LedgerCheckpoint).values(name=name, last_seq=value))
+        return
+
+    result = await db.execute(
+        update(LedgerCheckpoint)
+        .where(LedgerCheckpoint.name == name, LedgerCheckpoint.last_seq == current)
+        .values(last_seq=value, updated_at=datetime.now())
+    )
+    if not result.rowcount:
+        raise CheckpointConflict(f'Checkpoint {name} moved during the run')
+
+
+class InventoryReconciler:
+    """
+    Checks Inventory.stock against the InventoryStatus ledger. Each run folds the ledger rows after its
+    checkpoint into inventory_balance with one grouped SUM(CASE operation ...), so it reads the rows added
+    since the previous run instead of the whole history, then compares stock with balance plus the
+    unfolded tail in one statement.
+
+    A run only folds rows up to the last id the previous run saw: an insert still in flight at that time
+    may commit with a lower id than rows already visible, skipping past it would miss it for good.
+    Write-behind sales not flushed yet are taken into account through their ledger_entry rows, whichever
+    worker queued them. A sale committing between those reads and the comparison can still show as
+    drift for one run, which is why repairs only touch drift that the previous run found too.
+    """
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.last_run = None
+        self.drift = []
+        self.previous_drift = {}
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None
+
+    async def run(self, repair: str = '', rebuild: bool = False) -> dict:
+        """
+        Folds new ledger rows into the balances, reports drift and optionally repairs it
+        :param repair: stock, ledger or empty to only report
+        :param rebuild: recompute the balances from the whole ledger
+        :return: run summary
+        """
+        if repair and repair not in RECONCILE_REPAIRS:
+            raise ValueError(f'Unknown repair: {repair}')
+
+        async with self.lock:
+            async with db_utils.AsyncSessionLocal() as db:
+                try:
+                    return await self._run(db, repair, rebuild)
+                except Exception:
+                    await db.rollback()
+                    raise
+
+    async def _run(self, db: AsyncSession, repair: str, rebuild: bool) -> dict:
+        started_at, started = datetime.now(), time.perf_counter()
+
+        if rebuild:
+            await db.execute(delete(InventoryBalance))
+            await db.execute(delete(LedgerCheckpoint).where(
+                LedgerCheckpoint.name.in_([BALANCE_CHECKPOINT, SEEN_CHECKPOINT])))
+            await db.commit()
+            self.previous_drift = {}
+
+        checkpoint = await _read_checkpoint(db, BALANCE_CHECKPOINT)
+        seen = await _read_checkpoint(db, SEEN_CHECKPOINT)
+        last_id = await db.scalar(select(func.max(InventoryStatus.id))) or 0
+        # The first run folds everything there is
+        upto_id = max(seen if seen is not None else last_id, checkpoint or 0)
+
+        # Fold the settled ledger rows into the balances
+        entries, products = 0, 0
+        deltas = (await db.execute(ledger_delta_query(checkpoint or 0, upto_id))).all()
+        for start in range(0, len(deltas), RECONCILE_BATCH_SIZE):
+            rows = [{'product_id': product_id, 'balance': int(delta)}
+                    for product_id, delta, _ in deltas[start:start + RECONCILE_BATCH_SIZE]]
+            await _add_to_balances(db, rows)
+        for _, _, count in deltas:
+            entries += count
+            products += 1
+        await _move_checkpoint(db, BALANCE_CHECKPOINT, checkpoint, upto_id)
+        await _move_checkpoint(db, SEEN_CHECKPOINT, seen, last_id)
+        await db.commit()
+
+        # Compare stock with the ledger, queued write-behind sales are already off the stock
+        pending = await pending_ledger_pieces(db)
+        drift = {}
+        for product_id, sku, stock, ledger_stock in (await db.execute(drift_query(upto_id))).all():
+            ledger_stock = int(ledger_stock) - pending.get(product_id, 0)
+            if stock != ledger_stock:
+                drift[product_id] = {'product_id': product_id, 'sku': sku, 'stock': stock,
+                                     'ledger_stock': ledger_stock, 'drift': stock - ledger_stock}
+        for row in drift.values():
+            row['confirmed'] = self.previous_drift.get(row['product_id']) == row['drift']
+
+        repaired = 0
+        if repair:
+            confirmed = {product_id: row['drift'] for product_id, row in drift.items() if row['confirmed']}
+            repaired = await self._repair(db, confirmed, repair)
+            for product_id in confirmed:
+                del drift[product_id]
+
+        self.previous_drift = {product_id: row['drift'] for product_id, row in drift.items()}
+        self.drift = list(drift.values())[:MAX_REPORTED_DRIFT]
+        self.runs += 1
+        self.last_run = {
+            'started_at': started_at.isoformat(timespec='seconds'),
+            'seconds': round(time.perf_counter() - started, 3),
+            'rows_processed': entries,
+            'products_updated': products,
+            'checkpoint': upto_id,
+            'last_ledger_id': last_id,
+            'drift_products': len(drift),
+            'drift_units': sum(abs(row['drift']) for row in drift.values()),
+            'repair': repair or None,
+            'repaired': repaired
+        }
+
+        return self.last_run
+
+    @staticmethod
+    async def _repair(db: AsyncSession, drift: dict, repair: str) -> int:
+        """
+        Fixes drift in one transaction per batch of products
+        :param db: DB Session
+        :param drift: dict of product_id to stock minus ledger stock
+        :param repair: stock takes the ledger stock, ledger adds an entry making up the difference
+        :return: number of repaired products
+        """
+        product_ids = list(drift)
+        for start in range(0, len(product_ids), RECONCILE_BATCH_SIZE):
+            batch = {product_id: drift[product_id] for product_id in product_ids[start:start + RECONCILE_BATCH_SIZE]}
+            if repair == 'stock':
+                # Relative to the current stock, sales since the check moved stock and ledger alike
+                drift_case = case(batch, value=Inventory.product_id)
+                await db.execute(
+                    update(Inventory)
+                    .where(Inventory.product_id.in_(batch.keys()))
+                    .values(stock=Inventory.stock - drift_case)
+                    .execution_options(synchronize_session=False)
+                )
+                await refresh_stock_snapshot(db, batch.keys())
+            else:
+                await db.execute(insert(InventoryStatus), [{
+                    'product_id': product_id,
+                    'operation': 'add' if units > 0 else 'remove',
+                    'pieces': abs(units)
+                } for product_id, units in batch.items()])
+            await db.commit()
+
+        return len(product_ids)
+
+    async def start(self, interval: int = RECONCILE_INTERVAL, repair: str = RECONCILE_REPAIR) -> None:
+        """
+        Runs the reconciliation every interval seconds in the background, a no-op when interval is 0
+        :param interval: seconds between runs
+        :param repair: repair of every run
+        :return:
+        """
+        if interval > 0:
+            self.task = asyncio.create_task(self._loop(interval, repair))
+
+    async def stop(self) -> None:
+        if not self.running:
+            return
+
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _loop(self, interval: int, repair: str) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.run(repair)
+            except CheckpointConflict:
+                # Another worker ran it at the same time
+                pass
+            except Exception:
+                logger.exception('Inventory reconciliation failed')
+
+    def stats(self) -> dict:
+        """
+        Returns the last run and the drift it found
+        :return: dict
+        """
+        return {
+            'background': self.running,
+            'runs': self.runs,
+            'last_run': self.last_run,
+            'drift': self.drift
+        }
+
+
+inventory_reconciler = InventoryReconciler()
+
+
+async def _run_cli(args) -> InventoryReconciler:
+    reconciler = InventoryReconciler()
+    await reconciler.run(rebuild=args.rebuild)
+    # Repairs need the drift confirmed by a second run
+    if args.repair:
+        await asyncio.sleep(args.confirm_delay)
+        await reconciler.run(args.repair)
+    await db_utils.dispose_engines()
+
+    return reconciler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks inventory stock against the inventory_status ledger')
+    parser.add_argument('--repair', choices=RECONCILE_REPAIRS,
+                        help='stock rebuilds stock from the ledger, ledger adds entries making up the drift')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the balances from the whole ledger')
+    parser.add_argument('--confirm-delay', type=float, default=5,
+                        help='seconds between the check and the repair run, drift has to show in both')
+    parser.add_argument('--url', help='database URL, DATABASE_URL if not given')
+    args = parser.parse_args()
+
+    if args.url:
+        db_utils.configure_database(args.url)
+    reconciler = asyncio.run(_run_cli(args))
+    for row in reconciler.drift:
+        print(f"{row['sku']}: stock {row['stock']}, ledger {row['ledger_stock']}, drift {row['drift']}")
+    print(reconciler.last_run)
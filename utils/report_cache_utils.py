@@ -0,0 +1,214 @@
+import asyncio
+import os
+import zlib
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta
+from typing import Optional
+from urllib.parse import parse_qsl
+
+from utils.cache_utils import LRUCache
+from utils.invalidation_utils import invalidation_channel
+
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # compressed payloads
+REPORT_CACHE_MAX_ENTRIES = int(os.environ.get('REPORT_CACHE_MAX_ENTRIES', 10000))
+# Seconds a report whose range reaches today is served from the cache, 0 only caches past ranges
+REPORT_CACHE_RECENT_TTL = int(os.environ.get('REPORT_CACHE_RECENT_TTL', 30))
+# Seconds after the end of a range before it counts as past, write-behind sales of its last minutes land late
+REPORT_CACHE_SETTLE = int(os.environ.get('REPORT_CACHE_SETTLE', 300))
+
+REPORT_COMPRESSION_LEVEL = 6
+# Larger payloads would push out many smaller reports, e.g. unpaginated raw sales of a year
+REPORT_MAX_ENTRY_BYTES = REPORT_CACHE_MAX_BYTES // 8
+
+# Cached endpoints and the query parameters ending their date ranges
+REPORT_ENDPOINTS = {
+    '/sales/get_data': ('end_date',),
+    '/inventory/track': ('end_date',),
+    '/sales/compare_data': ('end_date', 'end_date2'),
+}
+
+CachedReport = namedtuple('CachedReport', ['body', 'raw_size', 'historical'])
+
+
+def report_key(path: str, query_string: bytes) -> tuple:
+    """
+    Normalized cache key of a report request: parameter order and empty parameters don't matter
+    :param path: endpoint path
+    :param query_string: raw query string
+    :return: tuple
+    """
+    params = parse_qsl(query_string.decode('latin-1'), keep_blank_values=False)
+    return path, tuple(sorted(params))
+
+
+def is_historical(params: dict, end_params: tuple, now: Optional[datetime] = None) -> Optional[bool]:
+    """
+    Whether every range of a report ended before today, i.e. its result can't change anymore
+    :param params: query parameters
+    :param end_params: parameters ending the ranges
+    :param now: current time
+    :return: bool, None when a date is missing or invalid and the handler has to answer
+    """
+    settled = (now or datetime.now()) - timedelta(seconds=REPORT_CACHE_SETTLE)
+    historical = True
+    for name in end_params:
+        try:
+            end = date.fromisoformat(params[name])
+        except (KeyError, ValueError):
+            return None
+        # End days are included, the range is over at the following midnight
+        historical = historical and datetime.combine(end + timedelta(days=1), time()) <= settled
+
+    return historical
+
+
+class ReportCache:
+    """
+    Compressed JSON responses of the report endpoints. Reports of past ranges are kept until evicted,
+    least recently used first once REPORT_CACHE_MAX_BYTES of compressed payloads is reached; reports
+    whose range reaches today expire after REPORT_CACHE_RECENT_TTL seconds. Catalog writes clear it,
+    sales rows show product names.
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int, recent_ttl: int):
+        self.reports = LRUCache(max_entries, maxbytes=max_bytes, sizeof=lambda report: len(report.body))
+        self.recent_ttl = recent_ttl
+        # Reports being computed, concurrent loads of the same report wait for the first one
+        self.in_flight = {}
+
+        self.stored = 0
+        self.too_large = 0
+        self.waits = 0
+        self.stored_raw_bytes = 0
+        self.stored_bytes = 0
+
+    def get(self, key: tuple) -> Optional[CachedReport]:
+        return self.reports.get(key, None)
+
+    def set(self, key: tuple, body: bytes, historical: bool) -> None:
+        """
+        Compresses and caches a report body
+        :param key: report_key of the request
+        :param body: JSON body
+        :param historical: kept until evicted, else for recent_ttl seconds
+        :return:
+        """
+        compressed = zlib.compress(body, REPORT_COMPRESSION_LEVEL)
+        if len(compressed) > REPORT_MAX_ENTRY_BYTES:
+            self.too_large += 1
+            return
+
+        self.reports.set(key, CachedReport(compressed, len(body), historical),
+                         None if historical else self.recent_ttl)
+        self.stored += 1
+        self.stored_raw_bytes += len(body)
+        self.stored_bytes += len(compressed)
+
+    def clear(self, keys=None) -> None:
+        self.reports.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns hit rate, entries and compressed size of the cached reports
+        :return: dict
+        """
+        return {
+            **self.reports.stats(),
+            'stored': self.stored,
+            'too_large': self.too_large,
+            'waits': self.waits,
+            # Over every stored report, evicted ones included
+            'compression_ratio': round(self.stored_raw_bytes / self.stored_bytes, 2) if self.stored_bytes else 0
+        }
+
+
+def invalidate_reports() -> None:
+    """
+    Drops cached reports after past sales or inventory changed, in this and the other workers
+    :return:
+    """
+    report_cache.clear()
+    invalidation_channel.publish('reports')
+
+
+async def _send_report(send, report: CachedReport, deflate: bool) -> None:
+    headers = [(b'content-type', b'application/json'), (b'x-report-cache', b'hit')]
+    if deflate:
+        # zlib streams are the deflate content coding, no need to decompress
+        body = report.body
+        headers += [(b'content-encoding', b'deflate'), (b'vary', b'accept-encoding')]
+    else:
+        body = zlib.decompress(report.body)
+    headers.append((b'content-length', str(len(body)).encode()))
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class ReportCacheMiddleware:
+    """
+    ASGI middleware answering repeated loads of the report endpoints from the ReportCache, before routing,
+    so a hit never checks out a database connection. Only successful JSON responses are cached, streamed
+    ndjson/csv formats pass through.
+    """
+
+    def __init__(self, app, cache: ReportCache):
+        self.app = app
+        self.cache = cache
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET' or scope['path'] not in REPORT_ENDPOINTS:
+            await self.app(scope, receive, send)
+            return
+
+        key = report_key(scope['path'], scope['query_string'])
+        params = dict(key[1])
+        historical = is_historical(params, REPORT_ENDPOINTS[scope['path']])
+        if historical is None or params.get('format', 'json') != 'json' or (
+                not historical and not self.cache.recent_ttl):
+            await self.app(scope, receive, send)
+            return
+
+        deflate = any(name == b'accept-encoding' and b'deflate' in value for name, value in scope['headers'])
+        while True:
+            report = self.cache.get(key)
+            if report is not None:
+                # Answered before routing, tells the metrics middleware the path is a route
+                scope['report_cache_hit'] = True
+                await _send_report(send, report, deflate)
+                return
+
+            in_flight = self.cache.in_flight.get(key)
+            if in_flight is None:
+                break
+            self.cache.waits += 1
+            await in_flight.wait()
+
+        done = self.cache.in_flight[key] = asyncio.Event()
+        status_code, json_body, body = 500, False, []
+
+        async def send_captured(message):
+            nonlocal status_code, json_body
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                headers = message.get('headers', [])
+                json_body = (b'content-type', b'application/json') in headers
+                message['headers'] = [*headers, (b'x-report-cache', b'miss')]
+            elif message['type'] == 'http.response.body':
+                body.append(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_captured)
+            payload = b''.join(body)
+            # Failed responses are cheap and may change, e.g. an unknown category that gets added
+            if status_code == 200 and json_body and payload.startswith(b'{"status":"success"'):
+                self.cache.set(key, payload, historical)
+        finally:
+            del self.cache.in_flight[key]
+            done.set()
+
+
+report_cache = ReportCache(REPORT_CACHE_MAX_BYTES, REPORT_CACHE_MAX_ENTRIES, REPORT_CACHE_RECENT_TTL)
+
+# Invalidations of other workers
+invalidation_channel.subscribe('reports', report_cache.clear)
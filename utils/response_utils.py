@@ -0,0 +1,49 @@
+import time
+from decimal import Decimal
+from typing import Any, Sequence
+
+import orjson
+from fastapi.responses import ORJSONResponse, Response
+from sqlalchemy.engine import Row
+
+from utils.metrics_utils import record_serialization
+
+# Output keys of the projection rows, in select order. Columns past the last key (like the
+# keyset id of inventory_track_query) are left out of the output
+SALE_FIELDS = ('invoice_no', 'item', 'quantity', 'price per piece', 'total', 'invoice time')
+INVENTORY_TRACK_FIELDS = ('product_name', 'product_sku', 'units', 'operation', 'operation_date')
+
+
+class JSONResponse(ORJSONResponse):
+    """
+    orjson response recording its render time in the request metrics
+    """
+
+    def render(self, content: Any) -> bytes:
+        started = time.perf_counter()
+        body = super().render(content)
+        record_serialization(time.perf_counter() - started)
+        return body
+
+
+def rows_response(content: dict, fields: Sequence[str]) -> Response:
+    """
+    Serializes a payload holding projection rows straight to JSON with orjson. Rows are encoded
+    one at a time as objects keyed by fields, no list of dicts is built and no response model is
+    validated, which is what makes large pages cheap
+    :param content: response payload, rows may sit anywhere in it
+    :param fields: output key of each row column
+    :return: JSON Response
+    """
+    def default(value):
+        if isinstance(value, Row):
+            return dict(zip(fields, value))
+        if isinstance(value, Decimal):
+            return float(value)
+        raise TypeError
+
+    started = time.perf_counter()
+    body = orjson.dumps(content, default=default)
+    record_serialization(time.perf_counter() - started)
+
+    return Response(body, media_type='application/json')
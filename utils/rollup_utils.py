@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, delete, func, insert, literal, select, update
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from constants import TIME_INTERVAL_MAPPING
+from db_utils import Category, Product, Sale, SalesRollup
+from utils.query_utils import date_bucket
+
+# Every interval the sales endpoints understand gets its own rollup bucket
+ROLLUP_BUCKETS = tuple(TIME_INTERVAL_MAPPING.keys())
+
+
+def get_bucket_start(value: datetime, bucket: str) -> datetime:
+    """
+    Floors a timestamp to the start of its calendar bucket
+    :param value: timestamp to floor
+    :param bucket: bucket name i.e. daily, weekly, monthly, yearly
+    :return: datetime
+    """
+    day = datetime(value.year, value.month, value.day)
+    if bucket == 'daily':
+        return day
+    if bucket == 'weekly':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'monthly':
+        return day.replace(day=1)
+    if bucket == 'yearly':
+        return day.replace(month=1, day=1)
+
+    raise ValueError(f'Unknown rollup bucket: {bucket}')
+
+
+async def _upsert_rollup_rows(db: AsyncSession, rows: list) -> None:
+    """
+    Adds rows to existing rollup rows, inserting missing ones
+    :param db: DB Session
+    :param rows: list of rollup dicts (bucket, bucket_start, product_id, category_id, units, revenue, sale_count)
+    :return:
+    """
+    dialect = db.bind.dialect.name
+
+    # Single statement upsert where the dialect supports it
+    if dialect == 'mysql':
+        stmt = mysql.insert(SalesRollup).values(rows)
+        await db.execute(stmt.on_duplicate_key_update(
+            units=SalesRollup.units + stmt.inserted.units,
+            revenue=SalesRollup.revenue + stmt.inserted.revenue,
+            sale_count=SalesRollup.sale_count + stmt.inserted.sale_count,
+        ))
+        return
+
+    if dialect == 'sqlite':
+        stmt = sqlite.insert(SalesRollup).values(rows)
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=['bucket', 'bucket_start', 'product_id'],
+            set_={
+                'units': SalesRollup.units + stmt.excluded.units,
+                'revenue': SalesRollup.revenue + stmt.excluded.revenue,
+                'sale_count': SalesRollup.sale_count + stmt.excluded.sale_count,
+            },
+        ))
+        return
+
+    # Generic fallback: update and insert when nothing was there yet
+    for row in rows:
+        result = await db.execute(
+            update(SalesRollup)
+            .where(SalesRollup.bucket == row['bucket'], SalesRollup.bucket_start == row['bucket_start'],
+                   SalesRollup.product_id == row['product_id'])
+            .values(units=SalesRollup.units + row['units'],
+                    revenue=SalesRollup.revenue + row['revenue'],
+                    sale_count=SalesRollup.sale_count + row['sale_count'])
+        )
+        if not result.rowcount:
+            await db.execute(insert(SalesRollup).values(**row))
+
+
+async def add_sales_to_rollups(db: AsyncSession, sales: list) -> None:
+    """
+    Adds sales to every rollup bucket, each sale counts as one invoice. Runs inside the caller's
+    transaction so the rollups commit (or roll back) together with the sales.
+    :param db: DB Session
+    :param sales: list of (product_id, category_id, units, revenue, sale_time) tuples
+    :return:
+    """
+    # Merge sales falling in the same rollup row so each row is touched once
+    totals = defaultdict(lambda: [0, 0.0, 0])
+    for product_id, category_id, units, revenue, sale_time in sales:
+        for bucket in ROLLUP_BUCKETS:
+            entry = totals[(bucket, get_bucket_start(sale_time, bucket), product_id, category_id)]
+            entry[0] += units
+            entry[1] += revenue
+            entry[2] += 1
+
+    rows = [{
+        'bucket': bucket,
+        'bucket_start': bucket_start,
+        'product_id': product_id,
+        'category_id': category_id,
+        'units': units,
+        'revenue': revenue,
+        'sale_count': sale_count
+    } for (bucket, bucket_start, product_id, category_id), (units, revenue, sale_count) in totals.items()]
+
+    if rows:
+        await _upsert_rollup_rows(db, rows)
+
+
+async def recategorize_rollups(db: AsyncSession, categories: dict) -> None:
+    """
+    Moves the rollup rows of recategorized products to their new category in the caller's transaction,
+    category summaries read the category_id copied into the rollups and not the product's
+    :param db: DB Session
+    :param categories: dict of product_id to new category_id
+    :return:
+    """
+    if not categories:
+        return
+
+    rollup = SalesRollup.__table__
+    await db.execute(
+        update(rollup)
+        .where(rollup.c.product_id == bindparam('b_product_id'))
+        .values(category_id=bindparam('b_category_id')),
+        [{'b_product_id': product_id, 'b_category_id': category_id} for product_id, category_id in categories.items()]
+    )
+
+
+async def check_rollups(db: AsyncSession, buckets: tuple = ROLLUP_BUCKETS) -> list:
+    """
+    Compares units and revenue per category of every rollup bucket with the raw sales
+    :param db: DB Session
+    :param buckets: rollup buckets to check
+    :return: list of mismatch messages, empty when the rollups match
+    """
+    sales = {category_id: (units, revenue) for category_id, units, revenue in await db.execute(
+        select(Product.category_id, func.sum(Sale.pieces), func.sum(Sale.pieces * Sale.price_per_piece))
+        .join(Product, Product.id == Sale.product_id)
+        .group_by(Product.category_id)
+    )}
+    mismatches = []
+    for bucket in buckets:
+        rollups = {category_id: (units, revenue) for category_id, units, revenue in await db.execute(
+            select(SalesRollup.category_id, func.sum(SalesRollup.units), func.sum(SalesRollup.revenue))
+            .where(SalesRollup.bucket == bucket)
+            .group_by(SalesRollup.category_id)
+        )}
+        for category_id in sorted(sales.keys() | rollups.keys()):
+            units, revenue = sales.get(category_id, (0, 0))
+            rollup_units, rollup_revenue = rollups.get(category_id, (0, 0))
+            # Revenue sums floats in a different order
+            if units != rollup_units or abs(revenue - rollup_revenue) > max(abs(revenue), 1) * 1e-6:
+                mismatches.append(f'{bucket} category {category_id}: rollups {rollup_units} units {rollup_revenue:.2f}'
+                                  f' revenue, sales {units} units {revenue:.2f} revenue')
+
+    return mismatches
+
+
+async def update_sale_rollups(db: AsyncSession, sale_lines: list, sale_time: datetime) -> None:
+    """
+    Adds sold lines of one sale to every rollup bucket, in the caller's transaction
+    :param db: DB Session
+    :param sale_lines: list of (product_id, category_id, units, revenue) tuples
+    :param sale_time: time of the sale
+    :return:
+    """
+    await add_sales_to_rollups(db, [(product_id, category_id, units, revenue, sale_time)
+                                    for product_id, category_id, units, revenue in sale_lines])
+
+
+async def get_rollup_summary(db: AsyncSession, bucket: str, start: datetime, end: datetime,
+                             product_sku: str = '', category: str = '') -> list:
+    """
+    Returns per product totals read from the rollup table
+    :param db: DB Session
+    :param bucket: rollup bucket to read
+    :param start: first bucket start included
+    :param end: last bucket start included
+    :param product_sku: optional product SKU filter
+    :param category: optional category name filter
+    :return: list
+    """
+    query = (
+        select(Product.product_name, Product.sku, Category.cat_name,
+               func.sum(SalesRollup.units), func.sum(SalesRollup.sale_count), func.sum(SalesRollup.revenue))
+        .join(Product, Product.id == SalesRollup.product_id)
+        .join(Category, Category.id == SalesRollup.category_id)
+        .where(SalesRollup.bucket == bucket, SalesRollup.bucket_start >= start, SalesRollup.bucket_start <= end)
+        .group_by(Product.id, Product.product_name, Product.sku, Category.cat_name)
+        .order_by(Product.id)
+    )
+    if product_sku:
+        query = query.where(Product.sku == product_sku)
+    if category:
+        query = query.where(Category.cat_name == category)
+
+    return [{
+        'item': product_name,
+        'sku': sku,
+        'category': cat_name,
+        'quantity': units,
+        'invoices': sale_count,
+        'total': revenue
+    } for product_name, sku, cat_name, units, sale_count, revenue in await db.execute(query)]
+
+
+async def backfill_rollups(db: AsyncSession, buckets: tuple = ROLLUP_BUCKETS) -> int:
+    """
+    Rebuilds rollup buckets from the raw sales table with one INSERT ... SELECT ... GROUP BY per bucket,
+    in the transaction that deleted the bucket. Sales committing meanwhile wait for the rebuild (SQLite
+    locks the database, MySQL the sales the select reads) and then upsert into the rebuilt rows, so the
+    server can keep selling while it runs.
+    :param db: DB Session
+    :param buckets: rollup buckets to rebuild
+    :return: number of rollup rows written
+    """
+    written = 0
+    await db.execute(delete(SalesRollup).where(SalesRollup.bucket.in_(buckets)))
+    for bucket in buckets:
+        bucket_start = date_bucket(Sale.sale_time, bucket)
+        if db.bind.dialect.name == 'sqlite':
+            # SQLite keeps DateTime as text with microseconds, rows upserted by sales must match
+            bucket_start = bucket_start + literal('.000000')
+        result = await db.execute(insert(SalesRollup).from_select(
+            ['bucket', 'bucket_start', 'product_id', 'category_id', 'units', 'revenue', 'sale_count'],
+            select(literal(bucket), bucket_start, Sale.product_id, Product.category_id, func.sum(Sale.pieces),
+                   func.sum(Sale.pieces * Sale.price_per_piece), func.count())
+            .join(Product, Product.id == Sale.product_id)
+            .group_by(bucket_start, Sale.product_id, Product.category_id)
+        ))
+        written += result.rowcount
+
+    await db.commit()
+
+    return written
+
+
+async def _run_backfill(buckets: tuple) -> int:
+    from db_utils import AsyncSessionLocal
+
+    async with AsyncSessionLocal() as session:
+        return await backfill_rollups(session, buckets)
+
+
+async def _run_check(buckets: tuple) -> list:
+    from db_utils import AsyncSessionLocal
+
+    async with AsyncSessionLocal() as session:
+        return await check_rollups(session, buckets)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild sales rollup tables from raw sales')
+    parser.add_argument('--bucket', action='append', choices=ROLLUP_BUCKETS,
+                        help='bucket to rebuild, can be repeated (default: all)')
+    parser.add_argument('--check', action='store_true',
+                        help='only compare the rollups with the raw sales per category, exit with 1 on a mismatch')
+    args = parser.parse_args()
+
+    if args.check:
+        rollup_mismatches = asyncio.run(_run_check(tuple(args.bucket or ROLLUP_BUCKETS)))
+        for mismatch in rollup_mismatches:
+            print(mismatch)
+        print(f'{len(rollup_mismatches)} rollup mismatches')
+        sys.exit(1 if rollup_mismatches else 0)
+
+    written = asyncio.run(_run_backfill(tuple(args.bucket or ROLLUP_BUCKETS)))
+    print(f'Backfill done, {written} rollup rows written')
@@ -0,0 +1,369 @@
+import asyncio
+import heapq
+import logging
+import re
+import time
+from bisect import bisect_left, insort
+from collections import namedtuple
+from typing import Iterable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import db_utils
+from db_utils import Category, Product
+
+logger = logging.getLogger(__name__)
+
+MAX_SEARCH_RESULTS = 100
+MAX_PREFIX_WORDS = 500  # vocabulary words a short prefix expands to
+
+# Weight of a match by product field, SKUs are what cashiers type the most precisely
+FIELD_WEIGHTS = {'sku': 1.2, 'name': 1.0, 'category': 0.6}
+# Match quality, a prefix scores up to exact as it gets longer
+EXACT_SCORE = 1.0
+PREFIX_SCORE = 0.5
+FUZZY_SCORE = 0.4
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+')
+
+SearchResult = namedtuple('SearchResult', ['id', 'product_name', 'sku', 'price', 'category', 'score'])
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def trigrams(word: str) -> set:
+    # Padded at the start only, a typed prefix shares its first grams with the word
+    padded = f'$${word}'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_edits(token: str) -> int:
+    """
+    Typos tolerated in a query word, none for short words which would match almost anything
+    """
+    if len(token) < 4:
+        return 0
+    return 1 if len(token) < 8 else 2
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Optimal string alignment distance (insertions, deletions, substitutions and swapped neighbours),
+    stops early once it is over limit
+    :return: distance, limit + 1 when over it
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+
+    return previous[-1]
+
+
+class ProductSearchIndex:
+    """
+    In-memory search over product name, SKU and category name for lookup-as-you-type.
+    Every word maps to the products holding it by field weight (an inverted index); the sorted
+    vocabulary finds the words a prefix expands to with a binary search, and a trigram index of the
+    vocabulary finds the candidates of misspelled words, verified with an edit distance. Products must
+    match every query word, ranked by the sum of their best match per word. Candidates are read best
+    score first and reading stops once the rest can't make the results, so a word shared by half the
+    catalog costs about as much as a rare one.
+
+    The index is built from the database on first use. Product writes of any worker mark their SKUs
+    stale through the catalog invalidation, the next search reloads them with one query.
+    """
+
+    def __init__(self):
+        self.products = {}
+        self.sku_ids = {}
+        # product id -> [(word, field weight)]
+        self.product_words = {}
+        # word -> {field weight: {product id: None}}, ids in insertion order
+        self.postings = {}
+        self.vocabulary = []
+        self.word_grams = {}
+
+        self.built = False
+        self.building = False
+        self.stale = set()
+        self.lock = asyncio.Lock()
+
+        self.searches = 0
+        self.reloads = 0
+        self.build_ms = 0
+
+    def add(self, product_id: int, product_name: str, sku: str, price: float, category: str) -> None:
+        """
+        Indexes a product, replacing what was indexed for it before
+        :return:
+        """
+        self.remove(product_id)
+        self.products[product_id] = (product_name, sku, price, category)
+        self.sku_ids[sku] = product_id
+
+        words = {}
+        for field, text in (('category', category), ('name', product_name), ('sku', sku)):
+            for word in tokenize(text):
+                words[word] = max(words.get(word, 0), FIELD_WEIGHTS[field])
+
+        for word, weight in words.items():
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = {}
+                if self.building:
+                    self.vocabulary.append(word)
+                else:
+                    insort(self.vocabulary, word)
+                # Codes and numbers like SKUs and sizes are only matched exactly or by prefix
+                if word.isalpha():
+                    for gram in trigrams(word):
+                        self.word_grams.setdefault(gram, set()).add(word)
+            postings.setdefault(weight, {})[product_id] = None
+        self.product_words[product_id] = list(words.items())
+
+    def remove(self, product_id: int) -> None:
+        if product_id not in self.products:
+            return
+
+        sku = self.products.pop(product_id)[1]
+        if self.sku_ids.get(sku) == product_id:
+            del self.sku_ids[sku]
+        for word, weight in self.product_words.pop(product_id):
+            postings = self.postings[word]
+            del postings[weight][product_id]
+            if not postings[weight]:
+                del postings[weight]
+            if postings:
+                continue
+            # Last product of the word
+            del self.postings[word]
+            del self.vocabulary[bisect_left(self.vocabulary, word)]
+            if not word.isalpha():
+                continue
+            for gram in trigrams(word):
+                self.word_grams[gram].discard(word)
+                if not self.word_grams[gram]:
+                    del self.word_grams[gram]
+
+    def mark_stale(self, skus: Optional[Iterable[str]]) -> None:
+        """
+        Reloads products on the next search, every product when skus is None
+        :param skus: written SKUs
+        :return:
+        """
+        if skus is None:
+            self.built = False
+        else:
+            self.stale.update(skus)
+
+    async def build(self, db: AsyncSession) -> int:
+        """
+        Indexes every product
+        :param db: DB Session
+        :return: number of products
+        """
+        started = time.perf_counter()
+        for structure in (self.products, self.sku_ids, self.product_words, self.postings, self.word_grams,
+                          self.stale):
+            structure.clear()
+        self.vocabulary = []
+        rows = (await db.execute(_product_query())).all()
+        # Sorted once at the end instead of on every new word
+        self.building = True
+        try:
+            for row in rows:
+                self.add(*row)
+        finally:
+            self.building = False
+            self.vocabulary.sort()
+        self.built = True
+        self.build_ms = (time.perf_counter() - started) * 1000
+
+        return len(self.products)
+
+    async def refresh(self, db: AsyncSession, skus: Iterable[str]) -> None:
+        """
+        Reloads products by SKU, dropping the deleted ones
+        :param db: DB Session
+        :param skus: SKUs to reload
+        :return:
+        """
+        skus = list(skus)
+        found = set()
+        for row in await db.execute(_product_query().where(Product.sku.in_(skus))):
+            self.add(*row)
+            found.add(row.sku)
+        for sku in set(skus) - found:
+            if sku in self.sku_ids:
+                self.remove(self.sku_ids[sku])
+        self.reloads += 1
+
+    async def ensure_current(self) -> None:
+        """
+        Builds the index or reloads stale products, without a database round trip when it is current
+        :return:
+        """
+        if self.built and not self.stale:
+            return
+
+        async with self.lock:
+            if self.built and not self.stale:
+                return
+            async with db_utils.AsyncSessionLocal() as db:
+                if not self.built:
+                    await self.build(db)
+                else:
+                    skus, self.stale = self.stale, set()
+                    await self.refresh(db, skus)
+
+    async def warm_up(self) -> None:
+        """
+        Builds the index before the first search, a failure leaves it to the first search
+        :return:
+        """
+        try:
+            await self.ensure_current()
+        except Exception:
+            logger.exception('Building the product search index failed')
+
+    def _word_matches(self, token: str, prefix: bool) -> dict:
+        """
+        Vocabulary words matching a query word with their match score. Misspellings are only looked
+        for when nothing starts with the word
+        :param token: query word
+        :param prefix: the word is still being typed, words starting with it match too
+        :return: dict of word to score
+        """
+        matches = {}
+        if token in self.postings:
+            matches[token] = EXACT_SCORE
+
+        if prefix:
+            start = bisect_left(self.vocabulary, token)
+            for word in self.vocabulary[start:start + MAX_PREFIX_WORDS]:
+                if not word.startswith(token):
+                    break
+                if word != token:
+                    matches[word] = PREFIX_SCORE + (EXACT_SCORE - PREFIX_SCORE) * len(token) / len(word)
+
+        edits = max_edits(token)
+        if matches or not edits:
+            return matches
+
+        # A word within k edits still shares all but 3k of the token's grams
+        grams = trigrams(token)
+        shared = {}
+        for gram in grams:
+            for word in self.word_grams.get(gram, ()):
+                shared[word] = shared.get(word, 0) + 1
+        needed = max(1, len(grams) - 3 * edits)
+        for word, count in shared.items():
+            if count < needed or (not prefix and abs(len(word) - len(token)) > edits):
+                continue
+            # Typos in what is typed so far count against the same length of the word
+            distance = edit_distance(token, word, edits)
+            if prefix and len(word) > len(token):
+                distance = min(distance, edit_distance(token, word[:len(token)], edits))
+            if distance <= edits:
+                matches[word] = FUZZY_SCORE * (1 - distance / (edits + 1))
+
+        return matches
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """
+        Products matching every word of the query, best first. The last word is matched as a prefix
+        :param query: search text
+        :param limit: number of results
+        :return: list of SearchResult
+        """
+        self.searches += 1
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return []
+
+        token_matches = []
+        for index, token in enumerate(tokens):
+            matches = self._word_matches(token, prefix=index == len(tokens) - 1)
+            if not matches:
+                return []
+            token_matches.append(matches)
+
+        # Candidates come from the query word matching the fewest products, the other words are
+        # checked against the words of each candidate
+        token_matches.sort(key=lambda matches: sum(
+            len(products) for word in matches for products in self.postings[word].values()))
+        others = token_matches[1:]
+        # Most the other words can add to a candidate
+        others_bound = sum(max(score * max(self.postings[word]) for word, score in matches.items())
+                           for matches in others)
+
+        groups = sorted(((score * weight, products) for word, score in token_matches[0].items()
+                         for weight, products in self.postings[word].items()), key=lambda group: -group[0])
+        totals, seen, top = {}, set(), []
+        for score, products in groups:
+            for product_id in products:
+                # Scores only go down from here, stop once the rest can't beat the current results
+                if len(top) == limit and score + others_bound <= top[0]:
+                    break
+                if product_id in seen:
+                    continue
+                seen.add(product_id)
+
+                total = score
+                for matches in others:
+                    best = 0
+                    for word, weight in self.product_words[product_id]:
+                        match_score = matches.get(word)
+                        if match_score is not None:
+                            best = max(best, match_score * weight)
+                    if not best:
+                        break
+                    total += best
+                else:
+                    totals[product_id] = total
+                    heapq.heappush(top, total)
+                    if len(top) > limit:
+                        heapq.heappop(top)
+            else:
+                continue
+            break
+
+        best = heapq.nsmallest(limit, totals.items(),
+                               key=lambda item: (-item[1], len(self.products[item[0]][0]), item[0]))
+        return [SearchResult(product_id, *self.products[product_id], round(score, 4)) for product_id, score in best]
+
+    def stats(self) -> dict:
+        return {
+            'built': self.built,
+            'products': len(self.products),
+            'words': len(self.vocabulary),
+            'trigrams': len(self.word_grams),
+            'stale': len(self.stale),
+            'searches': self.searches,
+            'reloads': self.reloads,
+            'build_ms': round(self.build_ms, 1)
+        }
+
+
+def _product_query():
+    return (
+        select(Product.id, Product.product_name, Product.sku, Product.price, Category.cat_name)
+        .join(Category, Category.id == Product.category_id)
+    )
+
+
+product_search = ProductSearchIndex()
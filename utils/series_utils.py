@@ -0,0 +1,136 @@
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_utils import Category, Product, Sale, SalesRollup
+from utils.query_utils import date_bucket
+from utils.rollup_utils import ROLLUP_BUCKETS, get_bucket_start
+
+SERIES_BUCKETS = ('hourly', 'daily', 'weekly', 'monthly')
+SERIES_SPLITS = ('category', 'sku')
+
+
+def _floor(value: datetime, bucket: str) -> datetime:
+    if bucket == 'hourly':
+        return value.replace(minute=0, second=0, microsecond=0)
+    return get_bucket_start(value, bucket)
+
+
+def _next_bucket(value: datetime, bucket: str) -> datetime:
+    if bucket == 'hourly':
+        return value + timedelta(hours=1)
+    if bucket == 'daily':
+        return value + timedelta(days=1)
+    if bucket == 'weekly':
+        return value + timedelta(weeks=1)
+    # Calendar months, not 30 days
+    return value.replace(year=value.year + value.month // 12, month=value.month % 12 + 1)
+
+
+def series_buckets(start_date: date, end_date: date, bucket: str) -> list:
+    """
+    Starts of every bucket overlapping the range, the first and last bucket are whole so they may
+    reach outside it
+    :param start_date: first day
+    :param end_date: last day, included
+    :param bucket: hourly, daily, weekly or monthly
+    :return: list of datetimes
+    """
+    if bucket not in SERIES_BUCKETS:
+        raise ValueError(f'Unknown series bucket: {bucket}')
+
+    current = _floor(datetime(start_date.year, start_date.month, start_date.day), bucket)
+    end = datetime(end_date.year, end_date.month, end_date.day) + timedelta(days=1)
+    buckets = []
+    while current < end:
+        buckets.append(current)
+        current = _next_bucket(current, bucket)
+
+    return buckets
+
+
+def build_series_query(first: datetime, last: datetime, bucket: str, split_by: str = None, categories: list = (),
+                       skus: list = ()):
+    """
+    Builds the per bucket units and revenue statement. Daily and coarser buckets read the sales rollups,
+    hourly buckets group the sales table in SQL
+    :param first: first bucket start
+    :param last: last bucket start
+    :param bucket: hourly, daily, weekly or monthly
+    :param split_by: None, category or sku
+    :param categories: category names to keep, all categories if empty
+    :param skus: SKUs to keep, all products if empty
+    :return: Select
+    """
+    if bucket in ROLLUP_BUCKETS:
+        bucket_start = SalesRollup.bucket_start
+        units, revenue = func.sum(SalesRollup.units), func.sum(SalesRollup.revenue)
+        query = select().select_from(SalesRollup).where(
+            SalesRollup.bucket == bucket, SalesRollup.bucket_start >= first, SalesRollup.bucket_start <= last)
+        product_id, category_id = SalesRollup.product_id, SalesRollup.category_id
+    else:
+        bucket_start = date_bucket(Sale.sale_time, bucket)
+        units, revenue = func.sum(Sale.pieces), func.sum(Sale.pieces * Sale.price_per_piece)
+        query = select().select_from(Sale).where(
+            Sale.sale_time >= first, Sale.sale_time < _next_bucket(last, bucket))
+        product_id, category_id = Sale.product_id, None
+
+    keys = [bucket_start]
+    # The rollups carry the category, sales need the product for it
+    if split_by == 'sku' or skus or (category_id is None and (split_by == 'category' or categories)):
+        query = query.join(Product, Product.id == product_id)
+        category_id = Product.category_id if category_id is None else category_id
+    if split_by == 'category' or categories:
+        query = query.join(Category, Category.id == category_id)
+    if categories:
+        query = query.where(Category.cat_name.in_(categories))
+    if skus:
+        query = query.where(Product.sku.in_(skus))
+    if split_by == 'category':
+        keys.append(Category.cat_name)
+    elif split_by == 'sku':
+        keys.append(Product.sku)
+
+    return query.add_columns(*keys, units.label('units'), revenue.label('revenue')).group_by(*keys)
+
+
+async def sales_series(db: AsyncSession, start_date: date, end_date: date, bucket: str, split_by: str = None,
+                       categories: list = (), skus: list = (), top: int = None) -> dict:
+    """
+    Per bucket units and revenue computed in one query, buckets without sales are filled with zeros
+    so every series has one point per bucket
+    :param db: DB Session
+    :param start_date: first day
+    :param end_date: last day, included
+    :param bucket: hourly, daily, weekly or monthly
+    :param split_by: None for one total series, category or sku for one series each
+    :param categories: category names to keep, all categories if empty
+    :param skus: SKUs to keep, all products if empty
+    :param top: keep the series with the highest revenue only
+    :return: dict with bucket starts and series
+    """
+    buckets = series_buckets(start_date, end_date, bucket)
+    positions = {bucket_start: index for index, bucket_start in enumerate(buckets)}
+    query = build_series_query(buckets[0], buckets[-1], bucket, split_by, list(categories), list(skus))
+
+    series = {}
+    for row in await db.execute(query):
+        # date_bucket yields strings, the rollup table datetimes
+        bucket_start = datetime.fromisoformat(row[0]) if isinstance(row[0], str) else row[0]
+        key = row[1] if split_by else None
+        if key not in series:
+            series[key] = {'key': key, 'units': [0] * len(buckets), 'revenue': [0.0] * len(buckets)}
+        position = positions[bucket_start]
+        series[key]['units'][position] = int(row.units or 0)
+        series[key]['revenue'][position] = float(row.revenue or 0)
+
+    lines = sorted(series.values(), key=lambda line: (-sum(line['revenue']), str(line['key'])))
+    if not split_by and not lines:
+        lines = [{'key': None, 'units': [0] * len(buckets), 'revenue': [0.0] * len(buckets)}]
+
+    return {
+        'bucket': bucket,
+        'buckets': buckets,
+        'series': lines[:top] if top else lines
+    }
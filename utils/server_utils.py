@@ -0,0 +1,116 @@
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import uvicorn
+
+logger = logging.getLogger('uvicorn.error')
+
+WORKER_CHECK_INTERVAL = 1  # seconds between checks for dead workers
+WORKER_START_DELAY = 2  # seconds a new worker gets to start serving before an old one is stopped on reload
+
+# Workers are spawned, not forked, so they don't inherit the supervisor's signal handlers and threads
+spawn = multiprocessing.get_context('spawn')
+
+
+def _run_worker(config: uvicorn.Config, sockets: list) -> None:
+    # Logging setup of the supervisor is not inherited by spawned processes
+    config.configure_logging()
+    uvicorn.Server(config=config).run(sockets=sockets)
+
+
+class WorkerSupervisor:
+    """
+    Runs the app in several worker processes sharing one listening socket, like uvicorn --workers, and
+    adds what the production deployment needs on top:
+    - SIGHUP reloads gracefully: workers are replaced one at a time, a new one is started before an old one
+      gets SIGTERM, which lets it finish its requests and flush the sales ledger
+    - workers that die are restarted
+    - workers get a shared INVALIDATION_SOCKET_DIR so cache invalidations reach every worker
+    """
+
+    def __init__(self, config: uvicorn.Config):
+        self.config = config
+        self.processes = []
+        self.should_exit = threading.Event()
+        self.should_reload = threading.Event()
+        self.socket_dir: Optional[tempfile.TemporaryDirectory] = None
+
+    def run(self) -> None:
+        self.socket_dir = tempfile.TemporaryDirectory(prefix='invalidation-')
+        # Spawned workers inherit the environment
+        os.environ['INVALIDATION_SOCKET_DIR'] = self.socket_dir.name
+        sockets = [self.config.bind_socket()]
+
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._reload)
+
+        logger.info('Started supervisor [%s] with %s workers', os.getpid(), self.config.workers)
+        for _ in range(self.config.workers):
+            self.processes.append(self._start_worker(sockets))
+
+        while not self.should_exit.wait(WORKER_CHECK_INTERVAL):
+            if self.should_reload.is_set():
+                self.should_reload.clear()
+                self._rolling_restart(sockets)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning('Worker [%s] exited with %s, restarting it', process.pid, process.exitcode)
+                    self.processes[index] = self._start_worker(sockets)
+
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.socket_dir.cleanup()
+        logger.info('Stopped supervisor [%s]', os.getpid())
+
+    def _start_worker(self, sockets: list):
+        process = spawn.Process(target=_run_worker, kwargs={'config': self.config, 'sockets': sockets})
+        process.start()
+        return process
+
+    def _rolling_restart(self, sockets: list) -> None:
+        logger.info('Reloading %s workers', len(self.processes))
+        for index, process in enumerate(self.processes):
+            self.processes[index] = self._start_worker(sockets)
+            time.sleep(WORKER_START_DELAY)
+            process.terminate()
+            process.join()
+        logger.info('Reloaded')
+
+    def _stop(self, sig, frame) -> None:
+        self.should_exit.set()
+
+    def _reload(self, sig, frame) -> None:
+        self.should_reload.set()
+
+
+def serve(app: str, host: str, port: int, workers: int = 1, reload: bool = False,
+          graceful_timeout: Optional[int] = None) -> None:
+    """
+    Serves the app in one process, or with a WorkerSupervisor for several workers
+    :param app: import string of the app e.g. main:app, workers import it themselves
+    :param host: bind address
+    :param port: bind port
+    :param workers: worker processes, e.g. the number of cores
+    :param reload: restart on code changes, development only, one process
+    :param graceful_timeout: seconds a stopping worker waits for open requests
+    :return:
+    """
+    if reload:
+        uvicorn.run(app, host=host, port=port, reload=True)
+        return
+
+    config = uvicorn.Config(app, host=host, port=port, workers=workers, timeout_graceful_shutdown=graceful_timeout)
+    if workers > 1:
+        WorkerSupervisor(config).run()
+    else:
+        uvicorn.Server(config).run()
@@ -0,0 +1,68 @@
+import asyncio
+from typing import Iterable
+
+from sqlalchemy import Select, delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from constants import LOW_STOCK_LIMIT
+from db_utils import Inventory, Product, StockSnapshot
+
+SNAPSHOT_COLUMNS = ['product_id', 'sku', 'product_name', 'category_id', 'stock', 'low_stock_threshold', 'headroom',
+                    'updated_at']
+
+
+def snapshot_source_query() -> Select:
+    """
+    Snapshot rows computed from inventory and product, the product threshold overrides LOW_STOCK_LIMIT
+    :return: Select in SNAPSHOT_COLUMNS order
+    """
+    threshold = func.coalesce(Inventory.low_stock_threshold, LOW_STOCK_LIMIT)
+    return (
+        select(Inventory.product_id, Product.sku, Product.product_name, Product.category_id, Inventory.stock,
+               threshold, Inventory.stock - threshold, func.now())
+        .join(Product, Product.id == Inventory.product_id)
+    )
+
+
+async def refresh_stock_snapshot(db: AsyncSession, product_ids: Iterable[int]) -> None:
+    """
+    Rewrites the snapshot rows of products in the caller's transaction, call it after every stock,
+    threshold or product write. Writers of a product are already serialized by its inventory row lock.
+    :param db: DB Session
+    :param product_ids: written products
+    :return:
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+
+    # Pending ORM changes have to reach inventory before it is read back
+    await db.flush()
+    await db.execute(delete(StockSnapshot).where(StockSnapshot.product_id.in_(product_ids)))
+    await db.execute(insert(StockSnapshot).from_select(
+        SNAPSHOT_COLUMNS, snapshot_source_query().where(Inventory.product_id.in_(product_ids))
+    ))
+
+
+async def rebuild_stock_snapshot(db: AsyncSession) -> int:
+    """
+    Rebuilds the whole snapshot, needed after LOW_STOCK_LIMIT changes or writes that bypassed the app
+    :param db: DB Session
+    :return: number of snapshot rows
+    """
+    await db.execute(delete(StockSnapshot))
+    await db.execute(insert(StockSnapshot).from_select(SNAPSHOT_COLUMNS, snapshot_source_query()))
+    await db.commit()
+
+    return await db.scalar(select(func.count()).select_from(StockSnapshot))
+
+
+async def _run_rebuild() -> int:
+    from db_utils import AsyncSessionLocal
+
+    async with AsyncSessionLocal() as session:
+        return await rebuild_stock_snapshot(session)
+
+
+if __name__ == '__main__':
+    print(f'Stock snapshot rebuilt, {asyncio.run(_run_rebuild())} products')
@@ -0,0 +1,139 @@
+from datetime import date
+
+from sqlalchemy import func, literal, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_utils import Category, Product, Sale
+from utils.query_utils import date_bucket
+from utils.range_utils import day_range
+
+COMPARE_GROUPS = ('category', 'product', 'bucket')
+
+
+def parse_period(value: str) -> tuple:
+    """
+    Parses a 'start:end' date pair, both days included
+    :param value: e.g. 2024-01-01:2024-03-31
+    :return: (start, end) dates
+    """
+    start, end = (date.fromisoformat(part.strip()) for part in value.split(':'))
+    if start > end:
+        raise ValueError(f'period {value} ends before it starts')
+
+    return start, end
+
+
+def build_compare_query(periods: list, categories: list, group_by: list, bucket: str = 'daily',
+                        period_categories: list = None):
+    """
+    Builds one statement that aggregates every period: a UNION ALL of grouped selects, so
+    overlapping periods each get their own totals
+    :param periods: list of (start, end) dates, end day included
+    :param categories: category names to keep, all categories if empty
+    :param group_by: dimensions among category, product, bucket
+    :param bucket: bucket size when grouping by bucket
+    :param period_categories: one category name per period to keep in that period, instead of categories
+    :return: Select
+    """
+    revenue = func.sum(Sale.pieces * Sale.price_per_piece)
+    selects = []
+    for index, (start, end) in enumerate(periods):
+        range_start, range_end = day_range(start, end, max_days=None)
+        columns = [literal(index).label('period')]
+        keys = []
+        if 'category' in group_by:
+            columns.append(Category.cat_name.label('category'))
+            keys.append(Category.cat_name)
+        if 'product' in group_by:
+            columns += [Product.sku.label('sku'), Product.product_name.label('item')]
+            keys += [Product.sku, Product.product_name]
+        if 'bucket' in group_by:
+            bucket_start = date_bucket(Sale.sale_time, bucket)
+            columns.append(bucket_start.label('bucket_start'))
+            keys.append(bucket_start)
+
+        query = (
+            select(*columns, func.sum(Sale.pieces).label('units'), revenue.label('revenue'),
+                   func.count(Sale.id).label('invoices'))
+            .join(Product, Product.id == Sale.product_id)
+            .join(Category, Category.id == Product.category_id)
+            .where(Sale.sale_time >= range_start, Sale.sale_time < range_end)
+        )
+        if period_categories:
+            query = query.where(Category.cat_name == period_categories[index])
+        elif categories:
+            query = query.where(Category.cat_name.in_(categories))
+        if keys:
+            query = query.group_by(*keys)
+        selects.append(query)
+
+    return union_all(*selects) if len(selects) > 1 else selects[0]
+
+
+def _summary(row) -> dict:
+    units, revenue, invoices = row['units'] or 0, row['revenue'] or 0, row['invoices'] or 0
+    return {
+        'units': units,
+        'revenue': revenue,
+        'invoices': invoices,
+        'avg_price_per_piece': revenue / units if units else 0,
+        'avg_invoice': revenue / invoices if invoices else 0
+    }
+
+
+def _delta(current: dict, previous: dict) -> dict:
+    delta = {}
+    for metric in ('units', 'revenue', 'invoices'):
+        change = current[metric] - previous[metric]
+        delta[metric] = change
+        delta[f'{metric}_pct'] = round(change / previous[metric] * 100, 2) if previous[metric] else None
+
+    return delta
+
+
+async def compare_sales(db: AsyncSession, periods: list, categories: list = (), group_by: list = (),
+                        bucket: str = 'daily', period_categories: list = None) -> list:
+    """
+    Sales totals of several periods computed in SQL, with period over period deltas
+    :param db: DB Session
+    :param periods: list of (start, end) dates, end day included
+    :param categories: category names to keep, all categories if empty
+    :param group_by: dimensions among category, product, bucket
+    :param bucket: bucket size when grouping by bucket
+    :param period_categories: one category name per period to keep in that period, instead of categories
+    :return: list of periods with their groups
+    """
+    query = build_compare_query(periods, list(categories), list(group_by), bucket, period_categories)
+    rows = (await db.execute(query)).mappings().all()
+
+    # Key columns of a group, deltas compare the same group of consecutive periods
+    key_columns = [column for column in ('category', 'sku', 'item', 'bucket_start')
+                   if rows and column in rows[0]]
+    delta_columns = [column for column in key_columns if column != 'bucket_start']
+
+    result = [{'period': index, 'start_date': start, 'end_date': end, 'groups': []}
+              for index, (start, end) in enumerate(periods)]
+    totals = [{} for _ in periods]
+    for row in rows:
+        group = {column: row[column] for column in key_columns}
+        group.update(_summary(row))
+        result[row['period']]['groups'].append(group)
+
+        # Bucket groups of different periods don't line up, deltas use the totals per key
+        key = tuple(row[column] for column in delta_columns)
+        total = totals[row['period']].setdefault(key, {'units': 0, 'revenue': 0, 'invoices': 0})
+        for metric in total:
+            total[metric] += row[metric] or 0
+
+    for index, period in enumerate(result):
+        period['groups'].sort(key=lambda group: tuple(str(group[column]) for column in key_columns))
+        if index:
+            empty = {'units': 0, 'revenue': 0, 'invoices': 0}
+            keys = totals[index].keys() | totals[index - 1].keys()
+            period['change_from_previous'] = [
+                {**dict(zip(delta_columns, key)),
+                 **_delta(totals[index].get(key, empty), totals[index - 1].get(key, empty))}
+                for key in sorted(keys, key=lambda key: tuple(str(part) for part in key))
+            ]
+
+    return result